@@ -0,0 +1,333 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the video pipeline of the output streams. ffmpeg is
+replaced by a stand-in which throws the video and audio away, so only
+the python side of the pipeline is measured:
+
+* conversion: frames converted per second, per resolution, dtype and
+  pixel format (rgb24 or yuv420p) of the pipe
+* pipe_write: megabytes per second written by send_video_frame()
+* pacer_jitter: how late the ticks of TwitchBufferedOutputStream are,
+  at 30 and 60 fps
+* buffer_memory: bytes of memory per frame in the video buffer
+* file_playback: frames per second played by play_file() from a 4K
+  .npy file at 30 fps, and the python memory allocated meanwhile
+
+Store the results of a commit, and compare another commit against them:
+
+    python benchmarks/benchmark.py --output before.json
+    python benchmarks/benchmark.py --compare before.json
+
+The comparison exits with status 1 when a result got worse by more than
+the threshold.
+"""
+from __future__ import print_function, division
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from time import monotonic
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from twitchstream.outputvideo import TwitchOutputStream, \
+    TwitchBufferedOutputStream  # noqa: E402
+
+STAND_IN_FFMPEG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               os.pardir, 'twitchstream', 'tests',
+                               'stand_in_ffmpeg.py')
+
+RESOLUTIONS = (
+    ('360p', 640, 360),
+    ('720p', 1280, 720),
+    ('1080p', 1920, 1080),
+)
+DTYPES = ('uint8', 'float32', 'float64')
+
+
+def result(value, unit, higher_is_better, noise=0.):
+    """
+    :param noise: changes smaller than this are not counted as a
+        regression, whatever the threshold
+    """
+    return {'value': value, 'unit': unit,
+            'higher_is_better': higher_is_better, 'noise': noise}
+
+
+def calls_per_second(function, min_time):
+    """
+    Call a function over and over for at least min_time seconds.
+
+    :return: the number of calls per second, of the fastest of three
+        rounds
+    """
+    best = 0.
+    for _ in range(3):
+        calls = 0
+        start_time = monotonic()
+        while True:
+            function()
+            calls += 1
+            elapsed = monotonic() - start_time
+            if elapsed >= min_time / 3:
+                break
+        best = max(best, calls / elapsed)
+    return best
+
+
+def random_frame(width, height, dtype):
+    frame = np.random.rand(height, width, 3)
+    if dtype == 'uint8':
+        return (frame * 255).astype(np.uint8)
+    return frame.astype(dtype)
+
+
+def open_stream(stream_class, width, height, fps, **kwargs):
+    return stream_class(twitch_stream_key=None,
+                        width=width,
+                        height=height,
+                        fps=fps,
+                        ffmpeg_binary=STAND_IN_FFMPEG,
+                        outputs=('null', ),
+                        **kwargs)
+
+
+def close_stream(stream):
+    stream.__exit__(None, None, None)
+    # the stand-in keeps on reading until its inputs are closed
+    stream.ffmpeg_process.stdin.close()
+    if stream.audio_pipe is not None:
+        os.close(stream.audio_pipe)
+    stream.ffmpeg_process.wait()
+
+
+def benchmark_conversion(min_time):
+    results = {}
+    for name, width, height in RESOLUTIONS:
+        for dtype in DTYPES:
+            frame = random_frame(width, height, dtype)
+            for pix_fmt, yuv_matrix in (('rgb24', None),
+                                        ('yuv420p', 'bt601')):
+                # don't start ffmpeg, only convert
+                stream = TwitchOutputStream.__new__(TwitchOutputStream)
+                stream.pix_fmt = 'rgb24'
+                stream.yuv_matrix = yuv_matrix
+                if dtype == 'uint8' and yuv_matrix is None:
+                    # written as it is, copy to measure the memory bandwidth
+                    def convert():
+                        stream._convert_frame(frame).copy()
+                else:
+                    def convert():
+                        stream._convert_frame(frame)
+                results['conversion/%s/%s/%s' % (name, dtype, pix_fmt)] = \
+                    result(calls_per_second(convert, min_time),
+                           'frames/s', True)
+    return results
+
+
+def benchmark_pipe_write(min_time):
+    results = {}
+    for name, width, height in RESOLUTIONS:
+        stream = open_stream(TwitchOutputStream, width, height, 30.)
+        frame = random_frame(width, height, 'uint8')
+        try:
+            frames_per_second = calls_per_second(
+                lambda: stream.send_video_frame(frame), min_time)
+        finally:
+            close_stream(stream)
+        results['pipe_write/%s' % name] = result(
+            frames_per_second * frame.nbytes / 1e6, 'MB/s', True)
+    return results
+
+
+class TimedStream(TwitchBufferedOutputStream):
+    """
+    Buffered stream which remembers when every tick was called.
+    """
+    def __init__(self, *args, **kwargs):
+        self.tick_times = []
+        super(TimedStream, self).__init__(*args, **kwargs)
+
+    def _send_video_frame(self, repeat=False):
+        self.tick_times.append(monotonic())
+        return super(TimedStream, self)._send_video_frame(repeat)
+
+
+def benchmark_pacer_jitter(duration):
+    results = {}
+    for fps in (30, 60):
+        stream = open_stream(TimedStream, 640, 360, float(fps),
+                             enable_audio=True,
+                             video_buffer_size=fps,
+                             audio_buffer_size=fps)
+        frame = random_frame(640, 360, 'uint8')
+        audio = np.zeros(44100 // fps)
+        try:
+            end_time = monotonic() + duration
+            while monotonic() < end_time:
+                stream.send_video_frame(frame)
+                stream.send_audio(audio, audio)
+        finally:
+            close_stream(stream)
+        times = np.array(stream.tick_times)
+        lateness = times - (times[0] + np.arange(len(times)) / fps)
+        lateness -= min(lateness.min(), 0.)
+        for statistic, value in (('median', np.median(lateness)),
+                                 ('p99', np.percentile(lateness, 99)),
+                                 ('max', lateness.max())):
+            # the scheduler of the OS adds a millisecond here and there
+            results['pacer_jitter/%dfps/%s' % (fps, statistic)] = result(
+                value * 1e3, 'ms', False, noise=1.)
+    return results
+
+
+def benchmark_buffer_memory(frame_count=20):
+    results = {}
+    for dtype in DTYPES:
+        # at one frame per second, the buffer fills up
+        stream = open_stream(TwitchBufferedOutputStream, 1280, 720, 1.,
+                             frame_pool_size=2)
+        try:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(frame_count):
+                stream.send_video_frame(random_frame(1280, 720, dtype))
+            used = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+        finally:
+            close_stream(stream)
+        results['buffer_memory/720p/%s' % dtype] = result(
+            used / frame_count, 'bytes/frame', False)
+    return results
+
+
+def benchmark_file_playback(duration, frame_count=8):
+    results = {}
+    width, height = 3840, 2160
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'frames.npy')
+        frames = np.lib.format.open_memmap(
+            path, mode='w+', dtype=np.uint8,
+            shape=(frame_count, height, width, 3))
+        frames[...] = random_frame(width, height, 'uint8')
+        del frames
+        stream = open_stream(TwitchBufferedOutputStream, width, height, 30.)
+        try:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            frame_file = stream.play_file(path)
+            start_time = monotonic()
+            start_bytes = stream.get_pipe_stats()['video']['bytes_written']
+            time.sleep(duration)
+            written = stream.get_pipe_stats()['video']['bytes_written'] - \
+                start_bytes
+            elapsed = monotonic() - start_time
+            used = tracemalloc.get_traced_memory()[1] - before
+            tracemalloc.stop()
+            stream.play_file(None)
+        finally:
+            close_stream(stream)
+        frame_file.close()
+    finally:
+        shutil.rmtree(directory)
+    results['file_playback/2160p/fps'] = result(
+        written / frame_file.frame_nbytes / elapsed, 'frames/s', True,
+        noise=0.5)
+    # allocations of the pacer and the writer thread, not of frames
+    results['file_playback/2160p/memory'] = result(
+        used, 'bytes', False, noise=1e6)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Print how the results changed since the baseline.
+
+    :return: the names of the results which got worse by more than the
+        threshold
+    """
+    regressions = []
+    print("\n%-40s %12s %12s %8s" % ('compared to %s' % baseline['commit'],
+                                     'before', 'after', 'change'))
+    for name in sorted(results):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['value']
+        after = results[name]['value']
+        change = (after - before) / before if before else 0.
+        worse = -change if results[name]['higher_is_better'] else change
+        flag = ''
+        if worse > threshold and \
+                abs(after - before) > results[name]['noise']:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-40s %12.4g %12.4g %+7.1f%%%s"
+              % (name, before, after, change * 100, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-o', '--output',
+                        help='store the results in this JSON file')
+    parser.add_argument('-c', '--compare',
+                        help='compare the results to this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='the relative change which counts as a '
+                             'regression (default: 0.1)')
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help='measure for a shorter time, less precise')
+    args = parser.parse_args()
+
+    min_time = .3 if args.quick else 1.5
+    results = {}
+    for benchmark in (lambda: benchmark_conversion(min_time),
+                      lambda: benchmark_pipe_write(min_time),
+                      lambda: benchmark_pacer_jitter(4 * min_time),
+                      benchmark_buffer_memory,
+                      lambda: benchmark_file_playback(2 * min_time)):
+        for name, value in sorted(benchmark().items()):
+            print("%-40s %12.4g %s" % (name, value['value'], value['unit']))
+            sys.stdout.flush()
+            results[name] = value
+
+    report = {'results': results}
+    report.update(environment())
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
@@ -24,17 +24,18 @@ if __name__ == "__main__":
             height=480,
             fps=30.,
             verbose=True,
-            enable_audio=True) as videostream:
+            enable_audio=True,
+            video_buffer_size=30,
+            audio_buffer_size=30) as videostream:
 
         frame = np.zeros((480, 640, 3))
 
         while True:
-            if videostream.get_video_frame_buffer_state() < 30:
-                frame = np.random.rand(480, 640, 3)
-                videostream.send_video_frame(frame)
+            # both calls block while the buffers are full
+            frame = np.random.rand(480, 640, 3)
+            videostream.send_video_frame(frame)
 
-            if videostream.get_audio_buffer_state() < 30:
-                left_audio = np.random.randn(1470)
-                right_audio = np.random.randn(1470)
-                videostream.send_audio(left_audio, right_audio)
+            left_audio = np.random.randn(1470)
+            right_audio = np.random.randn(1470)
+            videostream.send_audio(left_audio, right_audio)
 
@@ -9,7 +9,6 @@ from __future__ import print_function
 from twitchstream.outputvideo import TwitchBufferedOutputStream
 from twitchstream.chat import TwitchChatStream
 import argparse
-import time
 import numpy as np
 
 if __name__ == "__main__":
@@ -31,13 +30,18 @@ if __name__ == "__main__":
     # load two streams:
     # * one stream to send the video
     # * one stream to interact with the chat
+    # The buffers hold at most 30 frames and fragments. When they are
+    # full, sending blocks until the stream has made room again.
     with TwitchBufferedOutputStream(
             twitch_stream_key=args.streamkey,
             width=640,
             height=480,
             fps=30.,
             enable_audio=True,
-            verbose=False) as videostream, \
+            verbose=False,
+            video_buffer_size=30,
+            audio_buffer_size=30,
+            overflow='block') as videostream, \
         TwitchChatStream(
             username=args.username,
             oauth=args.oauth,
@@ -46,7 +50,15 @@ if __name__ == "__main__":
         # Send a chat message to let everybody know you've arrived
         chatstream.send_chat_message("Taking requests!")
 
-        frame = np.zeros((480, 640, 3))
+        # One frame per color. The color name is passed along as the
+        # version of the frame, so every frame is only converted once.
+        frames = {
+            'black': np.zeros((480, 640, 3)),
+            'red': np.tile([1., 0., 0.], (480, 640, 1)),
+            'green': np.tile([0., 1., 0.], (480, 640, 1)),
+            'blue': np.tile([0., 0., 1.], (480, 640, 1)),
+        }
+        color = 'black'
         frequency = 100
         last_phase = 0
 
@@ -66,39 +78,21 @@ if __name__ == "__main__":
                         chat_message['message'],
                         chat_message['username']
                     ))
-                    if chat_message['message'] == "red":
-                        frame[:, :, :] = np.array(
-                            [1, 0, 0])[None, None, :]
-                    elif chat_message['message'] == "green":
-                        frame[:, :, :] = np.array(
-                            [0, 1, 0])[None, None, :]
-                    elif chat_message['message'] == "blue":
-                        frame[:, :, :] = np.array(
-                            [0, 0, 1])[None, None, :]
+                    if chat_message['message'] in frames:
+                        color = chat_message['message']
                     elif chat_message['message'].isdigit():
                         frequency = int(chat_message['message'])
 
-            # If there are not enough video frames left,
-            # add some more.
-            if videostream.get_video_frame_buffer_state() < 30:
-                videostream.send_video_frame(frame)
+            # Add a video frame and an audio fragment of the same
+            # duration, to keep audio and video in sync. Both calls
+            # block while the buffers are full, which paces this loop
+            # at the frame rate of the stream.
+            videostream.send_video_frame(frames[color], version=color)
 
-            # If there are not enough audio fragments left,
-            # add some more, but take care to stay in sync with
-            # the video! Audio and video buffer separately,
-            # so they will go out of sync if the number of video
-            # frames does not match the number of audio samples!
-            elif videostream.get_audio_buffer_state() < 30:
-                x = np.linspace(last_phase,
-                                last_phase +
-                                frequency*2*np.pi/videostream.fps,
-                                int(44100 / videostream.fps) + 1)
-                last_phase = x[-1]
-                audio = np.sin(x[:-1])
-                videostream.send_audio(audio, audio)
-
-            # If nothing is happening, it is okay to sleep for a while
-            # and take some pressure of the CPU. But not too long, if
-            # the buffers run dry, audio and video will go out of sync.
-            else:
-                time.sleep(.001)
+            x = np.linspace(last_phase,
+                            last_phase +
+                            frequency*2*np.pi/videostream.fps,
+                            int(44100 / videostream.fps) + 1)
+            last_phase = x[-1]
+            audio = np.sin(x[:-1])
+            videostream.send_audio(audio, audio)
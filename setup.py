@@ -43,8 +43,11 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Natural Language :: English",
         "Operating System :: POSIX :: Linux",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.4",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
         "Topic :: Communications :: Chat :: Internet Relay Chat",
         "Topic :: Multimedia :: Video"
         ],
@@ -56,6 +59,7 @@ setup(
     packages=find_packages(),
     include_package_data=False,
     zip_safe=False,
+    python_requires='>=3.7',
     install_requires=install_requires,
     extras_require={
         'testing': tests_require,
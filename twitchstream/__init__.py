@@ -4,4 +4,22 @@
 Tools interface with Twitch using python, concretely, interfacing with
 the chat and video streams.
 """
+import importlib
+
 __version__ = "1.0.2c"
+
+# The modules are only imported when they are used, so a bot which only
+# uses the chat does not wait for numpy
+SUBMODULES = ('asyncstream', 'chat', 'ingest', 'manager', 'matroska',
+              'outputvideo', 'overlay', 'recorder', 'renderpool')
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module '%s' has no attribute '%s'"
+                         % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(SUBMODULES))
@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains an output stream for asyncio applications. Frames
+and audio are sent by awaiting coroutines, the stream is paced by a
+task on the event loop and the pipes to ffmpeg are written without
+blocking, so many streams can be fed from one thread.
+"""
+from __future__ import print_function, division
+import asyncio
+import os
+import signal
+import subprocess
+from time import monotonic
+
+import numpy as np
+
+from .outputvideo import AUDIORATE, CATCHUP_POLICIES, TwitchOutputStream
+
+
+class AsyncTwitchOutputStream(TwitchOutputStream):
+    """
+    An output stream for asyncio applications. Start it with start(), or
+    use it as an asynchronous context manager:
+
+        async with AsyncTwitchOutputStream(...) as stream:
+            await stream.send_video_frame(frame)
+
+    Like TwitchBufferedOutputStream, the stream keeps a steady framerate
+    by buffering frames and audio, which a task on the event loop writes
+    to ffmpeg every frame time. Every frame time, one frame and the audio
+    samples of that frame time are sent. When a buffer runs dry, the last
+    frame is shown again or silence is played.
+
+    send_video_frame() and send_audio() wait while their buffer is full.
+    The buffers are emptied only as fast as ffmpeg reads from its pipes,
+    so a stalling ffmpeg holds the senders back.
+
+    The stream takes the arguments of TwitchOutputStream, except for
+    auto_recover and vfr, and:
+
+    :param video_buffer_size: the maximum number of buffered video
+        frames, 0 for no limit
+    :type video_buffer_size: int
+    :param audio_buffer_size: the maximum number of buffered audio
+        fragments, 0 for no limit
+    :type audio_buffer_size: int
+    :param catchup: what to do when streaming falls behind, 'burst'
+        (stream the buffered frames back to back until caught up) or
+        'skip' (drop the missed frame times)
+    :type catchup: String
+
+    time_to_first_frame counts from the call to start().
+    """
+    def __init__(self, *args, **kwargs):
+        self.video_buffer_size = kwargs.pop('video_buffer_size', 30)
+        self.audio_buffer_size = kwargs.pop('audio_buffer_size', 30)
+        self.catchup = kwargs.pop('catchup', 'burst')
+        if self.catchup not in CATCHUP_POLICIES[:2]:
+            raise ValueError("Unknown catch-up policy '%s', use one of %s"
+                             % (self.catchup,
+                                ", ".join(CATCHUP_POLICIES[:2])))
+        if kwargs.get('auto_recover') or kwargs.get('vfr'):
+            raise ValueError("AsyncTwitchOutputStream can not recover "
+                             "automatically or stream in vfr mode")
+        super(AsyncTwitchOutputStream, self).__init__(*args, **kwargs)
+        self.q_video = None
+        self.q_audio = None
+        self.ticks = 0
+        self.audio_samples_sent = 0
+        self._last_frame_data = None
+        self._audio_fragment = b''
+        self._pacing = None
+        self._progress = None
+        self._stopped = False
+
+    def reset(self):
+        """
+        The ffmpeg process is started by start(), on the event loop.
+        """
+        pass
+
+    async def start(self):
+        """
+        Start ffmpeg and start streaming.
+        Raises an OSError when ffmpeg can not be started.
+        """
+        self._start_time = monotonic()
+        loop = asyncio.get_event_loop()
+        # calibrating the encoder and looking up the ingest server may
+        # take a while, keep the event loop running meanwhile
+        await loop.run_in_executor(
+            None, self.encoder_profile.prepare, self.ffmpeg_binary,
+            self.width, self.height, self.fps)
+        audio_fds = ()
+        if self.audio_enabled:
+            audio_read_fd, audio_write_fd = os.pipe()
+            audio_fds = (audio_read_fd, )
+        try:
+            command = await loop.run_in_executor(
+                None, self._ffmpeg_command,
+                audio_fds[0] if self.audio_enabled else None)
+            self.ffmpeg_process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=None if self.verbose else subprocess.DEVNULL,
+                pass_fds=audio_fds)
+        except BaseException:
+            if self.audio_enabled:
+                os.close(audio_write_fd)
+            raise
+        finally:
+            for fd in audio_fds:
+                os.close(fd)
+        if self.audio_enabled:
+            os.set_blocking(audio_write_fd, False)
+            self.audio_pipe = audio_write_fd
+
+        self.q_video = asyncio.Queue(self.video_buffer_size)
+        self.q_audio = asyncio.Queue(self.audio_buffer_size)
+        self._last_frame_data = self._frame_bytes(np.ones(self.frame_shape))
+        self._progress = asyncio.ensure_future(self._read_progress_async())
+        self._pacing = asyncio.ensure_future(self._pace())
+
+    async def _read_progress_async(self):
+        """
+        Read the progress reports of ffmpeg until it exits, see
+        _read_progress().
+        """
+        report = {}
+        previous = None
+        stdout = self.ffmpeg_process.stdout
+        while True:
+            line = await stdout.readline()
+            if not line:
+                return
+            key, _, value = line.decode('utf-8', 'replace').partition('=')
+            report[key.strip()] = value
+            if key.strip() == 'progress':
+                previous = self._update_encoder_stats(
+                    self._parse_progress(report), previous)
+                report = {}
+
+    async def _write_audio_pipe(self, data):
+        """
+        Write all of the data to the audio pipe, waiting on the event
+        loop while the pipe is full.
+        """
+        loop = asyncio.get_event_loop()
+        view = memoryview(data).cast('B')
+        while len(view):
+            try:
+                view = view[os.write(self.audio_pipe, view):]
+                continue
+            except BlockingIOError:
+                pass
+            writable = loop.create_future()
+            loop.add_writer(self.audio_pipe, writable.set_result, None)
+            try:
+                await writable
+            finally:
+                loop.remove_writer(self.audio_pipe)
+
+    def _pull_audio(self, count):
+        """
+        Take the bytes of count samples out of the audio buffer, padded
+        with silence when the buffer runs dry.
+        """
+        needed = count * 4  # two channels of 16 bit samples
+        pieces = []
+        while needed > 0:
+            if not self._audio_fragment:
+                try:
+                    self._audio_fragment = self.q_audio.get_nowait()
+                except asyncio.QueueEmpty:
+                    pieces.append(bytes(needed))
+                    break
+            pieces.append(self._audio_fragment[:needed])
+            self._audio_fragment = self._audio_fragment[needed:]
+            needed -= len(pieces[-1])
+        return b''.join(pieces)
+
+    async def _pace(self):
+        """
+        Send a frame and its audio every frame time, until the stream is
+        closed or ffmpeg stops.
+        """
+        loop = asyncio.get_event_loop()
+        period = 1. / self.fps
+        deadline = loop.time()
+        try:
+            while True:
+                try:
+                    self._last_frame_data = self.q_video.get_nowait()
+                except asyncio.QueueEmpty:
+                    pass    # show the last frame again
+                self.ticks += 1
+                self.ffmpeg_process.stdin.write(
+                    memoryview(self._last_frame_data).cast('B'))
+                if self.time_to_first_frame is None:
+                    self.time_to_first_frame = \
+                        monotonic() - self._start_time
+                if self.audio_enabled:
+                    count = int(round(self.ticks * AUDIORATE / self.fps)) - \
+                        self.audio_samples_sent
+                    await self._write_audio_pipe(self._pull_audio(count))
+                    self.audio_samples_sent += count
+                # wait for ffmpeg when it falls behind reading its input
+                await self.ffmpeg_process.stdin.drain()
+
+                deadline += period
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif self.catchup == 'skip' and -delay > period:
+                    deadline += (-delay // period) * period
+        except (OSError, RuntimeError):
+            # ffmpeg has stopped
+            pass
+        finally:
+            self._stopped = True
+            # wake up the senders waiting for room in the buffers, they
+            # will find out the stream has stopped
+            for buffer in (self.q_video, self.q_audio):
+                while not buffer.empty():
+                    buffer.get_nowait()
+
+    def _check_running(self):
+        if self._pacing is None:
+            raise RuntimeError("The stream has not been started")
+        if self._stopped:
+            raise OSError("The stream has stopped")
+
+    async def send_video_frame(self, frame, version=None):
+        """Add a frame of shape (height, width, channels) to the stream,
+        waiting while the buffer is full. The frame is converted right
+        away, so it can be changed as soon as this returns.
+        Raises an OSError when the stream has stopped.
+
+        :param frame: array containing the frame.
+        :type frame: numpy array with shape (height, width, channels)
+            containing uint8 values or floats between 0.0 and 1.0
+        :param version: token for the content of the frame, see
+            TwitchOutputStream.send_video_frame
+        :type version: any hashable value
+        """
+        self._check_running()
+        self._check_frame_shape(frame)
+        data = self._frame_bytes(frame, version)
+        if np.may_share_memory(data, frame):
+            # uint8 frames are passed as they are, keep a copy
+            data = data.copy()
+        await self.q_video.put(data)
+
+    async def send_audio(self, left_channel, right_channel):
+        """Add audio samples to the stream, waiting while the buffer is
+        full. The left and the right channel should have the same shape.
+        Raises an OSError when the stream has stopped.
+
+        :param left_channel: array containing the audio signal.
+        :type left_channel: numpy array with shape (k, )
+            containing values between -1.0 and 1.0 or int16 samples.
+            k can be any integer
+        :param right_channel: array containing the audio signal.
+        :type right_channel: numpy array with shape (k, )
+            containing values between -1.0 and 1.0 or int16 samples.
+            k can be any integer
+        """
+        self._check_running()
+        samples = self._interleave_audio(left_channel, right_channel)
+        data = samples.tobytes()
+        self._recycle_audio(samples)
+        await self.q_audio.put(data)
+
+    def get_video_frame_buffer_state(self):
+        """Find out how many video frames are left in the buffer.
+
+        :return: integer number of video frames left.
+        """
+        return self.q_video.qsize()
+
+    def get_audio_buffer_state(self):
+        """Find out how many audio fragments are left in the buffer.
+
+        :return: integer number of audio fragments left.
+        """
+        return self.q_audio.qsize()
+
+    async def close(self):
+        """
+        Stop streaming and let ffmpeg finish the stream.
+        """
+        if self._pacing is not None:
+            self._pacing.cancel()
+            await asyncio.gather(self._pacing, return_exceptions=True)
+        process = self.ffmpeg_process
+        if process is None:
+            return
+        if self.audio_pipe is not None:
+            os.close(self.audio_pipe)
+            self.audio_pipe = None
+        # sigint so ffmpeg can clean up the stream nicely
+        try:
+            process.send_signal(signal.SIGINT)
+        except ProcessLookupError:
+            pass
+        process.stdin.close()
+        await process.wait()
+        if self._progress is not None:
+            await self._progress
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
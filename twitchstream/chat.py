@@ -29,6 +29,8 @@ class TwitchChatStream(object):
     :param verbose: show all stream messages on stdout (for debugging)
     :type verbose: boolean
     """
+    # records the messages received, see SessionRecorder
+    recorder = None
 
     def __init__(self, username, oauth, verbose=False):
         """Create a new stream object, and try to connect."""
@@ -268,4 +270,6 @@ class TwitchChatStream(object):
                 rec = [self._parse_message(line)
                        for line in filter(None, msg.split('\r\n'))]
                 rec = [r for r in rec if r]     # remove Nones
+                if self.recorder is not None:
+                    self.recorder.record_chat_messages(rec)
                 result.extend(rec)
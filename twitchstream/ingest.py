@@ -0,0 +1,270 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the code used to find the Twitch ingest server to
+stream to. The list of ingest servers is cached on disk, and the server
+with the fastest connection is remembered, so (re)starting a stream does
+not have to wait for the Twitch API.
+"""
+from __future__ import print_function, division
+import json
+import os
+import socket
+import threading
+import time
+from time import monotonic
+from urllib.parse import urlparse
+
+INGEST_API_URL = 'https://ingest.twitch.tv/api/v2/ingests'
+
+# The port of an RTMP server, when its URL does not mention one
+RTMP_PORT = 1935
+
+
+def api_source(url=INGEST_API_URL, timeout=10.):
+    """
+    Create an ingest source which asks the Twitch API for the ingest
+    servers.
+
+    :param url: the URL of the ingest API
+    :type url: String
+    :param timeout: maximum number of seconds to wait for the API
+    :type timeout: float
+    :return: a function returning the list of ingest servers, as dicts
+        with at least the keys 'name' and 'url_template'
+    """
+    def source():
+        # only import requests when the API is asked, importing it takes
+        # a while
+        import requests
+        return requests.get(url=url, timeout=timeout).json()['ingests']
+    return source
+
+
+def file_source(path):
+    """
+    Create an ingest source which reads the ingest servers from a JSON
+    file, in the format of the Twitch API.
+
+    :param path: the JSON file
+    :type path: String
+    :return: a function returning the list of ingest servers
+    """
+    def source():
+        with open(path) as f:
+            return json.load(f)['ingests']
+    return source
+
+
+def default_cache_file(name='ingests.json'):
+    """
+    :param name: the name of the cache file
+    :type name: String
+    :return: the file in which the ingest servers, or anything else,
+        are cached by default
+    """
+    cache_dir = os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'),
+                                            '.cache'))
+    return os.path.join(cache_dir, 'twitchstream', name)
+
+
+def load_cache(cache_file):
+    """
+    Read a JSON cache file.
+
+    :param cache_file: the cache file, None for no cache
+    :type cache_file: String
+    :return: the content of the cache, None when it can not be read
+    """
+    if cache_file is None or not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_cache(cache_file, cache):
+    """
+    Write a JSON cache file. Failing to write it is ignored, without a
+    cache the next run just has to do the work again.
+
+    :param cache_file: the cache file, None for no cache
+    :type cache_file: String
+    :param cache: the content of the cache
+    :type cache: dict
+    """
+    if cache_file is None:
+        return
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # write atomically, other processes may be reading the cache
+        temp_file = '%s.%d' % (cache_file, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(cache, f)
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError):
+        pass
+
+
+class IngestSelector(object):
+    """
+    Selects the ingest server to stream to. The ingest servers are
+    cached on disk. The first few of them (the API lists the closest
+    ones first) are probed in parallel for their connection latency, and
+    the fastest one is remembered in the cache as well.
+
+    As long as the cache is fresh, selecting a server does not touch the
+    network. When the cache has expired, the cached server is used while
+    the cache is refreshed in the background. Only when there is no cache
+    at all, the first selection waits for the source.
+
+    Selecting servers is thread safe, so one selector can be shared by
+    many streams.
+
+    :param source: function returning the list of ingest servers, by
+        default the Twitch API (see api_source and file_source)
+    :type source: callable
+    :param cache_file: the file to cache the servers in, None to keep
+        them in memory only
+    :type cache_file: String
+    :param ttl: number of seconds the cache stays fresh
+    :type ttl: float
+    :param probe_count: number of servers to probe, 0 to use the first
+        server without probing
+    :type probe_count: int
+    :param probe_timeout: maximum number of seconds to wait for a server
+        to accept a connection
+    :type probe_timeout: float
+    """
+    def __init__(self,
+                 source=None,
+                 cache_file=default_cache_file(),
+                 ttl=24 * 3600.,
+                 probe_count=8,
+                 probe_timeout=1.):
+        if source is None:
+            source = api_source()
+        self.source = source
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.probe_count = probe_count
+        self.probe_timeout = probe_timeout
+        self.cache = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def _load_cache(self):
+        cache = load_cache(self.cache_file)
+        if not isinstance(cache, dict) or not all(
+                key in cache for key in ('fetched', 'ingests', 'fastest')):
+            return None
+        return cache
+
+    def _save_cache(self, cache):
+        save_cache(self.cache_file, cache)
+
+    def refresh(self):
+        """
+        Fetch the ingest servers from the source, probe them and store
+        the result in the cache.
+
+        :return: the new cache, a dict with the keys 'fetched' (a unix
+            timestamp), 'ingests' and 'fastest' (the selected ingest)
+        """
+        ingests = self.source()
+        fastest = ingests[0]
+        latencies = self.probe(ingests[:self.probe_count])
+        reachable = [(latency, i) for i, latency in enumerate(latencies)
+                     if latency is not None]
+        if reachable:
+            fastest = ingests[min(reachable)[1]]
+        cache = {
+            'fetched': time.time(),
+            'ingests': ingests,
+            'fastest': fastest,
+        }
+        with self._lock:
+            self.cache = cache
+        self._save_cache(cache)
+        return cache
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            pass    # keep using the expired cache
+        finally:
+            self._refreshing = False
+
+    def probe(self, ingests):
+        """
+        Measure how long each server takes to accept a connection, all
+        in parallel.
+
+        :param ingests: the ingest servers to probe
+        :type ingests: list of dicts
+        :return: list with the latency of every server in seconds, None
+            for servers which could not be reached
+        """
+        latencies = [None] * len(ingests)
+
+        def probe_one(i):
+            url = urlparse(ingests[i]['url_template'])
+            start_time = monotonic()
+            try:
+                connection = socket.create_connection(
+                    (url.hostname, url.port or RTMP_PORT),
+                    timeout=self.probe_timeout)
+            except (socket.error, ValueError):
+                return
+            latencies[i] = monotonic() - start_time
+            connection.close()
+
+        threads = [threading.Thread(target=probe_one, args=(i, ))
+                   for i in range(len(ingests))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies
+
+    def get_closest_ingest(self):
+        """
+        Select the ingest server to stream to.
+
+        :return: dict describing the ingest server, with at least the
+            keys 'name' and 'url_template'
+        """
+        with self._lock:
+            if self.cache is None:
+                self.cache = self._load_cache()
+            cache = self.cache
+            expired = cache is not None and \
+                time.time() - cache['fetched'] > self.ttl
+            if expired and not self._refreshing:
+                self._refreshing = True
+                thread = threading.Thread(target=self._refresh_in_background)
+                thread.daemon = True
+                thread.start()
+        if cache is None:
+            cache = self.refresh()
+        return cache['fastest']
+
+    def get_url(self, stream_key):
+        """
+        Select the ingest server to stream to, and fill in the stream
+        key.
+
+        :param stream_key: the Twitch stream key
+        :type stream_key: String
+        :return: String, the RTMP URL to stream to
+        """
+        return self.get_closest_ingest()['url_template'].format(
+            stream_key=stream_key)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the code to host many streams in one process. The
+streams share one pacer thread and one cache of ingest servers, and each
+of them gets a fixed share of the machine.
+"""
+from __future__ import print_function, division
+import multiprocessing
+import threading
+
+from .ingest import IngestSelector
+from .outputvideo import EncoderProfile, Pacer, TwitchBufferedOutputStream
+
+
+class StreamManager(object):
+    """
+    Host many streams in one process. All streams are paced by a single
+    thread and select their ingest server from a single cache. Every
+    stream gets the same budget: a number of x264 threads and bounded
+    buffers, so a machine can be packed with streams without them
+    competing for the cores or the memory.
+
+    Use add_stream() to start a stream, and get_health() to keep an eye
+    on all of them at once.
+
+    :param max_streams: the maximum number of streams, None for no
+        limit. When given, the cores are divided over this many streams.
+    :type max_streams: int
+    :param encoder_threads: the number of x264 threads of every stream,
+        by default the number of cores divided by max_streams, or 1
+    :type encoder_threads: int
+    :param video_buffer_size: the maximum number of buffered video
+        frames of every buffered stream, 0 for no limit
+    :type video_buffer_size: int
+    :param audio_buffer_size: the maximum number of buffered audio
+        fragments of every buffered stream, 0 for no limit
+    :type audio_buffer_size: int
+    :param frame_pool_size: the number of preallocated frames of every
+        buffered stream (see TwitchBufferedOutputStream.acquire_frame)
+    :type frame_pool_size: int
+    :param ingest_selector: selects the Twitch ingest server for all
+        streams, by default an IngestSelector caching the servers in the
+        user's cache dir
+    :type ingest_selector: IngestSelector
+    """
+    def __init__(self,
+                 max_streams=None,
+                 encoder_threads=None,
+                 video_buffer_size=30,
+                 audio_buffer_size=30,
+                 frame_pool_size=8,
+                 ingest_selector=None):
+        self.max_streams = max_streams
+        if encoder_threads is None:
+            encoder_threads = 1
+            if max_streams:
+                encoder_threads = max(
+                    1, multiprocessing.cpu_count() // max_streams)
+        self.encoder_threads = encoder_threads
+        self.video_buffer_size = video_buffer_size
+        self.audio_buffer_size = audio_buffer_size
+        self.frame_pool_size = frame_pool_size
+        if ingest_selector is None:
+            ingest_selector = IngestSelector()
+        self.ingest_selector = ingest_selector
+        self.pacer = Pacer()
+        self.streams = {}
+        self._lock = threading.Lock()
+
+    def add_stream(self, name, stream_class=TwitchBufferedOutputStream,
+                   **kwargs):
+        """
+        Start a stream. The keyword arguments are passed on to the
+        stream, and override the budget of the manager.
+        Raises a ValueError when the name is in use or when the
+        manager hosts max_streams streams already.
+
+        :param name: the name to refer to the stream by
+        :type name: String
+        :param stream_class: the class of the stream, a subclass of
+            TwitchOutputStreamRepeater or TwitchBufferedOutputStream
+        :type stream_class: class
+        :return: the stream
+        """
+        with self._lock:
+            if name in self.streams:
+                raise ValueError("There is a stream named '%s' already"
+                                 % name)
+            if self.max_streams is not None and \
+                    len(self.streams) >= self.max_streams:
+                raise ValueError("The manager hosts %d streams already"
+                                 % self.max_streams)
+            # keep the name, while the stream is starting
+            self.streams[name] = None
+        kwargs.setdefault('pacer', self.pacer)
+        kwargs.setdefault('ingest_selector', self.ingest_selector)
+        kwargs.setdefault('encoder_profile',
+                          EncoderProfile(threads=self.encoder_threads))
+        if issubclass(stream_class, TwitchBufferedOutputStream):
+            kwargs.setdefault('video_buffer_size', self.video_buffer_size)
+            kwargs.setdefault('audio_buffer_size', self.audio_buffer_size)
+            kwargs.setdefault('frame_pool_size', self.frame_pool_size)
+        try:
+            stream = stream_class(**kwargs)
+        except BaseException:
+            with self._lock:
+                del self.streams[name]
+            raise
+        with self._lock:
+            self.streams[name] = stream
+        return stream
+
+    def remove_stream(self, name):
+        """
+        Stop a stream and forget about it.
+        Raises a KeyError when there is no stream with this name.
+
+        :param name: the name of the stream
+        :type name: String
+        """
+        with self._lock:
+            stream = self.streams[name]
+            if stream is None:
+                raise KeyError(name)
+            del self.streams[name]
+        stream.__exit__(None, None, None)
+
+    def get_stream(self, name):
+        """
+        :param name: the name of the stream
+        :type name: String
+        :return: the stream with this name
+        """
+        stream = self.streams.get(name)
+        if stream is None:
+            raise KeyError(name)
+        return stream
+
+    def _get_streams(self):
+        with self._lock:
+            return [(name, stream)
+                    for name, stream in sorted(self.streams.items())
+                    if stream is not None]
+
+    @staticmethod
+    def _get_stream_stats(stream):
+        """
+        Collect the statistics of a single stream.
+        """
+        stats = {
+            'running': stream.ffmpeg_process.poll() is None,
+            'recoveries': stream.recoveries,
+            'encoder': stream.get_encoder_stats(),
+            'pipes': stream.get_pipe_stats(),
+            'video_buffer': None,
+            'audio_buffer': None,
+            'av_drift': None,
+        }
+        if isinstance(stream, TwitchBufferedOutputStream):
+            stats['video_buffer'] = stream.get_video_frame_buffer_state()
+            if stream.audio_enabled:
+                stats['audio_buffer'] = stream.get_audio_buffer_state()
+                stats['av_drift'] = stream.get_av_drift()
+        return stats
+
+    def get_stats(self):
+        """
+        Collect the statistics of every stream.
+
+        :return: dict from the name of every stream to a dict with the
+            keys 'running' (whether ffmpeg is running), 'recoveries'
+            (see auto_recover), 'encoder' (see get_encoder_stats),
+            'pipes' (see get_pipe_stats), 'video_buffer',
+            'audio_buffer' (the number of buffered frames and fragments)
+            and 'av_drift' (see get_av_drift). Values which do not apply
+            to a stream are None.
+        """
+        return dict((name, self._get_stream_stats(stream))
+                    for name, stream in self._get_streams())
+
+    def get_health(self):
+        """
+        Summarize the health of all streams.
+
+        :return: dict with the keys 'streams' (the number of streams),
+            'running' (the number of streams with a running ffmpeg),
+            'stopped' (the names of the other streams), 'recoveries'
+            (the restarts of ffmpeg over all streams), 'slowest' (the
+            name of the stream encoding the slowest, None when no stream
+            has reported its speed yet), 'min_speed' (its speed, 1.0 is
+            realtime), 'buffered_frames' and 'buffered_fragments' (the
+            number of frames and audio fragments in all buffers)
+        """
+        stats = self.get_stats()
+        speeds = [(stream_stats['encoder']['speed'], name)
+                  for name, stream_stats in stats.items()
+                  if stream_stats['encoder'].get('speed') is not None]
+        min_speed, slowest = min(speeds) if speeds else (None, None)
+        return {
+            'streams': len(stats),
+            'running': sum(1 for stream_stats in stats.values()
+                           if stream_stats['running']),
+            'stopped': sorted(name for name, stream_stats in stats.items()
+                              if not stream_stats['running']),
+            'recoveries': sum(stream_stats['recoveries']
+                              for stream_stats in stats.values()),
+            'slowest': slowest,
+            'min_speed': min_speed,
+            'buffered_frames': sum(stream_stats['video_buffer'] or 0
+                                   for stream_stats in stats.values()),
+            'buffered_fragments': sum(stream_stats['audio_buffer'] or 0
+                                      for stream_stats in stats.values()),
+        }
+
+    def close(self):
+        """
+        Stop all streams and the pacer.
+        """
+        for name, _ in self._get_streams():
+            self.remove_stream(name)
+        self.pacer.stop()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
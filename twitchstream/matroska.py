@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a minimal Matroska writer, which wraps raw frames
+with their timestamps, so ffmpeg can be fed a variable frame rate. Only
+what is needed for a single track of uncompressed video is written: the
+headers once, and every frame in a cluster of its own.
+"""
+from __future__ import division
+import struct
+
+# The FourCC of the pixel format of uncompressed video, which ffmpeg
+# reads from the ColourSpace element
+FOURCC = {
+    'rgb24': b'RGB\x18',
+    'bgr24': b'BGR\x18',
+    'rgba': b'RGBA',
+    'bgra': b'BGRA',
+    'gray': b'Y800',
+    'yuv420p': b'I420',
+}
+
+# Element IDs, with their marker bits
+EBML = b'\x1a\x45\xdf\xa3'
+EBML_VERSION = b'\x42\x86'
+EBML_READ_VERSION = b'\x42\xf7'
+EBML_MAX_ID_LENGTH = b'\x42\xf2'
+EBML_MAX_SIZE_LENGTH = b'\x42\xf3'
+DOC_TYPE = b'\x42\x82'
+DOC_TYPE_VERSION = b'\x42\x87'
+DOC_TYPE_READ_VERSION = b'\x42\x85'
+SEGMENT = b'\x18\x53\x80\x67'
+INFO = b'\x15\x49\xa9\x66'
+TIMECODE_SCALE = b'\x2a\xd7\xb1'
+MUXING_APP = b'\x4d\x80'
+WRITING_APP = b'\x57\x41'
+TRACKS = b'\x16\x54\xae\x6b'
+TRACK_ENTRY = b'\xae'
+TRACK_NUMBER = b'\xd7'
+TRACK_UID = b'\x73\xc5'
+TRACK_TYPE = b'\x83'
+FLAG_LACING = b'\x9c'
+CODEC_ID = b'\x86'
+VIDEO = b'\xe0'
+PIXEL_WIDTH = b'\xb0'
+PIXEL_HEIGHT = b'\xba'
+COLOUR_SPACE = b'\x2e\xb5\x24'
+CLUSTER = b'\x1f\x43\xb6\x75'
+TIMECODE = b'\xe7'
+SIMPLE_BLOCK = b'\xa3'
+
+# The size of an element which is still being written, a live stream
+UNKNOWN_SIZE = b'\x01\xff\xff\xff\xff\xff\xff\xff'
+
+# Timestamps are in milliseconds
+TIMECODE_SCALE_NS = 1000000
+
+
+def encode_size(size):
+    """
+    Encode the size of an element, always in eight bytes.
+
+    :param size: the size in bytes
+    :type size: int
+    :return: bytes
+    """
+    return b'\x01' + struct.pack('>Q', size)[1:]
+
+
+def element(element_id, data):
+    """
+    Encode an element.
+
+    :param element_id: the ID of the element
+    :type element_id: bytes
+    :param data: the content of the element
+    :type data: bytes
+    :return: bytes
+    """
+    return element_id + encode_size(len(data)) + data
+
+
+def uint_element(element_id, value):
+    """
+    Encode an element holding an unsigned integer.
+    """
+    data = struct.pack('>Q', value).lstrip(b'\x00') or b'\x00'
+    return element(element_id, data)
+
+
+def header(width, height, pix_fmt):
+    """
+    Encode the start of a live Matroska stream with a single track of
+    uncompressed video.
+
+    :param width: the width of the video (in pixels)
+    :type width: int
+    :param height: the height of the video (in pixels)
+    :type height: int
+    :param pix_fmt: the pixel format of the frames, see FOURCC
+    :type pix_fmt: String
+    :return: bytes
+    """
+    ebml = element(EBML, b''.join([
+        uint_element(EBML_VERSION, 1),
+        uint_element(EBML_READ_VERSION, 1),
+        uint_element(EBML_MAX_ID_LENGTH, 4),
+        uint_element(EBML_MAX_SIZE_LENGTH, 8),
+        element(DOC_TYPE, b'matroska'),
+        uint_element(DOC_TYPE_VERSION, 4),
+        uint_element(DOC_TYPE_READ_VERSION, 2),
+    ]))
+    info = element(INFO, b''.join([
+        uint_element(TIMECODE_SCALE, TIMECODE_SCALE_NS),
+        element(MUXING_APP, b'twitchstream'),
+        element(WRITING_APP, b'twitchstream'),
+    ]))
+    tracks = element(TRACKS, element(TRACK_ENTRY, b''.join([
+        uint_element(TRACK_NUMBER, 1),
+        uint_element(TRACK_UID, 1),
+        uint_element(TRACK_TYPE, 1),    # video
+        uint_element(FLAG_LACING, 0),
+        element(CODEC_ID, b'V_UNCOMPRESSED'),
+        element(VIDEO, b''.join([
+            uint_element(PIXEL_WIDTH, width),
+            uint_element(PIXEL_HEIGHT, height),
+            element(COLOUR_SPACE, FOURCC[pix_fmt]),
+        ])),
+    ])))
+    return ebml + SEGMENT + UNKNOWN_SIZE + info + tracks
+
+
+def frame_header(timestamp, size):
+    """
+    Encode the start of a cluster holding a single frame. The frame
+    itself should be written right after it.
+
+    :param timestamp: the timestamp of the frame, in milliseconds
+    :type timestamp: int
+    :param size: the size of the frame in bytes
+    :type size: int
+    :return: bytes
+    """
+    # track number 1, relative timestamp 0 and the keyframe flag
+    block_header = b'\x81\x00\x00\x80'
+    block = SIMPLE_BLOCK + encode_size(len(block_header) + size) + \
+        block_header
+    timecode = uint_element(TIMECODE, timestamp)
+    return CLUSTER + encode_size(len(timecode) + len(block) + size) + \
+        timecode + block
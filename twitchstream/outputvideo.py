@@ -10,17 +10,1489 @@ import subprocess
 import signal
 import threading
 import sys
-try:
-    import Queue as queue
-except ImportError:
-    import queue
+import queue
 import time
 import os
-
-import requests
+import heapq
+import itertools
+import multiprocessing
+import fcntl
+import functools
+import select
+import shutil
+import traceback
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from . import matroska
+from .ingest import IngestSelector, default_cache_file, load_cache, \
+    save_cache
 
 AUDIORATE = 44100
 
+# Raw pixel formats accepted on the video pipe, with their number of
+# channels. Frames in these formats are handed to ffmpeg as they are.
+PIX_FMT_CHANNELS = {
+    'rgb24': 3,
+    'bgr24': 3,    # OpenCV's channel order
+    'rgba': 4,
+    'bgra': 4,
+    'gray': 1,
+}
+
+
+# What a Pacer does when a task has fallen more than one period behind:
+# 'burst' calls the task back to back until it has caught up,
+# 'skip' drops the missed deadlines and carries on from the next one,
+# 'duplicate' calls the task with repeat=True for every missed deadline.
+CATCHUP_POLICIES = ('burst', 'skip', 'duplicate')
+
+
+class _PacerTask(object):
+    """
+    A periodic task scheduled on a Pacer.
+    """
+    def __init__(self, callback, catchup, deadline):
+        self.callback = callback
+        self.catchup = catchup
+        self.deadline = deadline
+        self.active = True
+        # how many seconds after its deadline the task was last called
+        self.lateness = 0.
+
+
+class Pacer(object):
+    """
+    Calls periodic tasks from a single long-lived thread. Deadlines are
+    absolute times on a monotonic clock, so small delays in calling a
+    task never add up to drift.
+
+    A task is a callable taking one boolean argument, repeat, and
+    returning the number of seconds until it should be called again,
+    or None when it should not be called anymore. repeat is True only
+    when the task is called to fill a missed deadline under the
+    'duplicate' catch-up policy. A task which raises an exception is
+    not called anymore, the other tasks carry on. While a task is being
+    called, it is the current_task of the pacer.
+
+    :param catchup: what to do when a task falls more than one period
+        behind, one of 'burst', 'skip' or 'duplicate'
+    :type catchup: String
+    """
+    def __init__(self, catchup='burst'):
+        if catchup not in CATCHUP_POLICIES:
+            raise ValueError("Unknown catch-up policy '%s', use one of %s"
+                             % (catchup, ", ".join(CATCHUP_POLICIES)))
+        self.catchup = catchup
+        self._tasks = []    # heap of (deadline, sequence number, task)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._running = True
+        self.current_task = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_task(self, callback, delay=0.0, catchup=None):
+        """
+        Schedule a periodic task.
+
+        :param callback: the task, see the class documentation
+        :type callback: callable
+        :param delay: number of seconds until the first call
+        :type delay: float
+        :param catchup: catch-up policy for this task, defaults to the
+            policy of the pacer
+        :type catchup: String
+        :return: the task, which can be passed to remove_task()
+        """
+        catchup = catchup or self.catchup
+        if catchup not in CATCHUP_POLICIES:
+            raise ValueError("Unknown catch-up policy '%s', use one of %s"
+                             % (catchup, ", ".join(CATCHUP_POLICIES)))
+        task = _PacerTask(callback, catchup, monotonic() + delay)
+        self._schedule(task)
+        return task
+
+    def remove_task(self, task):
+        """
+        Stop calling a task. A call which is in progress is finished.
+
+        :param task: a task returned by add_task()
+        """
+        task.active = False
+
+    def stop(self):
+        """
+        Stop the pacer thread. No tasks will be called anymore.
+        """
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def _schedule(self, task):
+        with self._condition:
+            heapq.heappush(self._tasks,
+                           (task.deadline, next(self._sequence), task))
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._tasks:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                deadline, _, task = self._tasks[0]
+                delay = deadline - monotonic()
+                if delay > 0:
+                    # wake up early when a task is added
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._tasks)
+            if not task.active:
+                continue
+            try:
+                if self._call(task):
+                    self._schedule(task)
+            except Exception:
+                # don't take the other tasks down with this one
+                traceback.print_exc()
+
+    def _call(self, task):
+        """
+        Call a task which is due, and move its deadline forward.
+
+        :return: True when the task should be called again
+        """
+        task.lateness = monotonic() - task.deadline
+        self.current_task = task
+        period = task.callback(False)
+        if period is None:
+            return False
+        task.deadline += period
+        behind = monotonic() - task.deadline
+        if period <= 0 or behind <= period:
+            return True
+        missed = int(behind // period)
+        if task.catchup == 'skip':
+            task.deadline += missed * period
+        elif task.catchup == 'duplicate':
+            for _ in range(missed):
+                period = task.callback(True)
+                if period is None:
+                    return False
+                task.deadline += period
+        # 'burst': the task is due again, it will be called right away
+        return True
+
+
+# What a full FrameBuffer does with a new frame:
+# 'block' waits until the pacer has made room,
+# 'drop_oldest' discards the oldest buffered frame to make room,
+# 'drop_newest' discards the new frame,
+# 'merge' merges the new frame into the newest buffered frame.
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_newest', 'merge')
+
+# What happened to a frame added to a FrameBuffer
+BUFFER_QUEUED = 'queued'
+BUFFER_DROPPED_OLDEST = 'dropped_oldest'
+BUFFER_DROPPED_NEWEST = 'dropped_newest'
+BUFFER_MERGED = 'merged'
+
+
+class FrameBuffer(object):
+    """
+    A thread safe buffer of frames or audio fragments, which are taken
+    out ordered by their frame counter. The buffer can be bounded, in
+    which case the overflow policy decides what happens to frames added
+    to a full buffer.
+
+    :param maxsize: the maximum number of buffered items, 0 for no limit
+    :type maxsize: int
+    :param overflow: the overflow policy, one of 'block', 'drop_oldest',
+        'drop_newest' or 'merge'
+    :type overflow: String
+    :param merge: function merging a new item into the newest buffered
+        item and returning the result, used by the 'merge' policy. By
+        default, the new item replaces the buffered one.
+    :type merge: callable
+    :param on_discard: function called with every item which is dropped
+        or replaced, to recycle it
+    :type on_discard: callable
+    """
+    def __init__(self, maxsize=0, overflow='block', merge=None,
+                 on_discard=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy '%s', use one of %s"
+                             % (overflow, ", ".join(OVERFLOW_POLICIES)))
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.merge = merge
+        self.on_discard = on_discard
+        self._heap = []     # heap of (frame counter, sequence, item)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def put(self, counter, item, timeout=None):
+        """
+        Add an item to the buffer.
+        Raises a queue.Full when the buffer blocks and stays full for
+        longer than the timeout.
+
+        :param counter: the position of the item within the stream
+        :type counter: int
+        :param item: the frame or audio fragment
+        :param timeout: maximum number of seconds to block, or None to
+            wait as long as needed
+        :type timeout: float
+        :return: one of BUFFER_QUEUED, BUFFER_DROPPED_OLDEST,
+            BUFFER_DROPPED_NEWEST or BUFFER_MERGED
+        """
+        discarded = []
+        with self._condition:
+            status = BUFFER_QUEUED
+            if self.maxsize > 0 and len(self._heap) >= self.maxsize:
+                if self.overflow == 'block':
+                    self._wait_for_room(timeout)
+                elif self.overflow == 'drop_oldest':
+                    discarded.append(heapq.heappop(self._heap)[2])
+                    status = BUFFER_DROPPED_OLDEST
+                elif self.overflow == 'drop_newest':
+                    discarded.append(item)
+                    status = BUFFER_DROPPED_NEWEST
+                else:
+                    discarded.extend(self._merge_newest(counter, item))
+                    status = BUFFER_MERGED
+            if status in (BUFFER_QUEUED, BUFFER_DROPPED_OLDEST):
+                heapq.heappush(self._heap,
+                               (counter, next(self._sequence), item))
+        if self.on_discard is not None:
+            for discarded_item in discarded:
+                self.on_discard(discarded_item)
+        return status
+
+    def _wait_for_room(self, timeout):
+        if timeout is None:
+            while len(self._heap) >= self.maxsize:
+                self._condition.wait()
+        else:
+            end_time = monotonic() + timeout
+            while len(self._heap) >= self.maxsize:
+                remaining = end_time - monotonic()
+                if remaining <= 0:
+                    raise queue.Full
+                self._condition.wait(remaining)
+
+    def _merge_newest(self, counter, item):
+        """
+        Merge an item into the newest buffered item. The newest item is
+        the largest one in the heap, so it is a leaf and raising its
+        counter keeps the heap intact.
+
+        :return: list of the items which were replaced
+        """
+        newest = max(range(len(self._heap)), key=lambda i: self._heap[i])
+        old_counter, sequence, old_item = self._heap[newest]
+        if self.merge is None:
+            merged = item
+        else:
+            merged = self.merge(old_item, item)
+        self._heap[newest] = (max(counter, old_counter), sequence, merged)
+        return [old_item] if merged is not old_item else []
+
+    def get_nowait(self):
+        """
+        Take the item with the lowest frame counter out of the buffer.
+        Raises a queue.Empty when the buffer is empty.
+
+        :return: tuple (frame counter, item)
+        """
+        with self._condition:
+            if not self._heap:
+                raise queue.Empty
+            counter, _, item = heapq.heappop(self._heap)
+            self._condition.notify()
+        return counter, item
+
+    def qsize(self):
+        """
+        Find out how many items are in the buffer.
+
+        :return: integer number of items
+        """
+        with self._condition:
+            return len(self._heap)
+
+    def get_items(self):
+        """
+        :return: list of the items in the buffer, in no particular order
+        """
+        with self._condition:
+            return [item for _, _, item in self._heap]
+
+
+# The stages of the pipeline timed by an instrumented stream:
+# 'enqueue' the time taken to add a frame to the buffer, 'dequeue' the
+# time a frame spent in the buffer, 'convert' and 'write' the time taken
+# to convert a frame and to write it to ffmpeg, 'video_tick' and
+# 'audio_tick' how late the pacer called the stream, after its deadline,
+# 'stall' the time a write to ffmpeg waited for room in the pipe.
+TIMING_STAGES = ('enqueue', 'dequeue', 'convert', 'write',
+                 'video_tick', 'audio_tick', 'stall')
+
+
+class TimingHistogram(object):
+    """
+    Keeps the most recent durations of a stage of the pipeline, to find
+    out where the time goes when a stream stutters.
+
+    Recording is thread safe.
+
+    :param size: the number of durations to keep
+    :type size: int
+    """
+    def __init__(self, size=1000):
+        self._durations = deque(maxlen=size)
+        self.total_count = 0
+
+    def record(self, duration):
+        """
+        Add a duration.
+
+        :param duration: the duration, in seconds
+        :type duration: float
+        """
+        self._durations.append(duration)
+        self.total_count += 1
+
+    def get_durations(self):
+        """
+        :return: numpy array with the recent durations, in seconds
+        """
+        return np.array(self._durations)
+
+    def histogram(self, bins=10):
+        """
+        Count the recent durations per bin.
+
+        :param bins: the number of bins, or the edges of the bins in
+            seconds
+        :type bins: int or list of floats
+        :return: (counts, edges), see numpy.histogram
+        """
+        return np.histogram(self.get_durations(), bins=bins)
+
+    def summary(self):
+        """
+        Summarize the recent durations.
+
+        :return: dict with the keys 'count', 'mean', 'median', 'p99' and
+            'max', in seconds. Without durations, the values are None and
+            the count is 0.
+        """
+        durations = self.get_durations()
+        if not len(durations):
+            return {'count': 0, 'mean': None, 'median': None, 'p99': None,
+                    'max': None}
+        return {
+            'count': len(durations),
+            'mean': float(durations.mean()),
+            'median': float(np.median(durations)),
+            'p99': float(np.percentile(durations, 99)),
+            'max': float(durations.max()),
+        }
+
+
+# How TwitchBufferedOutputStream corrects drift between audio and video:
+# 'audio' pads the audio with silence or drops audio samples,
+# 'video' shows a frame again or skips a frame,
+# None only measures the drift.
+AV_SYNC_POLICIES = ('audio', 'video', None)
+
+
+class FramePool(object):
+    """
+    A fixed pool of preallocated uint8 frames. Frames are handed out with
+    acquire() and handed back with release(), so frames can be rendered
+    and streamed without allocating new memory for every frame.
+
+    Acquiring and releasing frames is thread safe.
+
+    :param shape: the shape of a single frame
+    :type shape: tuple
+    :param size: the number of frames in the pool
+    :type size: int
+    :param shared: allocate the frames in shared memory, so processes
+        started by the multiprocessing module can render into them
+        (see RenderPool). The memory is available as the buffer
+        attribute.
+    :type shared: boolean
+    """
+    def __init__(self, shape, size, shared=False):
+        self.shape = shape
+        self.shared = shared
+        self.buffer = None
+        if shared:
+            self.buffer = multiprocessing.RawArray(
+                'B', size * int(np.prod(shape)))
+            frames = np.frombuffer(self.buffer, dtype=np.uint8)
+            self.frames = list(frames.reshape((size, ) + tuple(shape)))
+        else:
+            self.frames = [np.empty(shape, dtype=np.uint8)
+                           for _ in range(size)]
+        self._index = dict((id(frame), i)
+                           for i, frame in enumerate(self.frames))
+        self._free = list(range(size))
+        self._lock = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Take a free frame from the pool, waiting until one is released
+        when all of them are in use.
+        Raises a queue.Empty when no frame came free within the timeout.
+
+        :param timeout: maximum number of seconds to wait, or None to
+            wait as long as needed
+        :type timeout: float
+        :return: numpy array of dtype uint8
+        """
+        with self._lock:
+            if timeout is None:
+                while not self._free:
+                    self._lock.wait()
+            else:
+                end_time = monotonic() + timeout
+                while not self._free:
+                    remaining = end_time - monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._lock.wait(remaining)
+            return self.frames[self._free.pop()]
+
+    def release(self, frame):
+        """
+        Give a frame back to the pool. Arrays which do not belong to
+        the pool and frames which are already free are ignored.
+
+        :param frame: the frame to give back
+        :type frame: numpy array
+        """
+        index = self._index.get(id(frame))
+        if index is None or self.frames[index] is not frame:
+            return
+        with self._lock:
+            if index not in self._free:
+                self._free.append(index)
+                self._lock.notify()
+
+    def owns(self, frame):
+        """
+        Check whether a frame belongs to this pool.
+
+        :param frame: the frame to check
+        :type frame: numpy array
+        :return: True when the frame is one of the frames of the pool
+        """
+        return self.index(frame) is not None
+
+    def index(self, frame):
+        """
+        Find the position of a frame in the pool.
+
+        :param frame: the frame to look up
+        :type frame: numpy array
+        :return: the index of the frame in the frames attribute, None
+            when the frame does not belong to the pool
+        """
+        index = self._index.get(id(frame))
+        if index is None or self.frames[index] is not frame:
+            return None
+        return index
+
+    def get_free_count(self):
+        """
+        Find out how many frames of the pool are not in use.
+
+        :return: integer number of free frames
+        """
+        with self._lock:
+            return len(self._free)
+
+
+class FrameCache(object):
+    """
+    A small LRU cache of frames converted to the bytes which are sent to
+    ffmpeg, so a frame which is streamed over and over is only converted
+    once. Frames are looked up by the identity of their array and a
+    version token, which should change whenever the content of the array
+    changes. The cache holds on to the arrays, so their identity cannot
+    be taken over by another array while they are cached.
+
+    Looking up and adding frames is thread safe.
+
+    :param maxsize: the maximum number of frames in the cache
+    :type maxsize: int
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, frame, version):
+        """
+        Look up the converted frame.
+
+        :param frame: the frame as it was given to the stream
+        :type frame: numpy array
+        :param version: the version token of the content of the frame
+        :type version: any hashable value
+        :return: the converted frame, or None when it is not cached
+        """
+        key = (id(frame), version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] is not frame:
+                self.misses += 1
+                return None
+            # move it to the end, the most recently used frame
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, frame, version, data):
+        """
+        Add a converted frame, evicting the least recently used frame
+        when the cache is full.
+
+        :param frame: the frame as it was given to the stream
+        :type frame: numpy array
+        :param version: the version token of the content of the frame
+        :type version: any hashable value
+        :param data: the converted frame
+        :type data: numpy array
+        """
+        key = (id(frame), version)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (frame, data)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all frames from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# x264 presets, from the cheapest to the most expensive to encode
+X264_PRESETS = ('ultrafast', 'superfast', 'veryfast', 'faster', 'fast',
+                'medium')
+
+
+class EncoderProfile(object):
+    """
+    The x264 settings used by a TwitchOutputStream.
+
+    In adaptive mode, the first reset() of the stream measures how fast
+    this machine encodes the stream with each preset, and picks the most
+    expensive preset which still encodes faster than realtime by the
+    given headroom. Unless a number of threads is given, the encoder
+    uses one thread per core in adaptive mode, also while measuring.
+    When the speed reported by the encoder (see report_speed) falls
+    below realtime, the profile steps down to a cheaper preset, which is
+    used from the next reset() on.
+
+    :param preset: the x264 preset, see X264_PRESETS. In adaptive mode,
+        this is the most expensive preset which will be considered.
+    :type preset: String
+    :param threads: the number of encoder threads, None to use one per
+        core, 'auto' to use one per core in adaptive mode and 2
+        otherwise
+    :type threads: int or String
+    :param bitrate: the video bitrate (in kbit/s)
+    :type bitrate: int
+    :param keyframe_interval: the time between key frames (in seconds)
+    :type keyframe_interval: float
+    :param adaptive: pick the preset by measuring the encoding speed
+    :type adaptive: boolean
+    :param headroom: in adaptive mode, how many times faster than
+        realtime the chosen preset should encode
+    :type headroom: float
+    :param min_speed: the reported speed below which the encoder is
+        considered to fall behind. A stream fed at realtime never encodes
+        faster than realtime, so this is slightly below 1.0.
+    :type min_speed: float
+    :param cache_file: the file to cache the calibrated presets in, so
+        the next run on this machine, with the same ffmpeg and stream
+        size, starts right away. None to calibrate every run.
+    :type cache_file: String
+    """
+    def __init__(self,
+                 preset='faster',
+                 threads='auto',
+                 bitrate=3000,
+                 keyframe_interval=2.,
+                 adaptive=False,
+                 headroom=1.5,
+                 min_speed=0.95,
+                 cache_file=default_cache_file('encoder.json')):
+        if preset not in X264_PRESETS:
+            raise ValueError("Unknown preset '%s', use one of %s"
+                             % (preset, ", ".join(X264_PRESETS)))
+        self.preset = preset
+        self.max_preset = preset
+        if threads == 'auto':
+            threads = None if adaptive else 2
+        self.threads = threads
+        self.bitrate = bitrate
+        self.keyframe_interval = keyframe_interval
+        self.adaptive = adaptive
+        self.headroom = headroom
+        self.min_speed = min_speed
+        self.cache_file = cache_file
+        self.calibrated = False
+        self.falling_behind = False
+        self.speed = None
+
+    def get_threads(self):
+        """
+        :return: the number of encoder threads to use
+        """
+        if self.threads is None:
+            return multiprocessing.cpu_count()
+        return self.threads
+
+    def x264_args(self, fps):
+        """
+        The ffmpeg arguments which configure the x264 encoder.
+
+        :param fps: the number of frames per second of the videostream
+        :type fps: float
+        :return: list of ffmpeg arguments
+        """
+        return [
+            '-b:v', '%dk' % self.bitrate,
+            '-preset', self.preset, '-tune', 'zerolatency',
+            '-crf', '23',
+            # '-force_key_frames', r'expr:gte(t,n_forced*2)',
+            '-minrate', '%dk' % self.bitrate,
+            '-maxrate', '%dk' % self.bitrate,
+            '-bufsize', '%dk' % (4 * self.bitrate),
+            # key frame distance
+            '-g', '%d' % max(1, round(self.keyframe_interval * fps)),
+            '-keyint_min', '1',
+            '-threads', '%d' % self.get_threads(),
+        ]
+
+    def prepare(self, ffmpeg_binary, width, height, fps):
+        """
+        Called by the stream before (re)starting the encoder. In adaptive
+        mode, this calibrates the profile on its first call, and steps
+        down to a cheaper preset when the encoder was falling behind.
+
+        :param ffmpeg_binary: the binary used to encode the stream
+        :type ffmpeg_binary: String
+        :param width: the width of the videostream (in pixels)
+        :type width: int
+        :param height: the height of the videostream (in pixels)
+        :type height: int
+        :param fps: the number of frames per second of the videostream
+        :type fps: float
+        """
+        if not self.adaptive:
+            return
+        if not self.calibrated:
+            self.calibrate(ffmpeg_binary, width, height, fps)
+        elif self.falling_behind:
+            self.step_down()
+
+    def calibrate(self, ffmpeg_binary, width, height, fps, duration=1.):
+        """
+        Encode a test pattern of the size of the stream with every preset,
+        from the most expensive one down, and keep the first one which is
+        fast enough. When nothing can be measured, the preset is kept.
+
+        :param ffmpeg_binary: the binary used to encode the stream
+        :type ffmpeg_binary: String
+        :param width: the width of the videostream (in pixels)
+        :type width: int
+        :param height: the height of the videostream (in pixels)
+        :type height: int
+        :param fps: the number of frames per second of the videostream
+        :type fps: float
+        :param duration: the length of the test pattern (in seconds)
+        :type duration: float
+        """
+        self.calibrated = True
+        candidates = X264_PRESETS[:X264_PRESETS.index(self.max_preset) + 1]
+        key = self._cache_key(ffmpeg_binary, width, height, fps, duration)
+        cache = load_cache(self.cache_file) if key is not None else None
+        if not isinstance(cache, dict):
+            cache = {}
+        if cache.get(key) in candidates:
+            self.preset = cache[key]
+            return
+        for preset in reversed(candidates):
+            speed = self._measure_speed(ffmpeg_binary, preset, width,
+                                        height, fps, duration)
+            if speed is None:
+                return
+            self.preset = preset
+            if speed >= self.headroom:
+                break
+        if key is not None:
+            cache[key] = self.preset
+            save_cache(self.cache_file, cache)
+
+    def _cache_key(self, ffmpeg_binary, width, height, fps, duration):
+        """
+        :return: the key of a calibration in the cache, which changes
+            with everything the outcome depends on. None when the
+            encoder can not be found.
+        """
+        path = shutil.which(ffmpeg_binary)
+        if path is None:
+            return None
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        return '|'.join(str(value) for value in (
+            path, stat.st_size, stat.st_mtime, width, height, fps,
+            self.max_preset, self.get_threads(), self.headroom, duration,
+            multiprocessing.cpu_count()))
+
+    def _measure_speed(self, ffmpeg_binary, preset, width, height, fps,
+                       duration):
+        """
+        :return: how many times faster than realtime the preset encodes,
+            or None when the encoder could not be run
+        """
+        command = [
+            ffmpeg_binary,
+            '-loglevel', 'error',
+            '-f', 'lavfi',
+            '-i', 'testsrc=size=%dx%d:rate=%d' % (width, height, fps),
+            '-t', '%f' % duration,
+            '-vcodec', 'libx264',
+            '-pix_fmt', 'yuv420p',
+            '-preset', preset, '-tune', 'zerolatency',
+            '-threads', '%d' % self.get_threads(),
+            '-f', 'null', '-',
+        ]
+        start_time = monotonic()
+        try:
+            returncode = subprocess.call(command,
+                                         stdin=subprocess.DEVNULL,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL)
+        except OSError:
+            return None
+        if returncode != 0:
+            return None
+        return duration / max(monotonic() - start_time, 1e-6)
+
+    def report_speed(self, speed):
+        """
+        Report how many times faster than realtime the encoder runs.
+        The reports are smoothed, and when the smoothed speed drops below
+        min_speed the profile is marked as falling behind.
+
+        :param speed: the encoding speed, 1.0 being realtime
+        :type speed: float
+        """
+        if self.speed is None:
+            self.speed = speed
+        else:
+            self.speed = 0.9 * self.speed + 0.1 * speed
+        if self.speed < self.min_speed:
+            self.falling_behind = True
+
+    def step_down(self):
+        """
+        Switch to the next cheaper preset, if there is one.
+        """
+        index = X264_PRESETS.index(self.preset)
+        if index > 0:
+            self.preset = X264_PRESETS[index - 1]
+        self.falling_behind = False
+        self.speed = None
+
+
+# Container formats of destinations, guessed from their URL scheme or
+# file extension
+OUTPUT_FORMATS = {
+    'rtmp': 'flv',
+    'rtmps': 'flv',
+    'udp': 'mpegts',
+    'tcp': 'mpegts',
+    'srt': 'mpegts',
+    '.flv': 'flv',
+    '.mkv': 'matroska',
+    '.ts': 'mpegts',
+    '.mp4': 'mp4',
+}
+
+
+def output_format(destination):
+    """
+    Guess the container format of a destination from its URL scheme or
+    file extension. 'null' is ffmpeg's null sink, which discards the
+    stream.
+
+    :param destination: URL or file name
+    :type destination: String
+    :return: String, the name of the ffmpeg muxer
+    """
+    if destination == 'null':
+        return 'null'
+    scheme = destination.split('://', 1)[0] if '://' in destination \
+        else None
+    if scheme in OUTPUT_FORMATS:
+        return OUTPUT_FORMATS[scheme]
+    extension = os.path.splitext(destination)[1].lower()
+    if extension in OUTPUT_FORMATS:
+        return OUTPUT_FORMATS[extension]
+    raise ValueError("Cannot guess the format of '%s', pass a tuple "
+                     "(destination, format) instead" % destination)
+
+
+def output_args(destinations):
+    """
+    The ffmpeg arguments which write one encoded stream to one or more
+    destinations. Several destinations are served from a single encode
+    through ffmpeg's tee muxer. When a destination other than the first
+    one fails, the others carry on.
+
+    :param destinations: the destinations, each either a URL, a file
+        name, 'null', or a tuple (destination, format)
+    :type destinations: list
+    :return: list of ffmpeg arguments
+    """
+    destinations = [
+        destination if isinstance(destination, tuple)
+        else (destination, output_format(destination))
+        for destination in destinations]
+    if len(destinations) == 1:
+        destination, fmt = destinations[0]
+        if fmt == 'null':
+            destination = '-'
+        return ['-f', fmt, destination]
+
+    slaves = []
+    for i, (destination, fmt) in enumerate(destinations):
+        options = 'f=%s' % fmt
+        if i > 0:
+            options += ':onfail=ignore'
+        if fmt == 'null':
+            destination = '-'
+        for special in '\\|[]\'':
+            destination = destination.replace(special, '\\' + special)
+        slaves.append('[%s]%s' % (options, destination))
+    return [
+        # headers of the encoded streams for muxers which need them
+        '-flags', '+global_header',
+        '-f', 'tee', '|'.join(slaves),
+    ]
+
+
+# Luma coefficients (Kr, Kb) of the YUV color matrices, and the value of
+# ffmpeg's -colorspace option for them
+YUV_MATRICES = {
+    'bt601': ((0.299, 0.114), 'smpte170m'),
+    'bt709': ((0.2126, 0.0722), 'bt709'),
+}
+
+
+# The number of rows converted to yuv420p at once, so the intermediate
+# values stay in the CPU cache
+YUV_BAND_ROWS = 32
+
+# the threads converting bands of frames to yuv420p, shared by all
+# conversions and started when first needed
+_yuv_workers = None
+_yuv_workers_lock = threading.Lock()
+
+
+def _get_yuv_workers():
+    """
+    :return: the ThreadPoolExecutor converting bands to yuv420p
+    """
+    global _yuv_workers
+    with _yuv_workers_lock:
+        if _yuv_workers is None:
+            _yuv_workers = ThreadPoolExecutor(
+                max_workers=multiprocessing.cpu_count())
+        return _yuv_workers
+
+
+def rgb_to_yuv420p(frame, matrix='bt601', bgr=False, workers=None):
+    """
+    Convert an RGB frame to planar YUV 4:2:0 in limited (TV) range, the
+    yuv420p pixel format of ffmpeg. The chroma of every 2x2 block of
+    pixels is computed from the average color of the block.
+
+    The frame is converted a band of rows at a time. This takes about
+    14ms for a 1080p frame on one core. The bands are spread over worker
+    threads, which numpy lets run on all cores, so the conversion keeps
+    up with 1080p60 on the thread sending the frames.
+
+    :param frame: the frame, with an even width and height
+    :type frame: numpy array with shape (height, width, 3 or 4)
+        containing uint8 values or floats between 0.0 and 1.0. A fourth
+        (alpha) channel is ignored.
+    :param matrix: the color matrix, 'bt601' or 'bt709'
+    :type matrix: String
+    :param bgr: whether the channels are in BGR(A) order
+    :type bgr: boolean
+    :param workers: the number of threads converting the frame, by
+        default one per core. With 1, the frame is converted on the
+        calling thread only.
+    :type workers: int
+    :return: numpy array of dtype uint8 with height * width * 3 / 2
+        values: the Y plane, followed by the U and the V plane
+    """
+    height, width = frame.shape[:2]
+    (kr, kb), _ = YUV_MATRICES[matrix]
+    kg = 1. - kr - kb
+    scale = 1. / 255 if frame.dtype == np.uint8 else 1.
+    rgb = frame[:, :, 2::-1] if bgr else frame[:, :, :3]
+    weights = np.array([
+        # Y, U, V from R, G, B in [0, 1], without the offsets
+        [219. * kr, 219. * kg, 219. * kb],
+        [-112. * kr / (1. - kb), -112. * kg / (1. - kb), 112.],
+        [112., -112. * kg / (1. - kr), -112. * kb / (1. - kr)],
+    ], dtype=np.float32) * scale
+
+    yuv = np.empty(height * width * 3 // 2, dtype=np.uint8)
+    y_plane = yuv[:height * width].reshape((height, width))
+    u_plane = yuv[height * width:height * width * 5 // 4].reshape(
+        (height // 2, width // 2))
+    v_plane = yuv[height * width * 5 // 4:].reshape(
+        (height // 2, width // 2))
+
+    def convert(start, stop):
+        for top in range(start, stop, YUV_BAND_ROWS):
+            rows = slice(top, min(top + YUV_BAND_ROWS, stop))
+            chroma_rows = slice(rows.start // 2, rows.stop // 2)
+            band = rgb[rows].astype(np.float32)
+            if frame.dtype != np.uint8:
+                # out of range colors would wrap around, uint8 ones can't
+                np.clip(band, 0., 1., out=band)
+            luma = np.matmul(band, weights[0])
+            luma += 16.5    # offset, and round when truncating
+            y_plane[rows] = luma
+
+            # sum every 2x2 block, and average in the weights
+            blocks = band[0::2] + band[1::2]
+            blocks = blocks[:, 0::2] + blocks[:, 1::2]
+            for plane, plane_weights in ((u_plane, weights[1]),
+                                         (v_plane, weights[2])):
+                chroma = np.matmul(blocks, plane_weights / 4.)
+                chroma += 128.5
+                plane[chroma_rows] = chroma
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    # every worker gets whole bands
+    bands = -(-height // YUV_BAND_ROWS)
+    chunk = -(-bands // max(1, min(workers, bands))) * YUV_BAND_ROWS
+    starts = list(range(0, height, chunk))
+    futures = [_get_yuv_workers().submit(convert, start,
+                                         min(start + chunk, height))
+               for start in starts[1:]]
+    # the calling thread converts the first chunk itself
+    convert(0, min(chunk, height))
+    for future in futures:
+        future.result()
+    return yuv
+
+
+# The number of frames the pipe to ffmpeg should be able to hold, and
+# the seconds of audio of the audio pipe. The OS may allow less.
+PIPE_FRAMES = 4
+PIPE_AUDIO = 0.5
+
+# fcntl command to resize a pipe, missing from fcntl before Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
+
+def set_pipe_size(fd, size):
+    """
+    Enlarge the buffer of a pipe, as far as the OS allows. Only Linux
+    can resize pipes, elsewhere the pipe is left as it is.
+
+    :param fd: a file descriptor of the pipe
+    :type fd: int
+    :param size: the size of the buffer in bytes
+    :type size: int
+    :return: the new size of the buffer, None when it was not changed
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        with open('/proc/sys/fs/pipe-max-size') as f:
+            size = min(size, int(f.read()))
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except (IOError, OSError):
+        return None
+
+
+# A part of a file, which a PipeWriter writes to the pipe with sendfile,
+# without reading the data into python
+FileRegion = namedtuple('FileRegion', ['fd', 'offset', 'size'])
+
+# Whether the kernel can copy from a file to a pipe with sendfile
+SENDFILE_TO_PIPE = hasattr(os, 'sendfile') and \
+    sys.platform.startswith('linux')
+
+
+class FrameFile(object):
+    """
+    Pre-rendered frames in a file, mapped into memory instead of loaded.
+    The file is either a .npy file of uint8 frames, as saved by
+    numpy.save, or a raw file of frames back to back. The frames should
+    be in the pixel format of the pipe of the stream playing them (see
+    TwitchBufferedOutputStream.play_file), they are written to ffmpeg as
+    they are.
+
+    Raises a ValueError when the file does not hold whole uint8 frames.
+
+    :param path: the file
+    :type path: String
+    :param frame_nbytes: the size of a frame in a raw file, e.g.
+        width * height * 3 for rgb24 frames. Not needed for .npy files.
+    :type frame_nbytes: int
+    """
+    def __init__(self, path, frame_nbytes=None):
+        self.path = path
+        if path.endswith('.npy'):
+            frames = np.load(path, mmap_mode='r')
+            if frames.dtype != np.uint8 or frames.ndim < 2 or \
+                    not frames.flags.c_contiguous:
+                raise ValueError("%s should hold C ordered uint8 frames, "
+                                 "not %s %s" % (path, frames.dtype,
+                                                frames.shape))
+            self.offset = frames.offset
+            self.frame_nbytes = frames[0].nbytes
+            self.frames = frames.reshape((len(frames), -1))
+        else:
+            if not frame_nbytes:
+                raise ValueError("The size of the frames in %s is needed"
+                                 % path)
+            frames = np.memmap(path, dtype=np.uint8, mode='r')
+            if len(frames) % frame_nbytes:
+                raise ValueError("%s does not hold whole frames of %d "
+                                 "bytes" % (path, frame_nbytes))
+            self.offset = 0
+            self.frame_nbytes = frame_nbytes
+            self.frames = frames.reshape((-1, frame_nbytes))
+        if not len(self.frames):
+            raise ValueError("%s holds no frames" % path)
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get_frame(self, index):
+        """
+        :return: the bytes of a frame, a view on the mapped file
+        """
+        return self.frames[index]
+
+    def get_pipe_data(self, index):
+        """
+        The data of a frame to hand to a PipeWriter. Where the kernel can
+        copy from a file to a pipe, this is the region of the file with
+        the frame, otherwise it is a view on the mapped file. Either way,
+        the frame is never copied in python.
+
+        :return: FileRegion or numpy array
+        """
+        if SENDFILE_TO_PIPE:
+            return FileRegion(self.fd,
+                              self.offset + index * self.frame_nbytes,
+                              self.frame_nbytes)
+        return self.frames[index]
+
+    def close(self):
+        """
+        Close the file. Streams playing the file should stop first.
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class PipeWriter(object):
+    """
+    Writes to a pipe of ffmpeg on a thread of its own, so whoever sends
+    the data does not wait while ffmpeg is busy. Writes are done in the
+    order they are added, every write in as few system calls as possible
+    by writing all of its buffers at once (scatter/gather). Regions of
+    a file are copied to the pipe by the kernel, with sendfile. Every
+    pipe should get a writer of its own: ffmpeg does not read from one pipe
+    while it waits for data on another, e.g. while starting up.
+
+    The time writes spend waiting for ffmpeg to empty a full pipe is
+    measured as the stall time, which shows how far a slow encoder holds
+    the stream back.
+
+    When a write fails, the writes waiting behind it are dropped and the
+    error is raised by the next call of write() or flush(). With
+    keep_failed, the failed write and the writes behind it are kept
+    instead, as if the writer was suspended, see suspend().
+
+    :param max_backlog: the number of bytes which may wait to be
+        written, before write() waits for room. A single write may be
+        larger.
+    :type max_backlog: int
+    :param stall_histogram: records the stall time of every write
+    :type stall_histogram: TimingHistogram
+    :param keep_failed: keep the writes when a write fails, so they can
+        be resumed to another pipe
+    :type keep_failed: boolean
+    """
+    def __init__(self, max_backlog, stall_histogram=None,
+                 keep_failed=False):
+        self.max_backlog = max_backlog
+        self.stall_histogram = stall_histogram
+        self.keep_failed = keep_failed
+        self.stall_time = 0.
+        self.bytes_written = 0
+        # (fd, buffers, number of bytes, callback) tuples
+        self._queue = deque()
+        self._backlog = 0
+        self._writing = False
+        self._error = None
+        # increased by cancel() and suspend(), which abort the write in
+        # progress
+        self._generation = 0
+        # the writes kept while suspended, None when not suspended
+        self._kept = None
+        self._closed = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def write(self, fd, buffers, callback=None):
+        """
+        Add a write, waiting while the backlog is full. The buffers
+        should not be changed until they have been written. While the
+        writer is suspended, the write is kept until it is resumed.
+        Raises the error, usually an OSError, of a write which failed
+        before.
+
+        :param fd: the file descriptor to write to, None to only call
+            the callback
+        :type fd: int
+        :param buffers: the data to write
+        :type buffers: list of bytes, contiguous arrays or FileRegions
+        :param callback: function called once the data is written or
+            dropped
+        :type callback: callable
+        """
+        views = [buffer if isinstance(buffer, FileRegion)
+                 else memoryview(buffer).cast('B') for buffer in buffers]
+        nbytes = sum(_buffer_size(view) for view in views)
+        with self._condition:
+            self._raise_error()
+            while self._backlog and \
+                    self._backlog + nbytes > self.max_backlog:
+                self._condition.wait()
+                self._raise_error()
+            self._backlog += nbytes
+            if self._kept is not None:
+                self._kept.append((fd, views, nbytes, callback))
+                return
+            self._queue.append((fd, views, nbytes, callback))
+            self._start()
+
+    def call_after_writes(self, callback):
+        """
+        Call a function once the writes added so far are done.
+
+        :param callback: the function
+        :type callback: callable
+        """
+        with self._condition:
+            if self._kept is not None:
+                self._kept.append((None, [], 0, callback))
+                return
+            if self._queue or self._writing:
+                self._queue.append((None, [], 0, callback))
+                self._condition.notify_all()
+                return
+        callback()
+
+    def flush(self, timeout=None):
+        """
+        Wait until all writes are done, except for the writes which are
+        kept while the writer is suspended.
+        Raises the error, usually an OSError, of a write which failed.
+
+        :param timeout: maximum number of seconds to wait, or None to
+            wait as long as needed
+        :type timeout: float
+        :return: True when all writes are done, False on a timeout
+        """
+        end_time = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            while self._queue or self._writing:
+                if end_time is None:
+                    self._condition.wait()
+                else:
+                    remaining = end_time - monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+            self._raise_error()
+        return True
+
+    def cancel(self):
+        """
+        Drop the writes which are waiting or kept, abort the write in
+        progress and forget about errors.
+        """
+        with self._condition:
+            self._generation += 1
+            dropped = self._drop_queue()
+            if self._kept is not None:
+                dropped = self._kept + dropped
+                self._backlog -= sum(item[2] for item in self._kept)
+                self._kept = None
+            self._error = None
+            while self._writing:
+                self._condition.wait()
+        self._call_back(dropped)
+
+    def suspend(self):
+        """
+        Stop writing, e.g. while ffmpeg is restarted, and forget about
+        errors. The write in progress is aborted and kept, along with
+        the writes which are waiting and the writes added until the
+        writer is resumed.
+        """
+        with self._condition:
+            if self._kept is None:
+                self._kept = []
+            self._generation += 1
+            self._error = None
+            while self._writing:
+                self._condition.wait()
+            # the aborted write has been kept by the writer thread, the
+            # writes which were waiting follow it
+            self._kept.extend(self._queue)
+            self._queue.clear()
+
+    def resume(self, fd):
+        """
+        Write the kept writes to another file descriptor, and go on
+        writing.
+
+        :param fd: the file descriptor to write the kept writes to
+        :type fd: int
+        """
+        with self._condition:
+            kept, self._kept = self._kept or [], None
+            self._queue.extendleft(
+                (fd if item_fd is not None else None, views, nbytes,
+                 callback)
+                for item_fd, views, nbytes, callback in reversed(kept))
+            if self._queue:
+                self._start()
+
+    def close(self):
+        """
+        Drop the writes which are waiting and stop the thread.
+        """
+        self.cancel()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def get_stats(self):
+        """
+        :return: dict with the keys 'stall_time' (the seconds writes
+            waited for room in the pipe), 'bytes_written' and 'backlog'
+            (the bytes waiting to be written)
+        """
+        with self._condition:
+            return {
+                'stall_time': self.stall_time,
+                'bytes_written': self.bytes_written,
+                'backlog': self._backlog,
+            }
+
+    def _start(self):
+        """
+        Let the writer thread know there is something to write, with the
+        condition held.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+        self._condition.notify_all()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _drop_queue(self):
+        """
+        Empty the queue, with the condition held.
+
+        :return: the items which were dropped
+        """
+        dropped = list(self._queue)
+        self._queue.clear()
+        self._backlog -= sum(item[2] for item in dropped)
+        self._condition.notify_all()
+        return dropped
+
+    @staticmethod
+    def _call_back(items):
+        for _, _, _, callback in items:
+            if callback is not None:
+                try:
+                    callback()
+                except Exception:
+                    # don't take the other writes down with this one
+                    traceback.print_exc()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                item = self._queue.popleft()
+                generation = self._generation
+                self._writing = True
+            fd, views, nbytes, callback = item
+            error = None
+            stall = 0.
+            try:
+                if fd is not None:
+                    stall = self._write_all(fd, views, generation)
+            except Exception as e:
+                # whatever went wrong, it is raised by the next write()
+                # or flush(), and the writer goes on
+                error = e
+            finally:
+                with self._condition:
+                    self._writing = False
+                    written = error is None and stall is not None
+                    done = [item]
+                    if generation == self._generation:
+                        if written:
+                            self.bytes_written += nbytes
+                            self.stall_time += stall
+                        elif self.keep_failed:
+                            self._error = error
+                            self._kept = done + list(self._queue)
+                            self._queue.clear()
+                            done = []
+                        else:
+                            self._error = error
+                            done.extend(self._drop_queue())
+                    elif self._kept is not None and not written:
+                        # suspended, written again once resumed
+                        self._kept.insert(0, item)
+                        done = []
+                    if done:
+                        self._backlog -= nbytes
+                    self._condition.notify_all()
+            if fd is not None and written and \
+                    self.stall_histogram is not None:
+                self.stall_histogram.record(stall)
+            self._call_back(done)
+
+    def _write_all(self, fd, views, generation):
+        """
+        Write all buffers, waiting while the pipe is full.
+
+        :return: the number of seconds spent waiting, None when the
+            write was aborted
+        """
+        os.set_blocking(fd, False)
+        # unlike select, poll takes file descriptors above 1024
+        poller = select.poll()
+        poller.register(fd, select.POLLOUT)
+        stall = 0.
+        views = [view for view in views if _buffer_size(view)]
+        while views:
+            try:
+                if isinstance(views[0], FileRegion):
+                    region = views[0]
+                    written = os.sendfile(fd, region.fd, region.offset,
+                                          region.size)
+                    if not written:
+                        raise OSError("%d bytes of the file are missing"
+                                      % region.size)
+                else:
+                    # gather the buffers up to the next file region
+                    count = 1
+                    while count < len(views) and \
+                            not isinstance(views[count], FileRegion):
+                        count += 1
+                    written = os.writev(fd, views[:count])
+            except BlockingIOError:
+                # the pipe is full, wait until ffmpeg reads from it
+                start_time = monotonic()
+                poller.poll(100)
+                stall += monotonic() - start_time
+                if generation != self._generation:
+                    return None     # cancelled or suspended
+                continue
+            while written:
+                size = _buffer_size(views[0])
+                if written >= size:
+                    written -= size
+                    views.pop(0)
+                else:
+                    views[0] = _skip_bytes(views[0], written)
+                    written = 0
+        return stall
+
+
+def _buffer_size(buffer):
+    """
+    :return: the number of bytes of a memoryview or a FileRegion
+    """
+    if isinstance(buffer, FileRegion):
+        return buffer.size
+    return len(buffer)
+
+
+def _skip_bytes(buffer, count):
+    """
+    :return: the rest of a memoryview or a FileRegion, after count bytes
+    """
+    if isinstance(buffer, FileRegion):
+        return buffer._replace(offset=buffer.offset + count,
+                               size=buffer.size - count)
+    return buffer[count:]
+
 
 class TwitchOutputStream(object):
     """
@@ -42,7 +1514,80 @@ class TwitchOutputStream(object):
     :type ffmpeg_binary: String
     :param verbose: show ffmpeg output in stdout
     :type verbose: boolean
+    :param pix_fmt: the pixel format of the frames you will send, one of
+        'rgb24', 'bgr24', 'rgba', 'bgra' or 'gray'
+    :type pix_fmt: String
+    :param encoder_profile: the x264 settings, by default a non-adaptive
+        EncoderProfile
+    :type encoder_profile: EncoderProfile
+    :param outputs: where to send the stream, a list of destinations
+        which are all served from the same encode. A destination is
+        'twitch' for the closest Twitch ingest server, a file name, a
+        URL, 'null' to discard the stream, or a tuple (destination,
+        format) to set the container format explicitly. Without a
+        'twitch' destination, no stream key is needed.
+    :type outputs: list
+    :param ingest_selector: selects the Twitch ingest server, by default
+        an IngestSelector caching the servers in the user's cache dir
+    :type ingest_selector: IngestSelector
+    :param yuv_matrix: convert the frames to yuv420p before sending them
+        to ffmpeg, with the 'bt601' or 'bt709' color matrix. This halves
+        the bytes going through the pipe and spares ffmpeg the conversion.
+        Only for RGB and BGR(A) pixel formats, and an even width and
+        height. The conversion is done in python when the frame is sent,
+        spread over the cores by the worker threads of rgb_to_yuv420p.
+        It takes about 15ms of CPU time for a 1080p frame, while ffmpeg
+        converts uint8 frames much faster. Use it when the pipe, not the
+        CPU, holds the stream back.
+    :type yuv_matrix: String
+    :param auto_recover: restart ffmpeg when it stops, and send the frame
+        or audio which failed to the new process, along with the writes
+        which were still waiting for the previous process. Frames which
+        were still buffered follow as usual. When ffmpeg stops again
+        within recover_interval seconds, the OSError is raised as before.
+        The repeating and buffered streams restart ffmpeg on a thread of
+        its own, so a shared pacer keeps on streaming the other streams.
+        Until the new process runs, their ticks send nothing and the
+        last frame stays up.
+    :type auto_recover: boolean
+    :param recover_interval: minimum number of seconds between two
+        restarts by auto_recover
+    :type recover_interval: float
+    :param frame_cache_size: the number of converted frames to keep for
+        frames which are sent with a version (see send_video_frame), 0
+        to convert every frame again
+    :type frame_cache_size: int
+    :param timing_window: time the stages of the pipeline (see
+        TIMING_STAGES) and keep this many of the most recent timings of
+        every stage, 0 to not time anything. See get_timings().
+    :type timing_window: int
+    :param vfr: send every frame with its timestamp, and let ffmpeg make
+        a constant frame rate out of them. Frames only have to be sent
+        when they change, see send_video_frame(). Not for the repeating
+        and buffered streams, which keep the frame rate in python.
+    :type vfr: boolean
+    :param keepalive: in vfr mode, send the last frame again when no
+        frame was sent for this many seconds, so ffmpeg keeps on
+        encoding while the video is standing still. None to only send
+        the frames you send.
+    :type keepalive: float
+    :param overlays: text and images which ffmpeg draws on top of the
+        video, see TextOverlay and ImageOverlay. Updating an overlay
+        only writes a small file, which ffmpeg reloads every frame.
+    :type overlays: list
+    :param write_backlog: the seconds of video which may wait to be
+        written to ffmpeg by the writer thread, before sending waits for
+        ffmpeg. Only the repeating and buffered streams let the writer
+        thread write in the background, see get_pipe_stats().
+    :type write_backlog: float
+
+    Once the first frame has been written to ffmpeg, time_to_first_frame
+    holds the number of seconds it took since the stream was created,
+    including starting ffmpeg and finding the ingest server.
     """
+    # whether sending returns before the data has been written to ffmpeg
+    write_async = False
+
     def __init__(self,
                  twitch_stream_key,
                  width=640,
@@ -50,16 +1595,102 @@ class TwitchOutputStream(object):
                  fps=30.,
                  ffmpeg_binary="ffmpeg",
                  enable_audio=False,
-                 verbose=False):
+                 verbose=False,
+                 pix_fmt='rgb24',
+                 encoder_profile=None,
+                 outputs=('twitch', ),
+                 ingest_selector=None,
+                 yuv_matrix=None,
+                 auto_recover=False,
+                 recover_interval=1.,
+                 frame_cache_size=8,
+                 timing_window=0,
+                 vfr=False,
+                 keepalive=1.,
+                 overlays=(),
+                 write_backlog=0.5):
+        self._start_time = monotonic()
+        self.time_to_first_frame = None
+        if pix_fmt not in PIX_FMT_CHANNELS:
+            raise ValueError("Unsupported pixel format '%s', use one of "
+                             "%s" % (pix_fmt,
+                                     ", ".join(sorted(PIX_FMT_CHANNELS))))
         self.twitch_stream_key = twitch_stream_key
         self.width = width
         self.height = height
         self.fps = fps
+        self.pix_fmt = pix_fmt
+        if yuv_matrix is not None and (
+                yuv_matrix not in YUV_MATRICES or pix_fmt == 'gray' or
+                width % 2 or height % 2):
+            raise ValueError("Converting to yuv420p needs the 'bt601' or "
+                             "'bt709' matrix, RGB or BGR(A) frames and an "
+                             "even width and height")
+        self.yuv_matrix = yuv_matrix
+        if PIX_FMT_CHANNELS[pix_fmt] == 1:
+            self.frame_shape = (height, width)
+        else:
+            self.frame_shape = (height, width, PIX_FMT_CHANNELS[pix_fmt])
         self.ffmpeg_process = None
         self.audio_pipe = None
+        # buffers for the interleaved samples, which come back once the
+        # samples have been written
+        self._audio_buffers = deque()
+        self._audio_scaled = None
         self.ffmpeg_binary = ffmpeg_binary
         self.verbose = verbose
         self.audio_enabled = enable_audio
+        if encoder_profile is None:
+            encoder_profile = EncoderProfile()
+        self.encoder_profile = encoder_profile
+        self.outputs = list(outputs)
+        if ingest_selector is None:
+            ingest_selector = IngestSelector()
+        self.ingest_selector = ingest_selector
+        self.auto_recover = auto_recover
+        self.recover_interval = recover_interval
+        self.recoveries = 0
+        self._last_recovery = None
+        # whether ffmpeg is being restarted by the restart thread
+        self._recovering = False
+        self._restart_thread = None
+        self.frame_cache = None
+        if frame_cache_size:
+            self.frame_cache = FrameCache(frame_cache_size)
+        self.timings = None
+        if timing_window:
+            self.timings = dict((stage, TimingHistogram(timing_window))
+                                for stage in TIMING_STAGES)
+        # the number of ticks which were called more than half a frame
+        # time late, when timing
+        self.late_ticks = {'video_tick': 0, 'audio_tick': 0}
+        self.vfr = vfr
+        self.keepalive = keepalive
+        # in vfr mode, frames have to be written in one piece and in the
+        # order of their timestamps
+        self._video_lock = threading.RLock()
+        self._pts_offset = None
+        self._last_timestamp = None
+        self._last_video = None
+        self.overlays = list(overlays)
+        stall_histogram = None
+        if self.timings is not None:
+            stall_histogram = self.timings['stall']
+        # when recovering, the writes which failed are written to the
+        # new process
+        self.video_writer = PipeWriter(
+            max(1, int(round(fps * write_backlog))) *
+            self._pipe_frame_nbytes(),
+            stall_histogram=stall_histogram, keep_failed=auto_recover)
+        # two channels of 16 bit samples
+        self.audio_writer = PipeWriter(
+            max(1, int(write_backlog * AUDIORATE)) * 4,
+            stall_histogram=stall_histogram, keep_failed=auto_recover)
+        self._recover_lock = threading.Lock()
+        self.encoder_stats = {}
+        self.pacer = None
+        self._pacer_tasks = []
+        self._owns_pacer = False
         try:
             self.reset()
         except OSError:
@@ -72,6 +1703,8 @@ class TwitchOutputStream(object):
                 print("> sudo apt-get update && "
                       "sudo apt-get install ffmpeg")
             sys.exit(1)
+        if vfr and keepalive:
+            self._start_pacer(None, [(self._keepalive, 'skip')])
 
     def reset(self):
         """
@@ -84,56 +1717,170 @@ class TwitchOutputStream(object):
                 self.ffmpeg_process.send_signal(signal.SIGINT)
             except OSError:
                 pass
+        # the writes which did not make it to the previous process go
+        # to the new one
+        self.video_writer.suspend()
+        self.audio_writer.suspend()
+        if self.audio_pipe is not None:
+            # the new process gets a new audio pipe
+            try:
+                os.close(self.audio_pipe)
+            except OSError:
+                pass
+            self.audio_pipe = None
+        try:
+            self._start_ffmpeg()
+        except BaseException:
+            # there is no process to write to
+            self.video_writer.cancel()
+            self.audio_writer.cancel()
+            raise
+        if self.vfr:
+            # the timestamps of a new process start from zero, so the
+            # frames of the previous process can't follow
+            self.video_writer.cancel()
+            self._pts_offset = None
+            self._last_timestamp = None
+            header = matroska.header(self.width, self.height,
+                                     self._pipe_pix_fmt())
+            self._write_pipe(self.video_writer, self.ffmpeg_process.stdin,
+                             header)
+        self._resume_writers()
+
+        self.encoder_stats = {}
+        progress_thread = threading.Thread(target=self._read_progress,
+                                           args=(self.ffmpeg_process, ))
+        progress_thread.daemon = True
+        progress_thread.start()
+
+    def _start_ffmpeg(self):
+        """
+        Start a new ffmpeg process, with a new audio pipe.
+        """
+        self.encoder_profile.prepare(self.ffmpeg_binary, self.width,
+                                     self.height, self.fps)
+
+        audio_fds = ()
+        if self.audio_enabled:
+            # every process reads its audio from its own anonymous pipe,
+            # of which it inherits the reading end
+            audio_read_fd, audio_write_fd = os.pipe()
+            audio_fds = (audio_read_fd, )
+        devnullpipe = subprocess.DEVNULL
+        if self.verbose:
+            devnullpipe = None
+        try:
+            command = self._ffmpeg_command(
+                audio_fds[0] if self.audio_enabled else None)
+            self.ffmpeg_process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stderr=devnullpipe,
+                stdout=subprocess.PIPE,
+                pass_fds=audio_fds)
+        except BaseException:
+            if self.audio_enabled:
+                os.close(audio_write_fd)
+            raise
+        finally:
+            for fd in audio_fds:
+                os.close(fd)
+        # room for a few frames, so ffmpeg can fall behind for a moment
+        # without holding the writes up
+        set_pipe_size(self.ffmpeg_process.stdin.fileno(),
+                      PIPE_FRAMES * self._pipe_frame_nbytes())
+        if self.audio_enabled:
+            self.audio_pipe = audio_write_fd
+            set_pipe_size(audio_write_fd, int(PIPE_AUDIO * AUDIORATE) * 4)
+
+    def _ffmpeg_command(self, audio_fd=None):
+        """
+        Build the ffmpeg command line of the stream.
 
+        :param audio_fd: the file descriptor ffmpeg reads the audio from,
+            None when audio is disabled
+        :type audio_fd: int
+        :return: list of command line arguments
+        """
         command = []
         command.extend([
             self.ffmpeg_binary,
             '-loglevel', 'verbose',
+            # machine-readable progress reports on stdout
+            '-nostats', '-progress', 'pipe:1',
             '-y',       # overwrite previous file/stream
             # '-re',    # native frame-rate
             '-analyzeduration', '1',
-            '-f', 'rawvideo',
-            '-r', '%d' % self.fps,  # set a fixed frame rate
-            '-vcodec', 'rawvideo',
-            # size of one frame
-            '-s', '%dx%d' % (self.width, self.height),
-            '-pix_fmt', 'rgb24',  # The input are raw bytes
+        ])
+        if self.vfr:
+            # raw frames with their timestamp, in a matroska stream
+            command.extend(['-f', 'matroska'])
+        else:
+            command.extend([
+                '-f', 'rawvideo',
+                '-r', '%d' % self.fps,  # set a fixed frame rate
+                '-vcodec', 'rawvideo',
+                # size of one frame
+                '-s', '%dx%d' % (self.width, self.height),
+                # The input are raw bytes
+                '-pix_fmt', self._pipe_pix_fmt(),
+            ])
+        command.extend([
             '-thread_queue_size', '1024',
             '-i', '-',  # The input comes from a pipe
 
             # Twitch needs to receive sound in their streams!
             # '-an',            # Tells FFMPEG not to expect any audio
         ])
-        if self.audio_enabled:
+        if audio_fd is not None:
             command.extend([
                 '-ar', '%d' % AUDIORATE,
                 '-ac', '2',
                 '-f', 's16le',
+                # input options only hold for the next input, without
+                # this ffmpeg waits for seconds of audio before it reads
+                # on from the video pipe
+                '-analyzeduration', '1',
                 '-thread_queue_size', '1024',
-                '-i', '/tmp/audiopipe'
+                '-i', 'pipe:%d' % audio_fd
             ])
         else:
             command.extend([
                 '-f', 'lavfi',
                 '-i', 'anullsrc=channel_layout=stereo:sample_rate=44100'
             ])
+        # the overlays which read an input come after the video and the
+        # audio
+        for overlay in self.overlays:
+            command.extend(overlay.input_args(self.fps))
+        video_map = '0:v'
+        if self.overlays:
+            command.extend(['-filter_complex', self._overlay_filter()])
+            video_map = '[vout]'
         command.extend([
             # VIDEO CODEC PARAMETERS
             '-vcodec', 'libx264',
             '-r', '%d' % self.fps,
-            '-b:v', '3000k',
             '-s', '%dx%d' % (self.width, self.height),
-            '-preset', 'faster', '-tune', 'zerolatency',
-            '-crf', '23',
             '-pix_fmt', 'yuv420p',
-            # '-force_key_frames', r'expr:gte(t,n_forced*2)',
-            '-minrate', '3000k', '-maxrate', '3000k',
-            '-bufsize', '12000k',
-            '-g', '60',     # key frame distance
-            '-keyint_min', '1',
             # '-filter:v "setpts=0.25*PTS"'
             # '-vsync','passthrough',
-
+        ])
+        if self.vfr:
+            # repeat the frames up to a constant frame rate
+            command.extend(['-vsync', 'cfr'])
+        if self.yuv_matrix is not None:
+            # tag the color matrix of the frames converted in python
+            colorspace = YUV_MATRICES[self.yuv_matrix][1]
+            command.extend([
+                '-colorspace', colorspace,
+                '-color_primaries', colorspace,
+                '-color_trc', colorspace,
+                '-color_range', 'tv',
+            ])
+        # preset, bitrate, key frames and number of threads
+        command.extend(self.encoder_profile.x264_args(self.fps))
+        command.extend([
             # AUDIO CODEC PARAMETERS
             '-acodec', 'libmp3lame', '-ar', '44100', '-b:a', '160k',
             # '-bufsize', '8192k',
@@ -150,52 +1897,537 @@ class TwitchOutputStream(object):
 
             # MAP THE STREAMS
             # use only video from first input and only audio from second
-            '-map', '0:v', '-map', '1:a',
+            '-map', video_map, '-map', '1:a',
+        ])
+        # STREAM TO TWITCH, AND THE OTHER DESTINATIONS
+        command.extend(output_args([
+            self.get_closest_ingest() if destination == 'twitch'
+            else destination
+            for destination in self.outputs]))
+        return command
+
+    def _overlay_filter(self):
+        """
+        Build the filter graph drawing the overlays on the video, one
+        after the other. The video with all overlays is labeled vout.
 
-            # NUMBER OF THREADS
-            '-threads', '2',
+        :return: String
+        """
+        filters = []
+        source = '0:v'
+        input_index = 2
+        for i, overlay in enumerate(self.overlays):
+            input_label = None
+            if overlay.input_args(self.fps):
+                input_label = '%d:v' % input_index
+                input_index += 1
+            target = 'vout' if i == len(self.overlays) - 1 else 'v%d' % i
+            filters.append(overlay.filter(source, target, input_label))
+            source = target
+        return ';'.join(filters)
+
+    @staticmethod
+    def _parse_progress(report):
+        """
+        Parse a progress report of ffmpeg into encoder statistics.
+
+        :param report: the key=value pairs of one report
+        :type report: dict
+        :return: dict with the keys 'frames', 'fps', 'speed',
+            'bitrate' (in kbit/s), 'dropped_frames', 'duplicated_frames'
+            and 'out_time' (in seconds). Values ffmpeg did not know yet
+            are None.
+        """
+        def number(key, convert=float, suffix=''):
+            value = report.get(key, 'N/A').strip()
+            if suffix and value.endswith(suffix):
+                value = value[:-len(suffix)]
+            try:
+                return convert(value)
+            except ValueError:
+                return None
+
+        # out_time_ms is in microseconds as well, newer versions of ffmpeg
+        # also report it correctly named as out_time_us
+        out_time = number('out_time_us', int)
+        if out_time is None:
+            out_time = number('out_time_ms', int)
+        if out_time is not None:
+            out_time /= 1e6
+        return {
+            'frames': number('frame', int),
+            'fps': number('fps'),
+            'speed': number('speed', suffix='x'),
+            'bitrate': number('bitrate', suffix='kbits/s'),
+            'dropped_frames': number('drop_frames', int),
+            'duplicated_frames': number('dup_frames', int),
+            'out_time': out_time,
+        }
+
+    def _read_progress(self, process):
+        """
+        Read the progress reports of an ffmpeg process until it exits,
+        keep the latest statistics and report the encoding speed to the
+        encoder profile.
 
-            # STREAM TO TWITCH
-            '-f', 'flv', self.get_closest_ingest(),
-        ])
+        :param process: the ffmpeg process
+        :type process: subprocess.Popen
+        """
+        report = {}
+        previous = None
+        for line in iter(process.stdout.readline, b''):
+            key, _, value = line.decode('utf-8', 'replace').partition('=')
+            report[key.strip()] = value
+            if key.strip() != 'progress':
+                continue
+            stats = self._parse_progress(report)
+            report = {}
+            if process is not self.ffmpeg_process:
+                # a previous process which is shutting down, keep
+                # draining its reports until it exits
+                continue
+            previous = self._update_encoder_stats(stats, previous)
+        process.stdout.close()
+
+    def _update_encoder_stats(self, stats, previous):
+        """
+        Keep the latest statistics of the running ffmpeg process, and
+        report the encoding speed to the encoder profile.
+
+        :param stats: the parsed progress report
+        :type stats: dict
+        :param previous: the (out_time, monotonic time) of the previous
+            report, None for the first report
+        :type previous: tuple
+        :return: the (out_time, monotonic time) of this report
+        """
+        self.encoder_stats = stats
+        # the speed ffmpeg reports is averaged since it started, so
+        # measure the speed over the last report instead
+        if stats['out_time'] is None:
+            return previous
+        now = monotonic()
+        if previous is not None and now > previous[1]:
+            self.encoder_profile.report_speed(
+                (stats['out_time'] - previous[0]) / (now - previous[1]))
+        return (stats['out_time'], now)
+
+    def get_encoder_stats(self):
+        """Get the latest statistics of the encoder, which ffmpeg reports
+        about twice a second.
+
+        :return: dict with the keys 'frames', 'fps' (frames encoded per
+            second), 'speed' (1.0 is realtime), 'bitrate' (in kbit/s),
+            'dropped_frames', 'duplicated_frames' and 'out_time' (the
+            timestamp of the output, in seconds). The dict is empty
+            until the first report comes in.
+        """
+        return dict(self.encoder_stats)
 
-        devnullpipe = subprocess.DEVNULL
-        if self.verbose:
-            devnullpipe = None
-        self.ffmpeg_process = subprocess.Popen(
-            command,
-            stdin=subprocess.PIPE,
-            stderr=devnullpipe,
-            stdout=devnullpipe)
+    def _recover(self, failed_process):
+        """
+        Replace an ffmpeg process which stopped by a new one, when
+        auto_recover is enabled.
+
+        :param failed_process: the process which stopped
+        :type failed_process: subprocess.Popen
+        :return: True when a new process is running, False when it is up
+            to the caller to handle the failure
+        """
+        if not self.auto_recover:
+            return False
+        with self._recover_lock:
+            if self._recovering:
+                # the writes are kept until the new process runs
+                return True
+            if self.ffmpeg_process is not failed_process:
+                # another thread has recovered already
+                self._resume_writers()
+                return True
+            now = monotonic()
+            if self._last_recovery is not None and \
+                    now - self._last_recovery < self.recover_interval:
+                # ffmpeg keeps on failing, restarting will not help. Drop
+                # the writes kept for a new process, further writes fail
+                # as usual
+                self.video_writer.cancel()
+                self.audio_writer.cancel()
+                return False
+            self._last_recovery = now
+            print("%s stopped, restarting the stream" % self.ffmpeg_binary)
+            if self.write_async:
+                # the pacer should not wait for ffmpeg to start. Keep the
+                # writes, and restart ffmpeg on a thread of its own once
+                # the current tick is done.
+                self._recovering = True
+                self.video_writer.suspend()
+                self.audio_writer.suspend()
+                self._pacer_tasks.append(
+                    self.pacer.add_task(self._start_restart))
+                return True
+            self.reset()
+            self.recoveries += 1
+            return True
+
+    def _start_restart(self, repeat=False):
+        """
+        Pacer task starting the restart thread, called once.
+        """
+        self._restart_thread = threading.Thread(target=self._restart)
+        self._restart_thread.daemon = True
+        self._restart_thread.start()
+        return None
+
+    def _restart(self):
+        """
+        Restart ffmpeg, on the restart thread.
+        """
+        try:
+            self.reset()
+            self.recoveries += 1
+        except Exception:
+            # the writes have been dropped, and the ticks find out
+            # ffmpeg is not running
+            traceback.print_exc()
+        finally:
+            self._recovering = False
+
+    def _resume_writers(self):
+        """
+        Write the kept writes to the current ffmpeg process.
+        """
+        self.video_writer.resume(self.ffmpeg_process.stdin.fileno())
+        self.audio_writer.resume(self.audio_pipe)
 
     def __enter__(self):
         return self
 
+    def _start_pacer(self, pacer, tasks):
+        """
+        Start calling the periodic tasks of the stream.
+
+        :param pacer: the pacer to schedule the tasks on, None to start a
+            pacer of the stream's own
+        :type pacer: Pacer
+        :param tasks: (callback, catchup) pairs, see Pacer.add_task()
+        :type tasks: list of tuples
+        """
+        self._owns_pacer = pacer is None
+        if pacer is None:
+            pacer = Pacer()
+        self.pacer = pacer
+        for callback, catchup in tasks:
+            self._pacer_tasks.append(
+                pacer.add_task(callback, catchup=catchup))
+
     def __exit__(self, type, value, traceback):
+        if self.pacer is not None:
+            if self._owns_pacer:
+                self.pacer.stop()
+            else:
+                # other streams keep on using the pacer
+                for task in self._pacer_tasks:
+                    self.pacer.remove_task(task)
+        if self._restart_thread is not None:
+            # don't leave a new process behind
+            self._restart_thread.join()
+        # let the writer thread finish the writes in the backlog, unless
+        # ffmpeg is stuck
+        for writer in (self.video_writer, self.audio_writer):
+            try:
+                writer.flush(timeout=1.)
+            except OSError:
+                pass
+            writer.close()
         # sigint so avconv can clean up the stream nicely
         self.ffmpeg_process.send_signal(signal.SIGINT)
         # waiting doesn't work because of reasons I don't know
         # self.pipe.wait()
 
-    def send_video_frame(self, frame):
-        """Send frame of shape (height, width, 3)
-        with values between 0 and 1.
-        Raises an OSError when the stream is closed.
+    @staticmethod
+    def _as_uint8(frame):
+        """
+        Convert a frame to contiguous uint8 pixels, ready to be written
+        to the pipe. uint8 frames are passed through as they are, float
+        frames are scaled from [0, 1] to [0, 255] and clipped.
 
         :param frame: array containing the frame.
-        :type frame: numpy array with shape (height, width, 3)
-            containing values between 0.0 and 1.0
+        :type frame: numpy array
+        :return: contiguous numpy array of dtype uint8
         """
+        if frame.dtype == np.uint8:
+            return np.ascontiguousarray(frame)
+        pixels = np.multiply(frame, 255.)
+        np.clip(pixels, 0, 255, out=pixels)
+        return pixels.astype(np.uint8)
 
-        assert frame.shape == (self.height, self.width, 3)
+    def _convert_frame(self, frame):
+        """
+        Convert a frame to the bytes which are sent to ffmpeg.
+
+        :param frame: array containing the frame.
+        :type frame: numpy array
+        :return: contiguous numpy array of dtype uint8
+        """
+        if self.yuv_matrix is not None:
+            return rgb_to_yuv420p(frame, self.yuv_matrix,
+                                  bgr=self.pix_fmt.startswith('bgr'))
+        return self._as_uint8(frame)
+
+    def _check_frame_shape(self, frame):
+        """
+        Assert the frame fits the size and pixel format of the stream.
+        Grayscale frames can be given with or without a channel axis.
+
+        :param frame: array containing the frame.
+        :type frame: numpy array
+        """
+        assert frame.shape == self.frame_shape or (
+            len(self.frame_shape) == 2 and
+            frame.shape == self.frame_shape + (1,)), \
+            "Expected a frame of shape %s, got %s" % (self.frame_shape,
+                                                      frame.shape)
+
+    def _timed(self, stage, function, *args):
+        """
+        Call a function, and record how long it took when timing.
 
-        frame = np.clip(255*frame, 0, 255).astype('uint8')
+        :param stage: the stage of the pipeline, see TIMING_STAGES
+        :type stage: String
+        :return: what the function returned
+        """
+        if self.timings is None:
+            return function(*args)
+        start_time = monotonic()
         try:
-            self.ffmpeg_process.stdin.write(frame.tostring())
+            return function(*args)
+        finally:
+            self.timings[stage].record(monotonic() - start_time)
+
+    def _record_tick(self, stage):
+        """
+        Record how late the pacer called the current tick, when timing.
+
+        :param stage: 'video_tick' or 'audio_tick'
+        :type stage: String
+        """
+        if self.timings is None or self.pacer.current_task is None:
+            return
+        lateness = self.pacer.current_task.lateness
+        self.timings[stage].record(lateness)
+        if lateness > .5 / self.fps:
+            self.late_ticks[stage] += 1
+
+    def get_timings(self):
+        """Summarize the timings of the stages of the pipeline, when the
+        stream was created with a timing_window. The timings themselves
+        are in the timings attribute, the number of ticks which were
+        called more than half a frame time late in late_ticks.
+
+        :return: dict with a summary (see TimingHistogram.summary) for
+            every stage in TIMING_STAGES, empty when not timing
+        """
+        if self.timings is None:
+            return {}
+        return dict((stage, histogram.summary())
+                    for stage, histogram in self.timings.items())
+
+    def _frame_bytes(self, frame, version=None):
+        """
+        Convert a frame to the bytes which are sent to ffmpeg, using the
+        frame cache for frames with a version.
+
+        :param frame: array containing the frame.
+        :type frame: numpy array
+        :param version: the version token of the content of the frame,
+            or None when it is not known
+        :type version: any hashable value
+        :return: contiguous numpy array of dtype uint8
+        """
+        if version is None or self.frame_cache is None:
+            return self._convert_frame(frame)
+        data = self.frame_cache.get(frame, version)
+        if data is None:
+            data = self._convert_frame(frame)
+            # uint8 frames are written as they are, so only cache frames
+            # which needed converting
+            if not np.may_share_memory(data, frame):
+                self.frame_cache.put(frame, version, data)
+        return data
+
+    def _pipe_pix_fmt(self):
+        """
+        :return: the pixel format of the frames going through the pipe
+        """
+        return self.pix_fmt if self.yuv_matrix is None else 'yuv420p'
+
+    def _pipe_frame_nbytes(self):
+        """
+        :return: the number of bytes of a frame going through the pipe
+        """
+        if self.yuv_matrix is not None:
+            return self.width * self.height * 3 // 2
+        return self.width * self.height * PIX_FMT_CHANNELS[self.pix_fmt]
+
+    def _write_pipe(self, writer, pipe, *buffers, callback=None):
+        """
+        Write to a pipe to ffmpeg, through its writer thread. Unless the
+        stream writes asynchronously, wait until the data is written.
+        Raises an OSError when a write to ffmpeg failed.
+
+        :param writer: the writer of the pipe
+        :type writer: PipeWriter
+        :param pipe: the pipe, a file descriptor or a file object
+        :param buffers: the data to write, written at once
+        :type buffers: bytes or contiguous arrays
+        :param callback: function called once the data is written or
+            dropped, see PipeWriter.write()
+        :type callback: callable
+        """
+        fd = pipe if isinstance(pipe, int) else pipe.fileno()
+        writer.write(fd, buffers, callback=callback)
+        if not self.write_async:
+            try:
+                writer.flush()
+            except OSError:
+                # the caller sends the data again after recovering, it
+                # should not be kept for the new process
+                writer.cancel()
+                raise
+
+    def get_pipe_stats(self):
+        """Find out how the writes to ffmpeg are doing. A stall time
+        which keeps on growing means the encoder does not keep up.
+
+        :return: dict with the statistics (see PipeWriter.get_stats) of
+            the 'video' and the 'audio' pipe
+        """
+        return {
+            'video': self.video_writer.get_stats(),
+            'audio': self.audio_writer.get_stats(),
+        }
+
+    def _write_video(self, data, pts=None):
+        """
+        Write a converted frame to ffmpeg.
+
+        :param data: the frame, as returned by _frame_bytes()
+        :type data: numpy array
+        :param pts: in vfr mode, the timestamp of the frame in seconds,
+            None for the current time
+        :type pts: float
+        """
+        if self.vfr:
+            with self._video_lock:
+                self._write_timestamped(data, pts)
+            self._first_frame_written()
+            return
+        callback = None
+        if self.time_to_first_frame is None:
+            # the writer thread may write the frame later on
+            callback = self._first_frame_written
+        process = self.ffmpeg_process
+        try:
+            self._write_pipe(self.video_writer, process.stdin, data,
+                             callback=callback)
         except OSError:
-            # The pipe has been closed. Reraise and handle it further
-            # downstream
-            raise
+            # The pipe has been closed. Restart ffmpeg when recovering,
+            # otherwise reraise and handle it further downstream
+            if not self._recover(process):
+                raise
+            self._write_pipe(self.video_writer, self.ffmpeg_process.stdin,
+                             data, callback=callback)
+
+    def _first_frame_written(self):
+        """
+        Set time_to_first_frame, once the first frame has been written.
+        """
+        if self.time_to_first_frame is None:
+            self.time_to_first_frame = monotonic() - self._start_time
+
+    def _write_timestamped(self, data, pts):
+        """
+        Write a frame with its timestamp, in vfr mode. Call this with
+        the video lock held.
+        """
+        now = monotonic()
+        if pts is None:
+            pts = now
+        process = self.ffmpeg_process
+        try:
+            self._write_cluster(process, data, pts)
+        except OSError:
+            if not self._recover(process):
+                raise
+            self._write_cluster(self.ffmpeg_process, data, pts)
+        self._last_video = (data, pts, now)
+
+    def _write_cluster(self, process, data, pts):
+        """
+        Write a frame with its timestamp to an ffmpeg process, in vfr
+        mode. The timestamps written to a process start at 0 and always
+        increase.
+        """
+        if self._pts_offset is None:
+            self._pts_offset = pts
+        timestamp = int(round((pts - self._pts_offset) * 1000))
+        if self._last_timestamp is not None and \
+                timestamp <= self._last_timestamp:
+            timestamp = self._last_timestamp + 1
+        self._write_pipe(self.video_writer, process.stdin,
+                         matroska.frame_header(timestamp, data.nbytes), data)
+        self._last_timestamp = timestamp
+
+    def _keepalive(self, repeat=False):
+        """
+        Send the last frame again when no frame was sent for keepalive
+        seconds, in vfr mode.
+
+        :return: the number of seconds until the next check
+        """
+        with self._video_lock:
+            if self._last_video is None:
+                return self.keepalive
+            data, pts, sent = self._last_video
+            idle = monotonic() - sent
+            if idle < self.keepalive:
+                return self.keepalive - idle
+            try:
+                self._write_timestamped(data, pts + idle)
+            except OSError:
+                # stream has been closed.
+                return None
+        return self.keepalive
+
+    def send_video_frame(self, frame, version=None, pts=None):
+        """Send frame of shape (height, width, channels), where the
+        number of channels depends on the pixel format of the stream.
+        Frames of dtype uint8 are sent as they are, float frames should
+        contain values between 0 and 1.
+        Raises an OSError when the stream is closed.
+
+        In vfr mode, a frame is shown until the next frame is sent, so
+        frames only have to be sent when the video changes.
+
+        When the same few frames are sent over and over, give each of
+        them a version which changes whenever the content of the array
+        changes. Converted frames are then cached, and sending a frame
+        again only costs a write to the pipe.
+
+        :param frame: array containing the frame.
+        :type frame: numpy array with shape (height, width, channels)
+            containing uint8 values or floats between 0.0 and 1.0
+        :param version: token for the content of the frame, None when
+            the frame should be converted again
+        :type version: any hashable value
+        :param pts: in vfr mode, the time at which the frame should be
+            shown, in seconds on a clock of your choice which should
+            always increase. By default, the time of sending the frame.
+        :type pts: float
+        """
+        self._check_frame_shape(frame)
+        data = self._timed('convert', self._frame_bytes, frame, version)
+        self._timed('write', self._write_video, data, pts)
 
     def send_audio(self, left_channel, right_channel):
         """Add the audio samples to the stream. The left and the right
@@ -207,31 +2439,90 @@ class TwitchOutputStream(object):
             containing values between -1.0 and 1.0. k can be any integer
         :param right_channel: array containing the audio signal.
         :type right_channel: numpy array with shape (k, )
-            containing values between -1.0 and 1.0. k can be any integer
+            containing values between -1.0 and 1.0. k can be any integer.
+            Channels of dtype int16 are sent as they are.
         """
-        if self.audio_pipe is None:
-            if not os.path.exists('/tmp/audiopipe'):
-                os.mkfifo('/tmp/audiopipe')
-            self.audio_pipe = os.open('/tmp/audiopipe', os.O_WRONLY)
-
         assert len(left_channel.shape) == 1
         assert left_channel.shape == right_channel.shape
 
-        frame = np.column_stack((left_channel, right_channel)).flatten()
-
-        frame = np.clip(32767*frame, -32767, 32767).astype('int16')
+        frame = self._interleave_audio(left_channel, right_channel)
+        callback = None
+        if self.write_async:
+            # the buffer of the samples is reused once they are written
+            callback = functools.partial(self._recycle_audio, frame)
+        process = self.ffmpeg_process
         try:
-            os.write(self.audio_pipe, frame.tostring())
+            self._write_pipe(self.audio_writer, self.audio_pipe, frame,
+                             callback=callback)
         except OSError:
-            # The pipe has been closed. Reraise and handle it further
-            # downstream
-            raise
+            # The pipe has been closed. Restart ffmpeg when recovering,
+            # otherwise reraise and handle it further downstream
+            if not self._recover(process):
+                raise
+            self._write_pipe(self.audio_writer, self.audio_pipe, frame,
+                             callback=callback)
+        if callback is None:
+            self._recycle_audio(frame)
+
+    def _interleave_audio(self, left_channel, right_channel):
+        """
+        Interleave the two channels into int16 samples. The samples are
+        written into a recycled buffer, without any other temporary
+        arrays. Give the buffer back with _recycle_audio() once the
+        samples are not needed anymore.
+
+        :param left_channel: array containing the audio signal.
+        :type left_channel: numpy array with shape (k, )
+        :param right_channel: array containing the audio signal.
+        :type right_channel: numpy array with shape (k, )
+        :return: numpy array of dtype int16 and shape (k, 2)
+        """
+        length = len(left_channel)
+        try:
+            buffer = self._audio_buffers.pop()
+        except IndexError:
+            buffer = None
+        if buffer is None or len(buffer) < length:
+            buffer = np.empty((length, 2), dtype=np.int16)
+        samples = buffer[:length]
+        if left_channel.dtype == np.int16 and \
+                right_channel.dtype == np.int16:
+            samples[:, 0] = left_channel
+            samples[:, 1] = right_channel
+            return samples
+        if self._audio_scaled is None or len(self._audio_scaled) < length:
+            self._audio_scaled = np.empty((length, 2), dtype=np.float32)
+        scaled = self._audio_scaled[:length]
+        np.multiply(left_channel, 32767, out=scaled[:, 0],
+                    casting='unsafe')
+        np.multiply(right_channel, 32767, out=scaled[:, 1],
+                    casting='unsafe')
+        np.clip(scaled, -32767, 32767, out=samples, casting='unsafe')
+        return samples
+
+    def _recycle_audio(self, samples):
+        """
+        Give the buffer of samples returned by _interleave_audio() back,
+        to be reused.
+
+        :param samples: the samples
+        :type samples: numpy array
+        """
+        self._audio_buffers.append(samples.base)
 
     def get_closest_ingest(self):
-        closest_server = requests.get(url='https://ingest.twitch.tv/api/v2/ingests').json()['ingests'][0]
+        """
+        Find the URL of the Twitch ingest server to stream to. The
+        servers are cached, so this only waits for the Twitch API when
+        there is no cache yet.
+
+        :return: String, the RTMP URL including the stream key
+        """
+        closest_server = self.ingest_selector.get_closest_ingest()
         url_template = closest_server['url_template']
-        print("Streaming to closest server: %s at %s" % (closest_server['name'],
-                                                         url_template.replace('/app/{stream_key}', '')))
+        print("Streaming to closest server: %s at %s" % (
+            closest_server['name'],
+            url_template.replace('/app/{stream_key}', '')))
         return url_template.format(
             stream_key=self.twitch_stream_key)
 
@@ -244,35 +2535,65 @@ class TwitchOutputStreamRepeater(TwitchOutputStream):
     Note: this will not generate a stable, stutter-less stream!
      It does not keep a buffer and you cannot synchronize using this
      stream. Use TwitchBufferedOutputStream for this.
+
+    :param catchup: what to do when streaming falls behind, one of
+        'burst', 'skip' or 'duplicate' (see Pacer)
+    :type catchup: String
+    :param pacer: the pacer to send the frames from, which may be shared
+        with other streams. By default, the stream starts a pacer of its
+        own.
+    :type pacer: Pacer
     """
+    # the pacer should not wait for ffmpeg
+    write_async = True
+
     def __init__(self, *args, **kwargs):
+        catchup = kwargs.pop('catchup', 'burst')
+        pacer = kwargs.pop('pacer', None)
+        if catchup not in CATCHUP_POLICIES:
+            raise ValueError("Unknown catch-up policy '%s', use one of %s"
+                             % (catchup, ", ".join(CATCHUP_POLICIES)))
+        if kwargs.get('vfr'):
+            raise ValueError("A vfr stream does not need repeating, use "
+                             "TwitchOutputStream instead")
         super(TwitchOutputStreamRepeater, self).__init__(*args, **kwargs)
 
-        self.lastframe = np.ones((self.height, self.width, 3))
-        self._send_last_video_frame()   # Start sending the stream
-
+        self.lastframe = np.ones(self.frame_shape)
+        # the last frame as it is written to ffmpeg, every tick
+        self._lastframe_data = self._frame_bytes(self.lastframe)
         if self.audio_enabled:
             # some audible sine waves
             xl = np.linspace(0.0, 10*np.pi, int(AUDIORATE/self.fps) + 1)[:-1]
             xr = np.linspace(0.0, 100*np.pi, int(AUDIORATE/self.fps) + 1)[:-1]
             self.lastaudioframe_left = np.sin(xl)
             self.lastaudioframe_right = np.sin(xr)
-            self._send_last_audio()   # Start sending the stream
 
-    def _send_last_video_frame(self):
+        # Start sending the stream
+        tasks = [(self._send_last_video_frame, catchup)]
+        if self.audio_enabled:
+            tasks.append((self._send_last_audio, 'burst'))
+        self._start_pacer(pacer, tasks)
+
+    def _send_last_video_frame(self, repeat=False):
+        if not repeat:
+            self._record_tick('video_tick')
+        if self._recovering:
+            # the last frame stays up until ffmpeg runs again
+            return 1./self.fps
         try:
-            super(TwitchOutputStreamRepeater,
-                  self).send_video_frame(self.lastframe)
+            self._timed('write', self._write_video, self._lastframe_data)
         except OSError:
             # stream has been closed.
             # This function is still called once when that happens.
-            pass
-        else:
-            # send the next frame at the appropriate time
-            threading.Timer(1./self.fps,
-                            self._send_last_video_frame).start()
+            return None
+        # send the next frame at the appropriate time
+        return 1./self.fps
 
-    def _send_last_audio(self):
+    def _send_last_audio(self, repeat=False):
+        if not repeat:
+            self._record_tick('audio_tick')
+        if self._recovering:
+            return 1./self.fps
         try:
             super(TwitchOutputStreamRepeater,
                   self).send_audio(self.lastaudioframe_left,
@@ -280,21 +2601,32 @@ class TwitchOutputStreamRepeater(TwitchOutputStream):
         except OSError:
             # stream has been closed.
             # This function is still called once when that happens.
-            pass
-        else:
-            # send the next frame at the appropriate time
-            threading.Timer(1./self.fps,
-                            self._send_last_audio).start()
+            return None
+        # send the next frame at the appropriate time
+        return 1./self.fps
+
+    def send_video_frame(self, frame, version=None):
+        """Send frame of shape (height, width, channels), with uint8
+        values or floats between 0 and 1.
 
-    def send_video_frame(self, frame):
-        """Send frame of shape (height, width, 3)
-        with values between 0 and 1.
+        The frame is converted right away, and repeated until the next
+        one is sent. Frames which need no conversion (uint8 frames in the
+        pixel format of the pipe) are written as they are, and should not
+        be changed anymore after sending them. When the same few frames
+        are sent over and over, give each of them a version to convert
+        them only once (see TwitchOutputStream.send_video_frame).
 
         :param frame: array containing the frame.
-        :type frame: numpy array with shape (height, width, 3)
-            containing values between 0.0 and 1.0
+        :type frame: numpy array with shape (height, width, channels)
+            containing uint8 values or floats between 0.0 and 1.0
+        :param version: token for the content of the frame, None when
+            the frame should be converted again
+        :type version: any hashable value
         """
+        self._check_frame_shape(frame)
+        data = self._timed('convert', self._frame_bytes, frame, version)
         self.lastframe = frame
+        self._lastframe_data = data
 
     def send_audio(self, left_channel, right_channel):
         """Add the audio samples to the stream. The left and the right
@@ -315,157 +2647,519 @@ class TwitchBufferedOutputStream(TwitchOutputStream):
     """
     This stream makes sure a steady framerate is kept by buffering
     frames. Make sure not to have too many frames in buffer, since it
-    will increase the memory load considerably!
+    will increase the memory load considerably! The buffers can be
+    bounded with video_buffer_size and audio_buffer_size, in which case
+    the overflow policy decides what happens when they are full, and
+    send_video_frame() and send_audio() report what happened.
+
+    To avoid allocating a new array for every frame, frames can be
+    rendered straight into a preallocated frame with acquire_frame()
+    and added to the buffer with commit_frame(). The frames come from a
+    fixed pool, which is allocated on the first call of acquire_frame(),
+    and are recycled once they have been written to ffmpeg.
+
+    Video and audio are sent on one master clock: every frame time, one
+    frame and exactly the audio samples of that frame time are sent. The
+    n-th frame you send belongs with the audio samples sent from time
+    n / fps on. When a buffer runs dry, the last frame is shown again or
+    silence is played, and the resulting drift between your audio and
+    video is measured (get_av_drift), and corrected when av_sync is set.
+
+    Frames are converted to the bytes which are written to ffmpeg as
+    they are added, on the thread adding them, so the buffer holds
+    compact uint8 frames whatever the dtype of the frames you send.
+
+    The frames and the audio are written to ffmpeg by a writer thread
+    per pipe, so the frame times are kept while ffmpeg is catching up.
 
     Adding frames is thread safe.
+
+    Pre-rendered frames can be played straight from a file, without
+    loading or converting them, with play_file().
+
+    Everything sent to the stream can be recorded by a SessionRecorder,
+    and replayed later on by a SessionReplayer.
+
+    :param frame_pool_size: the number of preallocated frames used by
+        acquire_frame(). One of these is always held as the last frame
+        streamed, so at most frame_pool_size - 1 of them can be buffered.
+    :type frame_pool_size: int
+    :param catchup: what to do when streaming falls behind, one of
+        'burst' (stream the buffered frames back to back until caught
+        up), 'skip' (drop the missed frame times) or 'duplicate' (fill
+        the missed frame times with the last frame). Audio follows the
+        video frame times.
+    :type catchup: String
+    :param video_buffer_size: the maximum number of buffered video
+        frames, 0 for no limit
+    :type video_buffer_size: int
+    :param audio_buffer_size: the maximum number of buffered audio
+        fragments, 0 for no limit
+    :type audio_buffer_size: int
+    :param overflow: what to do with frames or fragments added to a full
+        buffer, one of 'block' (wait until there is room), 'drop_oldest',
+        'drop_newest' or 'merge' (the new frame replaces the newest
+        buffered frame, new audio is appended to the newest fragment)
+    :type overflow: String
+    :param av_sync: how to correct drift between the audio and the video,
+        one of 'audio' (pad with silence or drop samples), 'video' (show a
+        frame again or skip one) or None (only measure the drift). The
+        drift is not corrected while the buffer it would be corrected
+        with runs dry, so a stream which only gets audio for a while
+        keeps on playing it.
+    :type av_sync: String
+    :param max_av_drift: the drift (in seconds) which is tolerated before
+        it is corrected
+    :type max_av_drift: float
+    :param max_av_correction: with av_sync, the largest drift (in
+        seconds) which is made up for. While a buffer stays dry, the
+        drift stops growing beyond it, so a pause of the video or the
+        audio is not made up for with as long a pause of the other.
+    :type max_av_correction: float
+    :param pacer: the pacer to send the frames from, which may be shared
+        with other streams. By default, the stream starts a pacer of its
+        own.
+    :type pacer: Pacer
     """
+    # the pacer should not wait for ffmpeg
+    write_async = True
+    # records what is sent to the stream, see SessionRecorder
+    recorder = None
+    # the (FrameFile, loop, position of the next frame) being played
+    _frame_file = None
+
     def __init__(self, *args, **kwargs):
+        self.frame_pool_size = kwargs.pop('frame_pool_size', 30)
+        catchup = kwargs.pop('catchup', 'burst')
+        video_buffer_size = kwargs.pop('video_buffer_size', 0)
+        audio_buffer_size = kwargs.pop('audio_buffer_size', 0)
+        overflow = kwargs.pop('overflow', 'block')
+        self.av_sync = kwargs.pop('av_sync', None)
+        self.max_av_drift = kwargs.pop('max_av_drift', 0.04)
+        self.max_av_correction = kwargs.pop('max_av_correction', 1.)
+        pacer = kwargs.pop('pacer', None)
+        if catchup not in CATCHUP_POLICIES:
+            raise ValueError("Unknown catch-up policy '%s', use one of %s"
+                             % (catchup, ", ".join(CATCHUP_POLICIES)))
+        if self.av_sync not in AV_SYNC_POLICIES:
+            raise ValueError("Unknown A/V sync policy '%s', use one of %s"
+                             % (self.av_sync,
+                                ", ".join(map(str, AV_SYNC_POLICIES))))
+        if kwargs.get('vfr'):
+            raise ValueError("A vfr stream does not need buffering, use "
+                             "TwitchOutputStream instead")
+        self.frame_pool = None
+        self._frame_pool_lock = threading.Lock()
+        self._frame_file_lock = threading.Lock()
         super(TwitchBufferedOutputStream, self).__init__(*args, **kwargs)
-        self.last_frame = np.ones((self.height, self.width, 3))
-        self.last_frame_time = None
-        self.next_video_send_time = None
+        # the last frame streamed, as it was written to ffmpeg
+        self.last_frame = self._frame_bytes(np.ones(self.frame_shape))
+        # the frame of the frame pool which holds the last frame
+        self._last_pool_frame = None
         self.frame_counter = 0
-        self.q_video = queue.PriorityQueue()
+        # the buffer holds (frame of the frame pool or None, converted
+        # frame, time added) tuples
+        self.q_video = FrameBuffer(maxsize=video_buffer_size,
+                                   overflow=overflow,
+                                   on_discard=self._discard_frame)
+
+        # The master clock counts the ticks of the stream, every tick
+        # sends one video frame and the audio samples up to the end of
+        # the tick. The content counters count what was taken from the
+        # buffers, the difference between them is the A/V drift.
+        self.ticks = 0
+        self.audio_samples_sent = 0
+        self.video_content_frames = 0
+        self.audio_content_samples = 0
+        # whether the buffers ran dry in the previous tick, the drift is
+        # not corrected with a buffer which has nothing to correct it with
+        self._video_dry = False
+        self._audio_dry = False
+        if self.audio_enabled:
+            self.audio_frame_counter = 0
+            self.q_audio = FrameBuffer(maxsize=audio_buffer_size,
+                                       overflow=overflow,
+                                       merge=self._merge_audio)
+            # the fragment being sent, and how much of it has been sent
+            self._audio_fragment = None
+            self._audio_offset = 0
 
         # don't call the functions directly, as they block on the first
-        # call
-        self.t = threading.Timer(0.0, self._send_video_frame)
-        self.t.daemon = True
-        self.t.start()
+        # call. A single pacer task streams both video and audio.
+        self._start_pacer(pacer, [(self._send_video_frame, catchup)])
 
-        if self.audio_enabled:
-            # send audio at about the same rate as video
-            # this can be changed
-            self.last_audio = (np.zeros((int(AUDIORATE/self.fps), )),
-                               np.zeros((int(AUDIORATE/self.fps), )))
-            self.last_audio_time = None
-            self.next_audio_send_time = None
-            self.audio_frame_counter = 0
-            self.q_audio = queue.PriorityQueue()
-            self.t = threading.Timer(0.0, self._send_audio)
-            self.t.daemon = True
-            self.t.start()
+    @staticmethod
+    def _merge_audio(old_fragment, new_fragment):
+        """
+        Merge two audio fragments by appending the samples of the new
+        fragment to the old one.
+        """
+        return (np.concatenate((old_fragment[0], new_fragment[0])),
+                np.concatenate((old_fragment[1], new_fragment[1])))
 
-    def _send_video_frame(self):
-        start_time = time.time()
-        try:
-            frame = self.q_video.get_nowait()
-            # frame[0] is frame count of the frame
-            # frame[1] is the frame
-            frame = frame[1]
-        except IndexError:
-            frame = self.last_frame
-        except queue.Empty:
-            frame = self.last_frame
-        else:
-            self.last_frame = frame
+    def get_av_drift(self):
+        """Find out how far the audio runs ahead of the video, in seconds.
+        Whenever a buffer runs dry, the stream shows the last frame again
+        or plays silence, which shifts the audio and video you sent
+        relative to each other. With av_sync, this drift is corrected
+        automatically.
 
-        try:
-            super(TwitchBufferedOutputStream, self
-                  ).send_video_frame(frame)
-        except OSError:
-            # stream has been closed.
-            # This function is still called once when that happens.
-            # Don't call this function again and everything should be
-            # cleaned up just fine.
-            return
+        :return: float, positive when the audio is ahead of the video
+        """
+        return (self.audio_content_samples / AUDIORATE -
+                self.video_content_frames / self.fps)
 
-        # send the next frame at the appropriate time
-        if self.next_video_send_time is None:
-            self.t = threading.Timer(1./self.fps, self._send_video_frame)
-            self.next_video_send_time = start_time + 1./self.fps
+    def _next_video_frame(self, repeat, drift):
+        """
+        Take the frame for the next tick out of the buffer, or out of the
+        file being played, dropping or repeating a frame when that
+        corrects the A/V drift. Call this with the frame file lock held.
+
+        :return: the frame to write, last_frame or a frame of the file
+        """
+        if repeat or (self.av_sync == 'video' and not self._audio_dry and
+                      drift < -self.max_av_drift):
+            # the video runs ahead, show the last frame again
+            self._video_dry = False
+            return self.last_frame
+        count = 1
+        if self.av_sync == 'video' and drift > self.max_av_drift:
+            # the video runs behind, skip a frame
+            count = 2
+        pipe_data = None
+        for _ in range(count):
+            frame, pipe_data = None, self._next_file_frame()
+            if pipe_data is None:
+                try:
+                    _, (frame, data, added) = self.q_video.get_nowait()
+                except queue.Empty:
+                    break
+                if self.timings is not None:
+                    self.timings['dequeue'].record(monotonic() - added)
+                self.last_frame = pipe_data = data
+            if self._last_pool_frame is not None:
+                # recycle the previous frame once it has been written
+                self.video_writer.call_after_writes(functools.partial(
+                    self.release_frame, self._last_pool_frame))
+            self._last_pool_frame = frame
+            self.video_content_frames += 1
+        self._video_dry = pipe_data is None
+        if self._video_dry and self.av_sync is not None and \
+                drift > self.max_av_correction:
+            # no video is coming in, let the audio play on without
+            # making the drift grow any further
+            self.video_content_frames += 1
+        return self.last_frame if pipe_data is None else pipe_data
+
+    def _next_file_frame(self):
+        """
+        Take the next frame of the file being played, and make it the
+        last frame. Call this with the frame file lock held.
+
+        :return: the frame to write, see FrameFile.get_pipe_data, None
+            when no file is playing
+        """
+        if self._frame_file is None:
+            return None
+        frame_file, loop, position = self._frame_file
+        if position + 1 < len(frame_file):
+            self._frame_file = (frame_file, loop, position + 1)
+        elif loop:
+            self._frame_file = (frame_file, loop, 0)
         else:
-            self.next_video_send_time += 1./self.fps
-            next_event_time = self.next_video_send_time - start_time
-            if next_event_time > 0:
-                self.t = threading.Timer(next_event_time,
-                                         self._send_video_frame)
-            else:
-                # we should already have sent something!
-                #
-                # not allowed for recursion problems :-(
-                # (maximum recursion depth)
-                # self.send_me_last_frame_again()
-                #
-                # other solution:
-                self.t = threading.Thread(
-                    target=self._send_video_frame)
-
-        self.t.daemon = True
-        self.t.start()
-
-    def _send_audio(self):
-        start_time = time.time()
-        try:
-            _, left_audio, right_audio = self.q_audio.get_nowait()
-        except IndexError:
-            left_audio, right_audio = self.last_audio
-        except queue.Empty:
-            left_audio, right_audio = self.last_audio
+            self._frame_file = None
+        if self._frame_file is None:
+            # the last frame is shown again after the file is closed
+            self.last_frame = np.array(frame_file.get_frame(position))
         else:
-            self.last_audio = (left_audio, right_audio)
+            self.last_frame = frame_file.get_frame(position)
+        return frame_file.get_pipe_data(position)
+
+    def play_file(self, frame_file, loop=True):
+        """Stream pre-rendered frames from a file, one every tick, in
+        place of the frames in the buffer. The frames are not converted
+        nor loaded: they are copied from the file to ffmpeg by the kernel
+        where it can, so even 4K frames are played without going through
+        python. When a file which does not loop has been played, the
+        stream goes on with the buffered frames.
+
+        Stop a file by playing another file or None before closing it,
+        also once a file which does not loop has been played. This waits
+        until the frames of the file have been written, after that the
+        stream does not read from it anymore.
+        Raises a ValueError when the frames in the file do not have the
+        size of the frames in the pipe to ffmpeg.
+
+        :param frame_file: the frames, in the pixel format of the pipe
+            (e.g. rgb24, or yuv420p when converting to yuv420p). Either a
+            FrameFile or the path of a .npy or a raw file. None to stop
+            playing a file.
+        :type frame_file: FrameFile or String
+        :param loop: start over at the end of the file
+        :type loop: boolean
+        :return: the FrameFile being played
+        """
+        if frame_file is not None:
+            if not isinstance(frame_file, FrameFile):
+                frame_file = FrameFile(frame_file,
+                                       frame_nbytes=self._pipe_frame_nbytes())
+            if frame_file.frame_nbytes != self._pipe_frame_nbytes():
+                raise ValueError("The frames in %s have %d bytes, the "
+                                 "frames of the stream %d"
+                                 % (frame_file.path, frame_file.frame_nbytes,
+                                    self._pipe_frame_nbytes()))
+        with self._frame_file_lock:
+            if self._frame_file is not None and np.may_share_memory(
+                    self.last_frame, self._frame_file[0].frames):
+                # the last frame is shown again after the file is closed
+                self.last_frame = np.array(self.last_frame)
+            self._frame_file = None if frame_file is None else \
+                (frame_file, loop, 0)
+        # the writer may still have to copy frames of the previous file
+        written = threading.Event()
+        self.video_writer.call_after_writes(written.set)
+        written.wait()
+        return frame_file
+
+    def _pull_audio(self, count):
+        """
+        Take up to count samples out of the audio buffer.
 
+        :return: list of (left, right) pieces, together at most count
+            samples long
+        """
+        pieces = []
+        while count > 0:
+            if self._audio_fragment is None:
+                try:
+                    _, self._audio_fragment = self.q_audio.get_nowait()
+                except queue.Empty:
+                    break
+                self._audio_offset = 0
+            left, right = self._audio_fragment
+            start = self._audio_offset
+            end = min(start + count, len(left))
+            pieces.append((left[start:end], right[start:end]))
+            count -= end - start
+            self.audio_content_samples += end - start
+            if end == len(left):
+                self._audio_fragment = None
+            else:
+                self._audio_offset = end
+        return pieces
+
+    def _tick_audio(self, drift):
+        """
+        Send the audio samples up to the end of the current tick, padding
+        with silence when the buffer runs dry or to correct the A/V
+        drift, and trimming buffered samples to correct the drift.
+        """
+        count = int(round(self.ticks * AUDIORATE / self.fps)) - \
+            self.audio_samples_sent
+        silence = 0
+        if self.av_sync == 'audio' and not self._video_dry and \
+                drift > self.max_av_drift:
+            # the audio runs ahead, delay it
+            silence = min(count, int(round(drift * AUDIORATE)))
+        elif self.av_sync == 'audio' and drift < -self.max_av_drift:
+            # the audio runs behind, drop samples
+            self._pull_audio(int(round(-drift * AUDIORATE)))
+
+        samples = self._pull_audio(count - silence)
+        missing = count - silence - sum(len(left) for left, _ in samples)
+        self._audio_dry = missing > 0
+        if self._audio_dry and self.av_sync is not None and \
+                drift < -self.max_av_correction:
+            # no audio is coming in, let the video play on without
+            # making the drift grow any further
+            self.audio_content_samples += missing
+        # silence of the same dtype as the samples, which may be int16
+        dtype = samples[0][0].dtype if samples else np.float64
+        pieces = []
+        if silence:
+            pieces.append((np.zeros(silence, dtype), np.zeros(silence, dtype)))
+        pieces.extend(samples)
+        if missing:
+            pieces.append((np.zeros(missing, dtype), np.zeros(missing, dtype)))
+        if len(pieces) == 1:
+            left_audio, right_audio = pieces[0]
+        else:
+            left_audio = np.concatenate([left for left, _ in pieces])
+            right_audio = np.concatenate([right for _, right in pieces])
+
+        super(TwitchBufferedOutputStream, self
+              ).send_audio(left_audio, right_audio)
+        self.audio_samples_sent += count
+
+    def _send_video_frame(self, repeat=False):
+        # measure the drift between ticks, when audio and video are at
+        # the same point in time
+        if not repeat:
+            self._record_tick('video_tick')
+        if self._recovering:
+            # the buffers wait, and the last frame stays up, until
+            # ffmpeg runs again
+            return 1./self.fps
+        drift = self.get_av_drift() if self.audio_enabled else 0.
         try:
-            super(TwitchBufferedOutputStream, self
-                  ).send_audio(left_audio, right_audio)
+            # the file being played is not stopped between taking a
+            # frame out of it and handing the frame to the writer
+            with self._frame_file_lock:
+                data = self._next_video_frame(repeat, drift)
+                self.ticks += 1
+                self._timed('write', self._write_video, data)
+            if self.audio_enabled:
+                self._tick_audio(drift)
         except OSError:
             # stream has been closed.
             # This function is still called once when that happens.
-            # Don't call this function again and everything should be
-            # cleaned up just fine.
-            return
+            # Returning None stops the pacer from calling it again and
+            # everything should be cleaned up just fine.
+            return None
 
         # send the next frame at the appropriate time
-        downstream_time = len(left_audio) / AUDIORATE
-
-        if self.next_audio_send_time is None:
-            self.t = threading.Timer(downstream_time,
-                                     self._send_audio)
-            self.next_audio_send_time = start_time + downstream_time
-        else:
-            self.next_audio_send_time += downstream_time
-            next_event_time = self.next_audio_send_time - start_time
-            if next_event_time > 0:
-                self.t = threading.Timer(next_event_time,
-                                         self._send_audio)
-            else:
-                # we should already have sent something!
-                #
-                # not allowed for recursion problems :-(
-                # (maximum recursion depth)
-                # self.send_me_last_frame_again()
-                #
-                # other solution:
-                self.t = threading.Thread(
-                    target=self._send_audio)
-
-        self.t.daemon = True
-        self.t.start()
-
-    def send_video_frame(self, frame, frame_counter=None):
-        """send frame of shape (height, width, 3)
-        with values between 0 and 1
+        return 1./self.fps
+
+    def send_video_frame(self, frame, frame_counter=None, timeout=None,
+                         version=None):
+        """send frame of shape (height, width, channels), with uint8
+        values or floats between 0 and 1
+        Raises a queue.Full when the buffer blocks and stays full for
+        longer than the timeout.
+
+        The frame is converted right away, so only its uint8 bytes are
+        buffered. Frames which need no conversion (uint8 frames in the
+        pixel format of the pipe) are buffered as they are, and should
+        not be changed anymore after sending them. When the same few
+        frames are sent over and over, give each of them a version to
+        convert them only once (see TwitchOutputStream.send_video_frame).
 
         :param frame: array containing the frame.
-        :type frame: numpy array with shape (height, width, 3)
-            containing values between 0.0 and 1.0
+        :type frame: numpy array with shape (height, width, channels)
+            containing uint8 values or floats between 0.0 and 1.0
         :param frame_counter: frame position number within stream.
             Provide this when multi-threading to make sure frames don't
             switch position
         :type frame_counter: int
+        :param timeout: maximum number of seconds to wait for room in a
+            full buffer, or None to wait as long as needed
+        :type timeout: float
+        :param version: token for the content of the frame, None when
+            the frame should be converted again
+        :type version: any hashable value
+        :return: what happened to the frame, one of BUFFER_QUEUED,
+            BUFFER_DROPPED_OLDEST, BUFFER_DROPPED_NEWEST or BUFFER_MERGED
         """
+        self._check_frame_shape(frame)
         if frame_counter is None:
             frame_counter = self.frame_counter
             self.frame_counter += 1
+        if self.recorder is not None:
+            self.recorder.record_video_frame(frame, frame_counter)
+        data = self._timed('convert', self._frame_bytes, frame, version)
+        pool_frame = None
+        if self.frame_pool is not None and self.frame_pool.owns(frame):
+            if np.may_share_memory(data, frame):
+                # recycle the frame once it has been streamed
+                pool_frame = frame
+            else:
+                # the frame has been converted, it can be recycled now
+                self.frame_pool.release(frame)
+
+        return self._timed('enqueue', self.q_video.put, frame_counter,
+                           (pool_frame, data, monotonic()), timeout)
+
+    def acquire_frame(self, timeout=None):
+        """Get a preallocated frame to render into, which should be
+        added to the stream with commit_frame() afterwards. This waits
+        until a frame comes free when all frames of the pool are in use.
+        Raises a queue.Empty when no frame came free within the timeout.
+
+        :param timeout: maximum number of seconds to wait, or None to
+            wait as long as needed
+        :type timeout: float
+        :return: numpy array of dtype uint8 and shape
+            (height, width, channels)
+        """
+        return self.get_frame_pool().acquire(timeout=timeout)
+
+    def get_frame_pool(self, shared=False):
+        """Get the pool of preallocated frames used by acquire_frame(),
+        allocating it when it does not exist yet.
+        Raises a ValueError when shared memory is asked for, but the
+        pool has been allocated in private memory already.
+
+        :param shared: allocate the frames in shared memory, so other
+            processes can render into them
+        :type shared: boolean
+        :return: FramePool
+        """
+        if self.frame_pool is None:
+            with self._frame_pool_lock:
+                if self.frame_pool is None:
+                    self.frame_pool = FramePool(self.frame_shape,
+                                                self.frame_pool_size,
+                                                shared=shared)
+        if shared and not self.frame_pool.shared:
+            raise ValueError("The frame pool is in use already, and is "
+                             "not in shared memory")
+        return self.frame_pool
+
+    def commit_frame(self, frame, frame_counter=None, timeout=None,
+                     version=None):
+        """Add a frame obtained with acquire_frame() to the buffer. The
+        frame is recycled after it has been streamed, so it should not
+        be touched anymore after committing it.
+
+        :param frame: frame obtained with acquire_frame()
+        :type frame: numpy array
+        :param frame_counter: frame position number within stream.
+            Provide this when multi-threading to make sure frames don't
+            switch position
+        :type frame_counter: int
+        :param timeout: maximum number of seconds to wait for room in a
+            full buffer, or None to wait as long as needed
+        :type timeout: float
+        :param version: token for the content of the frame, see
+            send_video_frame()
+        :type version: any hashable value
+        :return: what happened to the frame, see send_video_frame()
+        """
+        assert self.frame_pool is not None and \
+            self.frame_pool.owns(frame), \
+            "Only frames obtained with acquire_frame() can be committed"
+        return self.send_video_frame(frame, frame_counter=frame_counter,
+                                     timeout=timeout, version=version)
 
-        self.q_video.put((frame_counter, frame))
+    def _discard_frame(self, item):
+        """
+        Recycle a frame which the video buffer dropped.
+
+        :param item: the (frame of the frame pool, converted frame, time
+            added) tuple in the buffer
+        :type item: tuple
+        """
+        self.release_frame(item[0])
+
+    def release_frame(self, frame):
+        """Give a frame obtained with acquire_frame() back without
+        streaming it.
+
+        :param frame: frame obtained with acquire_frame()
+        :type frame: numpy array
+        """
+        if self.frame_pool is not None and frame is not None:
+            self.frame_pool.release(frame)
 
     def send_audio(self,
                    left_channel,
                    right_channel,
-                   frame_counter=None):
+                   frame_counter=None,
+                   timeout=None):
         """Add the audio samples to the stream. The left and the right
         channel should have the same shape.
+        Raises a queue.Full when the buffer blocks and stays full for
+        longer than the timeout.
 
         :param left_channel: array containing the audio signal.
         :type left_channel: numpy array with shape (k, )
@@ -477,17 +3171,28 @@ class TwitchBufferedOutputStream(TwitchOutputStream):
             Provide this when multi-threading to make sure frames don't
             switch position
         :type frame_counter: int
+        :param timeout: maximum number of seconds to wait for room in a
+            full buffer, or None to wait as long as needed
+        :type timeout: float
+        :return: what happened to the fragment, one of BUFFER_QUEUED,
+            BUFFER_DROPPED_OLDEST, BUFFER_DROPPED_NEWEST or BUFFER_MERGED
         """
         if frame_counter is None:
             frame_counter = self.audio_frame_counter
             self.audio_frame_counter += 1
+        if self.recorder is not None:
+            self.recorder.record_audio(left_channel, right_channel,
+                                       frame_counter)
 
-        self.q_audio.put((frame_counter, left_channel, right_channel))
+        return self.q_audio.put(frame_counter,
+                                (left_channel, right_channel),
+                                timeout=timeout)
 
     def get_video_frame_buffer_state(self):
         """Find out how many video frames are left in the buffer.
-        The buffer should never run dry, or audio and video will go out
-        of sync. Likewise, the more filled the buffer, the higher the
+        The buffer should not run dry, or the last frame is shown again
+        and audio and video drift until av_sync has corrected it.
+        Likewise, the more filled the buffer, the higher the
         memory use and the delay between you putting your frame in the
         stream and the frame showing up on Twitch.
 
@@ -495,12 +3200,24 @@ class TwitchBufferedOutputStream(TwitchOutputStream):
         """
         return self.q_video.qsize()
 
+    def get_video_frame_buffer_nbytes(self):
+        """Find out how much memory the frames in the video buffer take.
+        A frame which is buffered more than once, like a cached frame, is
+        counted once.
+
+        :return: integer number of bytes
+        """
+        frames = dict((id(data), data)
+                      for _, data, _ in self.q_video.get_items())
+        return sum(data.nbytes for data in frames.values())
+
     def get_audio_buffer_state(self):
         """Find out how many audio fragments are left in the buffer.
-        The buffer should never run dry, or audio and video will go out
-        of sync. Likewise, the more filled the buffer, the higher the
-        memory use and the delay between you putting your frame in the
-        stream and the frame showing up on Twitch.
+        The buffer should not run dry, or silence is played and audio
+        and video drift until av_sync has corrected it. Likewise, the
+        more filled the buffer, the higher the memory use and the delay
+        between you putting your frame in the stream and the frame
+        showing up on Twitch.
 
         :return integer estimate of the number of audio fragments left.
         """
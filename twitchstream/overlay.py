@@ -0,0 +1,264 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the overlays which ffmpeg draws on top of the video
+of a stream. An overlay is read from a small file, which ffmpeg reloads
+every frame, so changing the text or the image on screen comes down to
+writing that file, without touching the frames in python.
+"""
+from __future__ import print_function, division
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+import numpy as np
+
+
+def escape_filter_value(value):
+    """
+    Escape a value for an option of a filter in an ffmpeg filter graph.
+    Values are escaped once for the filter options, and once for the
+    filter graph.
+
+    :param value: the value of the option
+    :type value: String
+    :return: the escaped value
+    """
+    value = str(value)
+    for special in '\\\':':
+        value = value.replace(special, '\\' + special)
+    for special in '\\\'[],;':
+        value = value.replace(special, '\\' + special)
+    return value
+
+
+def replace_file(path, data):
+    """
+    Replace the content of a file at once, so a reader never sees a file
+    which is half written.
+
+    :param path: the file to replace
+    :type path: String
+    :param data: the new content of the file
+    :type data: bytes
+    """
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(data)
+    os.replace(temporary_path, path)
+
+
+def encode_png(image):
+    """
+    Encode an image as a PNG file.
+
+    :param image: the image, RGB or RGBA
+    :type image: numpy array with shape (height, width, 3 or 4)
+        containing uint8 values
+    :return: bytes
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    if image.ndim != 3 or image.shape[2] not in (3, 4):
+        raise ValueError("Overlay images should have the shape (height, "
+                         "width, 3) or (height, width, 4), not %s"
+                         % (image.shape, ))
+    height, width, channels = image.shape
+    color_type = 2 if channels == 3 else 6
+
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + \
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    # every row starts with the filter type, 0 for no filter
+    rows = np.zeros((height, width * channels + 1), dtype=np.uint8)
+    rows[:, 1:] = image.reshape(height, width * channels)
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8,
+                                   color_type, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(rows.tobytes(), 1)),
+        chunk(b'IEND', b''),
+    ])
+
+
+class Overlay(object):
+    """
+    Something which ffmpeg draws on top of the video, read from a file
+    which is replaced whenever the overlay changes. The file lives in a
+    temporary directory, unless a path is given.
+
+    The same overlay can be used by several streams at once.
+
+    :param x: the horizontal position of the overlay (in pixels), or an
+        expression of the filter
+    :type x: int or String
+    :param y: the vertical position of the overlay (in pixels), or an
+        expression of the filter
+    :type y: int or String
+    :param path: the file to keep the overlay in
+    :type path: String
+    """
+    suffix = ''
+
+    def __init__(self, x=0, y=0, path=None):
+        self.x = x
+        self.y = y
+        self._directory = None
+        if path is None:
+            self._directory = tempfile.mkdtemp(prefix='twitchstream-')
+            path = os.path.join(self._directory, 'overlay' + self.suffix)
+        self.path = os.path.abspath(path)
+
+    def input_args(self, fps):
+        """
+        The ffmpeg arguments of the input which this overlay reads, if
+        any.
+
+        :param fps: the number of frames per second of the videostream
+        :type fps: float
+        :return: list of ffmpeg arguments
+        """
+        return []
+
+    def filter(self, source, target, input_label=None):
+        """
+        The part of the filter graph which draws this overlay.
+
+        :param source: the label of the video to draw on
+        :type source: String
+        :param target: the label of the video with the overlay
+        :type target: String
+        :param input_label: the label of the input of input_args()
+        :type input_label: String
+        :return: String
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Remove the temporary file of the overlay. Streams using the
+        overlay should be closed first.
+        """
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class TextOverlay(Overlay):
+    """
+    Text drawn by the drawtext filter of ffmpeg, e.g. the latest lines of
+    the chat or the tally of a vote. The drawtext filter needs an ffmpeg
+    built with libfreetype.
+
+    :param text: the text to show at first
+    :type text: String
+    :param fontsize: the size of the font (in pixels)
+    :type fontsize: int
+    :param fontcolor: the color of the text, in any ffmpeg color syntax
+    :type fontcolor: String
+    :param fontfile: the font file, None to let fontconfig find a font
+    :type fontfile: String
+    :param box: the color of a box behind the text, e.g. 'black@0.5',
+        None for no box
+    :type box: String
+
+    The position and the path are as for Overlay.
+    """
+    suffix = '.txt'
+
+    def __init__(self, text='', x=10, y=10, fontsize=24,
+                 fontcolor='white', fontfile=None, box=None, path=None):
+        super(TextOverlay, self).__init__(x, y, path)
+        self.fontsize = fontsize
+        self.fontcolor = fontcolor
+        self.fontfile = fontfile
+        self.box = box
+        self.text = None
+        self.update(text)
+
+    def update(self, text):
+        """
+        Show another text, from the next frame ffmpeg draws on.
+
+        :param text: the text, lines are separated by newlines
+        :type text: String
+        """
+        self.text = text
+        replace_file(self.path, text.encode('utf-8'))
+
+    def filter(self, source, target, input_label=None):
+        options = [
+            ('textfile', self.path),
+            ('reload', 1),
+            ('x', self.x),
+            ('y', self.y),
+            ('fontsize', self.fontsize),
+            ('fontcolor', self.fontcolor),
+        ]
+        if self.fontfile is not None:
+            options.append(('fontfile', self.fontfile))
+        if self.box is not None:
+            options.extend([('box', 1), ('boxcolor', self.box)])
+        return '[%s]drawtext=%s[%s]' % (
+            source,
+            ':'.join('%s=%s' % (name, escape_filter_value(value))
+                     for name, value in options),
+            target)
+
+
+class ImageOverlay(Overlay):
+    """
+    An image drawn on top of the video by the overlay filter of ffmpeg,
+    e.g. a logo or a graph. ffmpeg reads the image as an input which is
+    opened again for every frame, so it picks up a new image within a
+    few frames. Images with an alpha channel are blended with the video.
+
+    :param image: the image to show at first, None for a transparent
+        pixel
+    :type image: numpy array with shape (height, width, 3 or 4)
+        containing uint8 values
+
+    The position and the path are as for Overlay.
+    """
+    suffix = '.png'
+
+    def __init__(self, image=None, x=0, y=0, path=None):
+        super(ImageOverlay, self).__init__(x, y, path)
+        if image is None:
+            image = np.zeros((1, 1, 4), dtype=np.uint8)
+        self.update(image)
+
+    def update(self, image):
+        """
+        Show another image, from the next frame ffmpeg reads it on.
+
+        :param image: the image, RGB or RGBA
+        :type image: numpy array with shape (height, width, 3 or 4)
+            containing uint8 values
+        """
+        replace_file(self.path, encode_png(image))
+
+    def input_args(self, fps):
+        # the image2 demuxer decodes a looped image only once, looping
+        # the whole input reads the file again
+        return [
+            '-stream_loop', '-1',
+            '-f', 'image2',
+            '-framerate', '%d' % fps,
+            '-i', self.path,
+        ]
+
+    def filter(self, source, target, input_label=None):
+        # the image loops forever, stop with the video
+        return '[%s][%s]overlay=x=%s:y=%s:shortest=1[%s]' % (
+            source, input_label, escape_filter_value(self.x),
+            escape_filter_value(self.y), target)
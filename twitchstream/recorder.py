@@ -0,0 +1,300 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the code to record the frames, the audio and the chat
+messages of a streaming session to a file, and to replay that file into
+another stream later on. Replaying a recording into a stream which
+writes to a local file gives a load test of the whole pipeline which can
+be repeated offline.
+
+A recording is a header followed by records. Every record starts with a
+fixed size header and holds a frame, an audio fragment or a list of chat
+messages, starting on an aligned offset. This way the frames and the
+audio are read straight from the memory mapped file, without copying.
+"""
+from __future__ import print_function, division
+import json
+import struct
+import threading
+import time
+from time import monotonic
+
+import numpy as np
+
+# The first bytes of every recording, with the version of the format
+MAGIC = b'TWREC\x00\x01\x00'
+
+# The header of a record: the kind of record, the numpy type code of the
+# samples, the frame counter (-1 for None), the time since the start of
+# the recording (in seconds) and the size of the data.
+RECORD_HEADER = struct.Struct('<cc6xqdQ')
+
+# The data of every record starts at a multiple of this many bytes
+RECORD_ALIGNMENT = 32
+
+RECORD_VIDEO = b'V'
+RECORD_AUDIO = b'A'
+RECORD_CHAT = b'C'
+
+
+def _padding(size):
+    return -size % RECORD_ALIGNMENT
+
+
+class SessionRecorder(object):
+    """
+    Records everything sent to a TwitchBufferedOutputStream, and the
+    messages received by a TwitchChatStream, with the time they came in.
+    Frames are recorded as uint8 frames, before they are converted for
+    ffmpeg.
+
+    The recorder is thread safe, and can be used as a context manager
+    which closes the file and detaches from the streams.
+
+    :param path: the file to record to, it is overwritten
+    :type path: String
+    :param stream: the stream to record the frames and the audio of
+    :type stream: TwitchBufferedOutputStream
+    :param chat: the chat to record the received messages of
+    :type chat: TwitchChatStream
+    """
+    def __init__(self, path, stream=None, chat=None):
+        self.path = path
+        self.stream = stream
+        self.chat = chat
+        self.records = 0
+        self._lock = threading.Lock()
+        info = {}
+        if stream is not None:
+            info = {
+                'frame_shape': list(stream.frame_shape),
+                'fps': stream.fps,
+            }
+        info = json.dumps(info).encode('utf-8')
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC + struct.pack('<Q', len(info)) + info +
+                         b'\x00' * _padding(len(info)))
+        self._start_time = monotonic()
+        if stream is not None:
+            stream.recorder = self
+        if chat is not None:
+            chat.recorder = self
+
+    def _record(self, kind, data, frame_counter=None, type_code=b'\x00'):
+        """
+        Add a record, stamped with the current time.
+
+        :param kind: RECORD_VIDEO, RECORD_AUDIO or RECORD_CHAT
+        :type kind: bytes
+        :param data: the data of the record
+        :type data: bytes or a contiguous array
+        """
+        data = memoryview(data).cast('B')
+        header = RECORD_HEADER.pack(
+            kind, type_code,
+            -1 if frame_counter is None else frame_counter,
+            monotonic() - self._start_time, len(data))
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(header)
+            self._file.write(data)
+            self._file.write(b'\x00' * _padding(len(data)))
+            self.records += 1
+
+    def record_video_frame(self, frame, frame_counter=None):
+        """
+        Record a frame sent to the stream.
+
+        :param frame: the frame
+        :type frame: numpy array with shape (height, width, channels)
+            containing uint8 values or floats between 0.0 and 1.0
+        :param frame_counter: the frame counter of the frame
+        :type frame_counter: int
+        """
+        from .outputvideo import TwitchOutputStream
+        self._record(RECORD_VIDEO, TwitchOutputStream._as_uint8(frame),
+                     frame_counter)
+
+    def record_audio(self, left_channel, right_channel, frame_counter=None):
+        """
+        Record an audio fragment sent to the stream, in the type of
+        its samples.
+
+        :param left_channel: the samples of the left channel
+        :type left_channel: numpy array with shape (k, )
+        :param right_channel: the samples of the right channel
+        :type right_channel: numpy array with shape (k, )
+        :param frame_counter: the frame counter of the fragment
+        :type frame_counter: int
+        """
+        samples = np.ascontiguousarray(np.stack([left_channel,
+                                                 right_channel]))
+        self._record(RECORD_AUDIO, samples, frame_counter,
+                     samples.dtype.char.encode('ascii'))
+
+    def record_chat_messages(self, messages):
+        """
+        Record the chat messages received in one go.
+
+        :param messages: the messages, see
+            TwitchChatStream.twitch_receive_messages
+        :type messages: list of dicts
+        """
+        if messages:
+            self._record(RECORD_CHAT,
+                         json.dumps(messages).encode('utf-8'))
+
+    def close(self):
+        """
+        Stop recording, and close the file.
+        """
+        for source in (self.stream, self.chat):
+            if source is not None and \
+                    getattr(source, 'recorder', None) is self:
+                source.recorder = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class SessionReplayer(object):
+    """
+    Reads a recording made by a SessionRecorder, and replays it. The
+    file is memory mapped, the frames and the audio fragments which are
+    replayed are views on the file.
+
+    Raises a ValueError when the file is not a recording.
+
+    :param path: the recording
+    :type path: String
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._data[:len(MAGIC)]) != MAGIC:
+            raise ValueError("%s is not a recording of a session" % path)
+        offset = len(MAGIC) + 8
+        info_size, = struct.unpack('<Q', bytes(self._data[len(MAGIC):
+                                                          offset]))
+        self.info = json.loads(
+            bytes(self._data[offset:offset + info_size]).decode('utf-8'))
+        offset += info_size + _padding(info_size)
+        # (kind, type code, frame counter, time, offset, size) tuples
+        self.index = []
+        while offset + RECORD_HEADER.size <= len(self._data):
+            kind, type_code, frame_counter, timestamp, size = \
+                RECORD_HEADER.unpack(bytes(
+                    self._data[offset:offset + RECORD_HEADER.size]))
+            offset += RECORD_HEADER.size
+            if offset + size > len(self._data):
+                break   # the recording was cut off
+            self.index.append((kind, type_code, frame_counter, timestamp,
+                               offset, size))
+            offset += size + _padding(size)
+
+    def get_duration(self):
+        """
+        :return: the time of the last record, in seconds
+        """
+        return self.index[-1][3] if self.index else 0.
+
+    def get_counts(self):
+        """
+        :return: dict with the number of 'video', 'audio' and 'chat'
+            records
+        """
+        kinds = [record[0] for record in self.index]
+        return {
+            'video': kinds.count(RECORD_VIDEO),
+            'audio': kinds.count(RECORD_AUDIO),
+            'chat': kinds.count(RECORD_CHAT),
+        }
+
+    def records(self):
+        """
+        Iterate over the records in the order they were recorded.
+
+        :return: iterator over (kind, time, frame counter, data) tuples.
+            The data is a frame with the shape of the recorded stream for
+            RECORD_VIDEO, a (left channel, right channel) tuple for
+            RECORD_AUDIO and a list of messages for RECORD_CHAT.
+        """
+        frame_shape = tuple(self.info.get('frame_shape', (-1, )))
+        for kind, type_code, frame_counter, timestamp, offset, size \
+                in self.index:
+            data = self._data[offset:offset + size]
+            if kind == RECORD_VIDEO:
+                data = data.reshape(frame_shape)
+            elif kind == RECORD_AUDIO:
+                data = data.view(np.dtype(type_code.decode('ascii')))
+                data = (data[:len(data) // 2], data[len(data) // 2:])
+            else:
+                data = json.loads(bytes(data).decode('utf-8'))
+            if frame_counter == -1:
+                frame_counter = None
+            yield kind, timestamp, frame_counter, data
+
+    def replay(self, stream=None, on_chat=None, speed=1.):
+        """
+        Feed the recording into a stream at the pace it was recorded,
+        sped up by the given factor. The frames and the audio keep the
+        order they were recorded in, and are numbered by the stream
+        again. To test the pipeline offline, replay into a stream
+        writing to a local file, e.g.
+        outputs=[('/dev/null', 'flv')].
+
+        Raises a ValueError when the frames of the stream have another
+        shape than the recorded frames.
+
+        :param stream: the stream to send the frames and the audio to
+        :type stream: TwitchBufferedOutputStream
+        :param on_chat: function called with every list of recorded
+            chat messages
+        :type on_chat: callable
+        :param speed: how many times faster than recorded to replay,
+            None to replay as fast as the stream takes the data
+        :type speed: float
+        :return: dict with the keys 'video', 'audio' and 'chat' (the
+            number of records replayed), 'duration' (the seconds the
+            replay took) and 'max_lateness' (the seconds the replay fell
+            behind the recorded pace at most)
+        """
+        if stream is not None and 'frame_shape' in self.info and \
+                tuple(self.info['frame_shape']) != stream.frame_shape:
+            raise ValueError("The frames were recorded with shape %s, but "
+                             "the stream sends frames of shape %s"
+                             % (tuple(self.info['frame_shape']),
+                                stream.frame_shape))
+        counts = {'video': 0, 'audio': 0, 'chat': 0}
+        max_lateness = 0.
+        start_time = monotonic()
+        for kind, timestamp, _, data in self.records():
+            if speed is not None:
+                lateness = monotonic() - start_time - timestamp / speed
+                if lateness < 0:
+                    time.sleep(-lateness)
+                max_lateness = max(max_lateness, lateness)
+            if kind == RECORD_VIDEO:
+                if stream is not None:
+                    stream.send_video_frame(data)
+                counts['video'] += 1
+            elif kind == RECORD_AUDIO:
+                if stream is not None and stream.audio_enabled:
+                    stream.send_audio(*data)
+                counts['audio'] += 1
+            else:
+                if on_chat is not None:
+                    on_chat(data)
+                counts['chat'] += 1
+        counts['duration'] = monotonic() - start_time
+        counts['max_lateness'] = max_lateness
+        return counts
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the code to render frames in several processes at
+once. The processes render straight into the preallocated frames of a
+TwitchBufferedOutputStream, which live in shared memory, so frames are
+never pickled between processes.
+"""
+from __future__ import print_function, division
+import collections
+import multiprocessing
+import signal
+import threading
+import queue
+
+import numpy as np
+
+# The frames and the render function of a worker process
+_worker_frames = None
+_worker_render = None
+
+
+def _init_worker(buffer, shape, render):
+    """
+    Set up a worker process of a RenderPool.
+    """
+    global _worker_frames, _worker_render
+    # interrupting the stream is up to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_frames = np.frombuffer(buffer, dtype=np.uint8).reshape(
+        (-1, ) + tuple(shape))
+    _worker_render = render
+
+
+def _render_frame(task):
+    """
+    Render one frame in a worker process.
+
+    :param task: the index of the frame in the frame pool, and the
+        frame counter of the frame
+    :type task: tuple
+    """
+    index, frame_counter = task
+    _worker_render(frame_counter, _worker_frames[index])
+
+
+class RenderPool(object):
+    """
+    Render the frames of a TwitchBufferedOutputStream in a pool of
+    processes, so rendering with numpy is not limited to a single core
+    by the GIL.
+
+    The render function is called with the frame counter and a frame of
+    the frame pool of the stream (see acquire_frame), and should draw
+    the frame into that uint8 array. The frame pool of the stream is
+    allocated in shared memory for this, so it cannot be in use already.
+    The frames are committed to the stream in the order of their frame
+    counter, however fast every single frame renders.
+
+    When the processes are spawned instead of forked (the default on
+    some platforms), the render function has to be picklable, i.e. a
+    function defined at the top level of a module.
+
+    :param stream: the stream to render the frames for
+    :type stream: TwitchBufferedOutputStream
+    :param render: function(frame_counter, frame) drawing a frame
+    :type render: callable
+    :param processes: the number of processes, by default the number of
+        cores
+    :type processes: int
+    :param context: the multiprocessing context to start the processes
+        with, by default the multiprocessing module itself
+    """
+    def __init__(self, stream, render, processes=None, context=None):
+        self.stream = stream
+        self.frame_pool = stream.get_frame_pool(shared=True)
+        if context is None:
+            context = multiprocessing
+        self.pool = context.Pool(processes,
+                                 initializer=_init_worker,
+                                 initargs=(self.frame_pool.buffer,
+                                           self.frame_pool.shape,
+                                           render))
+        self.frames_rendered = 0
+        self._closed = False
+
+    def _acquire_frame(self, stopped):
+        """
+        Wait for a free frame in the frame pool of the stream.
+
+        :return: the frame, None when rendering was stopped
+        """
+        while not self._closed and not stopped.is_set():
+            try:
+                return self.stream.acquire_frame(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def render_frames(self, count=None):
+        """
+        Render frames and commit them to the stream, until count frames
+        have been rendered or the pool is closed. The frames get the next
+        frame counters of the stream. Exceptions raised by the render
+        function are raised here.
+
+        :param count: the number of frames to render, None to keep on
+            rendering until the pool is closed
+        :type count: int
+        :return: the number of frames committed to the stream
+        """
+        # frames which are being rendered, in the order of their frame
+        # counters, which is the order in which the pool returns them
+        pending = collections.deque()
+        lock = threading.Lock()
+        stopped = threading.Event()
+
+        def tasks():
+            # runs in a thread of the process pool
+            rendered = 0
+            while count is None or rendered < count:
+                frame = self._acquire_frame(stopped)
+                if frame is None:
+                    return
+                with lock:
+                    if stopped.is_set():
+                        self.stream.release_frame(frame)
+                        return
+                    frame_counter = self.stream.frame_counter
+                    self.stream.frame_counter += 1
+                    pending.append((frame, frame_counter))
+                rendered += 1
+                yield self.frame_pool.index(frame), frame_counter
+
+        committed = 0
+        results = self.pool.imap(_render_frame, tasks())
+        try:
+            while True:
+                try:
+                    results.next(timeout=0.1)
+                except StopIteration:
+                    break
+                except multiprocessing.TimeoutError:
+                    if self._closed:
+                        break
+                    continue
+                frame, frame_counter = pending.popleft()
+                self.stream.commit_frame(frame, frame_counter=frame_counter)
+                committed += 1
+                self.frames_rendered += 1
+        finally:
+            with lock:
+                stopped.set()
+                # frames which were not committed go back to the pool
+                while pending:
+                    self.stream.release_frame(pending.popleft()[0])
+        return committed
+
+    def close(self):
+        """
+        Stop rendering and stop the processes.
+        """
+        self._closed = True
+        self.pool.terminate()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
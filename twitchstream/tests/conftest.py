@@ -3,6 +3,11 @@
 """
 Configuration of the testing
 """
+import os
+import stat
+import sys
+
+import numpy as np
 import pytest
 
 
@@ -26,3 +31,114 @@ def pytest_runtest_setup(item):
     if 'slow' in item.keywords and \
             not item.config.getoption("--runslow"):
         pytest.skip("need --runslow option to run")
+
+
+# stands in for ffmpeg, see stand_in_ffmpeg.py
+STAND_IN_FFMPEG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'stand_in_ffmpeg.py')
+
+
+@pytest.fixture
+def ffmpeg(tmpdir):
+    """
+    The stand-in for ffmpeg, run by the python running the tests
+    :param tmpdir:
+    :return: the path of the stand-in
+    """
+    with open(STAND_IN_FFMPEG) as f:
+        script = f.read().split('\n', 1)[1]
+    path = str(tmpdir.join('ffmpeg'))
+    with open(path, 'w') as f:
+        f.write('#!%s\n' % sys.executable + script)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+class StandInStreams(object):
+    """
+    Opens output streams to the stand-in for ffmpeg. Every stream has a
+    file of its own, to which the stand-in copies the video. The audio
+    is copied to the same file with '.audio' appended.
+    """
+    def __init__(self, ffmpeg, tmpdir):
+        self.ffmpeg = ffmpeg
+        self.tmpdir = tmpdir
+        self.streams = []
+        self.opened = 0
+
+    def open(self, stream_class, ticking=True, **kwargs):
+        """
+        Open a stream, the keyword arguments are passed on to the stream.
+        This waits until the stand-in has reported its progress, after
+        which it finishes reading on sigint like ffmpeg does.
+
+        :param stream_class: the class of the stream
+        :param ticking: False to give a paced stream a pacer which never
+            calls it, so the test can call its ticks itself
+        :return: the stream
+        """
+        import time
+        from twitchstream.outputvideo import Pacer
+        kwargs.setdefault('twitch_stream_key', None)
+        kwargs.setdefault('ffmpeg_binary', self.ffmpeg)
+        kwargs.setdefault('outputs', [
+            (str(self.tmpdir.join('output%d' % self.opened)), 'rawvideo')])
+        self.opened += 1
+        if not ticking:
+            kwargs['pacer'] = Pacer()
+            kwargs['pacer'].stop()
+        stream = stream_class(**kwargs)
+        self.streams.append(stream)
+        deadline = time.time() + 5.
+        while not stream.get_encoder_stats() and time.time() < deadline:
+            time.sleep(0.01)
+        return stream
+
+    def close(self, stream):
+        """
+        Close a stream, and wait until the stand-in has copied everything
+        which was written to it.
+        """
+        if stream in self.streams:
+            self.streams.remove(stream)
+        stream.__exit__(None, None, None)
+        # the stand-in keeps on reading until its inputs are closed
+        stream.ffmpeg_process.stdin.close()
+        if stream.audio_pipe is not None:
+            os.close(stream.audio_pipe)
+            stream.audio_pipe = None
+        stream.ffmpeg_process.wait()
+
+    def read_video(self, stream):
+        """
+        :return: the bytes of the video the current ffmpeg process of a
+            stream got so far
+        """
+        with open(stream.outputs[0][0], 'rb') as f:
+            return f.read()
+
+    def read_audio(self, stream):
+        """
+        :return: the audio samples the current ffmpeg process of a stream
+            got so far, as an int16 array of shape (k, 2)
+        """
+        with open(stream.outputs[0][0] + '.audio', 'rb') as f:
+            return np.frombuffer(f.read(), dtype=np.int16).reshape((-1, 2))
+
+
+@pytest.fixture
+def streams(ffmpeg, tmpdir):
+    """
+    Open output streams to the stand-in for ffmpeg, see StandInStreams.
+    The streams which are still open after the test are closed.
+    :param ffmpeg:
+    :param tmpdir:
+    :return: StandInStreams
+    """
+    stand_in = StandInStreams(ffmpeg, tmpdir)
+    yield stand_in
+    for stream in list(stand_in.streams):
+        try:
+            stand_in.close(stream)
+        except Exception:
+            stream.ffmpeg_process.kill()
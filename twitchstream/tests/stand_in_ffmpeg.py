@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stands in for ffmpeg in the tests and the benchmarks. It reads the video
+from stdin and the audio from the pipes given as inputs. When the
+destination, the last argument, is a file name, the video is copied to
+that file and the audio to the same file with '.audio' appended,
+otherwise everything is thrown away. This way the benchmarks measure the
+python side of the pipeline only, and the tests can check what was
+written to ffmpeg.
+
+Like ffmpeg, it reports its progress on stdout, once.
+"""
+import os
+import signal
+import sys
+import threading
+
+
+def copy(fd, path):
+    output = open(path, 'wb') if path is not None else None
+    try:
+        while True:
+            data = os.read(fd, 1 << 20)
+            if not data:
+                return
+            if output is not None:
+                output.write(data)
+                output.flush()
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    # like ffmpeg, finish reading on sigint
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    audio = [int(arg[len('pipe:'):]) for arg in sys.argv[1:]
+             if arg.startswith('pipe:') and arg != 'pipe:1']
+    destination = sys.argv[-1]
+    if destination == '-':
+        destination = None
+    threads = [threading.Thread(target=copy, args=(0, destination))]
+    threads.extend(threading.Thread(
+        target=copy, args=(fd, destination and destination + '.audio'))
+        for fd in audio)
+    for thread in threads:
+        thread.start()
+    sys.stdout.write('frame=1\nout_time_us=40000\nspeed=1x\n'
+                     'progress=continue\n')
+    sys.stdout.flush()
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,43 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for asyncstream.py
+"""
+import asyncio
+import os
+
+import numpy as np
+
+
+def test_async_stream(tmpdir, ffmpeg):
+    """
+    Test AsyncTwitchOutputStream paces frames and audio on the event loop
+    """
+    from twitchstream.asyncstream import AsyncTwitchOutputStream
+    output = str(tmpdir.join('output'))
+
+    async def stream():
+        async with AsyncTwitchOutputStream(
+                twitch_stream_key=None, width=4, height=2, fps=50.,
+                ffmpeg_binary=ffmpeg, enable_audio=True,
+                outputs=[(output, 'rawvideo')],
+                video_buffer_size=2) as stream:
+            for i in range(10):
+                await stream.send_video_frame(np.zeros((2, 4, 3)))
+                await stream.send_audio(np.zeros(882), np.zeros(882))
+            while stream.get_video_frame_buffer_state():
+                await asyncio.sleep(0.01)
+            ticks = stream.ticks
+        assert stream.get_encoder_stats()['frames'] == 1
+        return ticks
+
+    loop = asyncio.new_event_loop()
+    try:
+        ticks = loop.run_until_complete(stream())
+    finally:
+        loop.close()
+    video = os.path.getsize(output)
+    audio = os.path.getsize(output + '.audio')
+    assert ticks >= 10
+    assert video == ticks * 2 * 4 * 3
+    assert audio == ticks * 882 * 4
@@ -38,3 +38,18 @@ def test_logged_in_successful():
     res = TwitchChatStream._logged_in_successful(
         ":tmi.twitch.tv 001 sdsd :>")
     assert res is True
+
+
+def test_lazy_imports():
+    """
+    Test the chat can be used without importing numpy and requests
+    """
+    import subprocess
+    import sys
+    subprocess.check_call([
+        sys.executable, '-c',
+        'import sys, twitchstream, twitchstream.chat; '
+        'assert "numpy" not in sys.modules; '
+        'assert "requests" not in sys.modules; '
+        'twitchstream.outputvideo; '
+        'assert "numpy" in sys.modules'])
@@ -0,0 +1,70 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for ingest.py
+"""
+import json
+import socket
+import time
+
+
+def test_ingest_selector(tmpdir):
+    """
+    Test IngestSelector probes the servers and caches the fastest one
+    """
+    from twitchstream.ingest import IngestSelector, file_source
+
+    listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening.bind(('127.0.0.1', 0))
+    listening.listen(1)
+    closed = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    closed.bind(('127.0.0.1', 0))
+    ingests = [
+        {'name': 'unreachable',
+         'url_template': 'rtmp://127.0.0.1:%d/app/{stream_key}'
+                         % closed.getsockname()[1]},
+        {'name': 'local',
+         'url_template': 'rtmp://127.0.0.1:%d/app/{stream_key}'
+                         % listening.getsockname()[1]},
+    ]
+    source_file = tmpdir.join('ingests.json')
+    source_file.write(json.dumps({'ingests': ingests}))
+    cache_file = tmpdir.join('cache', 'ingests.json')
+
+    try:
+        selector = IngestSelector(source=file_source(str(source_file)),
+                                  cache_file=str(cache_file))
+        assert selector.get_closest_ingest()['name'] == 'local'
+        assert selector.get_url('key') == \
+            'rtmp://127.0.0.1:%d/app/key' % listening.getsockname()[1]
+        assert json.loads(cache_file.read())['fastest']['name'] == 'local'
+    finally:
+        listening.close()
+        closed.close()
+
+    def failing_source():
+        raise AssertionError("the source should not be used")
+
+    # a fresh cache is used without asking the source
+    selector = IngestSelector(source=failing_source,
+                              cache_file=str(cache_file))
+    assert selector.get_closest_ingest()['name'] == 'local'
+
+    # an expired cache is still used while it is refreshed
+    calls = []
+
+    def source():
+        calls.append(1)
+        return ingests[:1]
+
+    selector = IngestSelector(source=source, cache_file=str(cache_file),
+                              ttl=0., probe_count=0)
+    time.sleep(0.01)
+    assert selector.get_closest_ingest()['name'] == 'local'
+    for _ in range(100):
+        if json.loads(cache_file.read())['fastest']['name'] != 'local':
+            break
+        time.sleep(0.01)
+    assert calls == [1]
+    assert json.loads(cache_file.read())['fastest']['name'] == \
+        'unreachable'
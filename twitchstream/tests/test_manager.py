@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for manager.py
+"""
+import time
+
+import numpy as np
+
+
+def test_stream_manager(tmpdir, ffmpeg):
+    """
+    Test StreamManager shares its pacer and enforces its budget
+    """
+    from twitchstream.manager import StreamManager
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    with StreamManager(max_streams=2, encoder_threads=1,
+                       video_buffer_size=3,
+                       ingest_selector=object()) as manager:
+        for name in ('a', 'b'):
+            stream = manager.add_stream(
+                name, stream_class=TwitchBufferedOutputStream,
+                twitch_stream_key=None, width=4, height=2,
+                ffmpeg_binary=ffmpeg, enable_audio=False,
+                outputs=[(str(tmpdir.join(name)), 'rawvideo')])
+            assert stream.pacer is manager.pacer
+            assert stream.ingest_selector is manager.ingest_selector
+            assert stream.encoder_profile.get_threads() == 1
+            assert stream.q_video.maxsize == 3
+        try:
+            manager.add_stream('c', stream_class=TwitchBufferedOutputStream,
+                               twitch_stream_key=None, ffmpeg_binary=ffmpeg)
+            assert False, "the manager should be full"
+        except ValueError:
+            pass
+
+        manager.get_stream('a').send_video_frame(
+            np.zeros((2, 4, 3)), frame_counter=100)
+        health = manager.get_health()
+        assert health['streams'] == 2 and health['running'] == 2
+        assert health['buffered_frames'] <= 1
+        assert manager.get_stats()['b']['av_drift'] is None
+
+        # the other stream keeps on streaming
+        stream_a, stream_b = manager.get_stream('a'), manager.get_stream('b')
+        manager.remove_stream('a')
+        assert sorted(manager.streams) == ['b']
+        ticks_a, ticks_b = stream_a.ticks, stream_b.ticks
+        time.sleep(0.2)
+        assert stream_a.ticks <= ticks_a + 1
+        assert stream_b.ticks > ticks_b
+    assert not manager.streams
+
+
+def test_recovery_off_the_pacer(tmpdir, ffmpeg):
+    """
+    Test a stream restarting ffmpeg does not hold up the other streams
+    on the shared pacer
+    """
+    import threading
+    from twitchstream.manager import StreamManager
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    restarting = threading.Event()
+
+    class SlowRestartStream(TwitchBufferedOutputStream):
+        def reset(self):
+            if self.ffmpeg_process is not None:
+                restarting.set()
+                time.sleep(0.5)
+            super(SlowRestartStream, self).reset()
+
+    with StreamManager(ingest_selector=object()) as manager:
+        for name in ('a', 'b'):
+            manager.add_stream(
+                name, stream_class=SlowRestartStream,
+                twitch_stream_key=None, width=4, height=2, fps=50.,
+                ffmpeg_binary=ffmpeg, enable_audio=True, auto_recover=True,
+                outputs=[(str(tmpdir.join(name)), 'rawvideo')])
+        stream_a, stream_b = manager.get_stream('a'), manager.get_stream('b')
+        time.sleep(0.1)
+        process = stream_a.ffmpeg_process
+        process.kill()
+        process.wait()
+        assert restarting.wait(5.)
+        ticks_a, ticks_b = stream_a.ticks, stream_b.ticks
+        time.sleep(0.2)
+        # the other stream keeps on streaming, the restarting one waits
+        assert stream_b.ticks >= ticks_b + 5
+        assert stream_a.ticks == ticks_a and stream_a.recoveries == 0
+        deadline = time.time() + 5.
+        while stream_a.recoveries == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert stream_a.ffmpeg_process is not process
+        assert stream_a.recoveries == 1
+        ticks_a = stream_a.ticks
+        time.sleep(0.1)
+        assert stream_a.ticks > ticks_a
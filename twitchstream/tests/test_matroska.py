@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for matroska.py
+"""
+import numpy as np
+
+
+def test_matroska():
+    """
+    Test the headers of a Matroska stream and its frames
+    """
+    from twitchstream import matroska
+    assert matroska.encode_size(3) == b'\x01\x00\x00\x00\x00\x00\x00\x03'
+    assert matroska.uint_element(b'\xd7', 0) == \
+        b'\xd7' + matroska.encode_size(1) + b'\x00'
+    assert matroska.uint_element(b'\xd7', 300) == \
+        b'\xd7' + matroska.encode_size(2) + b'\x01\x2c'
+
+    header = matroska.header(64, 48, 'rgb24')
+    assert header.startswith(matroska.EBML)
+    assert matroska.SEGMENT + matroska.UNKNOWN_SIZE in header
+    assert b'V_UNCOMPRESSED' in header and b'RGB\x18' in header
+
+    frame_header = matroska.frame_header(1500, 9216)
+    assert frame_header.startswith(matroska.CLUSTER)
+    # the size of the cluster covers the frame written after the header
+    assert int.from_bytes(frame_header[5:12], 'big') == \
+        len(frame_header) - 12 + 9216
+    assert frame_header.endswith(b'\x81\x00\x00\x80')
+
+
+def _read_clusters(data, header_size):
+    """
+    Read the timestamps and the frames of the clusters written after the
+    header of a Matroska stream.
+
+    :return: list of (timestamp, frame) tuples
+    """
+    import struct
+    from twitchstream import matroska
+    clusters = []
+    offset = header_size
+    while offset < len(data):
+        assert data[offset:offset + 4] == matroska.CLUSTER
+        size, = struct.unpack('>Q', b'\x00' + data[offset + 5:offset + 12])
+        cluster = data[offset + 12:offset + 12 + size]
+        assert cluster[:1] == matroska.TIMECODE
+        timecode_size = cluster[8]
+        timestamp = int.from_bytes(cluster[9:9 + timecode_size], 'big')
+        block = cluster[9 + timecode_size:]
+        assert block[:1] == matroska.SIMPLE_BLOCK
+        clusters.append((timestamp, block[13:]))
+        offset += 12 + size
+    return clusters
+
+
+def test_vfr_stream(streams):
+    """
+    Test a vfr stream writes increasing timestamps starting from 0, and
+    sends the last frame again when no frame comes in for keepalive
+    seconds
+    """
+    import time
+    from twitchstream import matroska
+    from twitchstream.outputvideo import TwitchOutputStream
+    stream = streams.open(TwitchOutputStream, width=4, height=2,
+                          enable_audio=False, vfr=True, keepalive=0.2)
+    # a duplicate and a timestamp going backwards, then a pause
+    pts = [10., 10.5, 10.5, 10.2, 20.]
+    for i, frame_pts in enumerate(pts):
+        stream.send_video_frame(np.full((2, 4, 3), i, dtype=np.uint8),
+                                pts=frame_pts)
+    time.sleep(0.7)
+    streams.close(stream)
+    data = streams.read_video(stream)
+    header = matroska.header(4, 2, 'rgb24')
+    assert data.startswith(header)
+    clusters = _read_clusters(data, len(header))
+    timestamps = [timestamp for timestamp, _ in clusters]
+    assert timestamps[:5] == [0, 500, 501, 502, 10000]
+    assert [frame[0] for _, frame in clusters[:5]] == [0, 1, 2, 3, 4]
+    # the last frame is sent again, keepalive seconds apart
+    repeats = clusters[5:]
+    assert 1 <= len(repeats) <= 3
+    for (timestamp, frame), previous in zip(repeats, timestamps[4:]):
+        assert timestamp - previous >= 200
+        assert frame == clusters[4][1]
@@ -3,3 +3,789 @@
 """
 Tests for outputvideo.py
 """
+import json
+import os
+
+import numpy as np
+
+
+def _wait_for(condition, timeout=5.):
+    """
+    Wait until a condition holds, or the timeout passes.
+    """
+    import time
+    end_time = time.time() + timeout
+    while not condition() and time.time() < end_time:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_as_uint8():
+    """
+    Test TwitchOutputStream._as_uint8
+    """
+    from twitchstream.outputvideo import TwitchOutputStream
+    frame = np.arange(24, dtype=np.uint8).reshape((2, 4, 3))
+    res = TwitchOutputStream._as_uint8(frame)
+    assert res.dtype == np.uint8
+    assert np.shares_memory(res, frame)
+
+    frame = np.array([[[-0.5, 0.0, 0.5], [1.0, 1.5, 0.25]]])
+    res = TwitchOutputStream._as_uint8(frame)
+    assert res.dtype == np.uint8
+    assert res.tolist() == [[[0, 0, 127], [255, 255, 63]]]
+
+
+def test_frame_pool():
+    """
+    Test FramePool
+    """
+    import pytest
+    import queue
+    from twitchstream.outputvideo import FramePool
+    pool = FramePool((2, 4, 3), 2)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first.dtype == np.uint8 and first.shape == (2, 4, 3)
+    assert first is not second
+    assert pool.owns(first) and not pool.owns(first.copy())
+    assert pool.get_free_count() == 0
+    with pytest.raises(queue.Empty):
+        pool.acquire(timeout=0.01)
+
+    pool.release(first)
+    pool.release(first)     # releasing twice is ignored
+    pool.release(np.empty((2, 4, 3), dtype=np.uint8))
+    assert pool.get_free_count() == 1
+    assert pool.acquire() is first
+
+
+def test_pacer_catchup():
+    """
+    Test the catch-up policies of Pacer
+    """
+    from twitchstream.outputvideo import Pacer, _PacerTask, monotonic
+    calls = []
+
+    def callback(repeat):
+        calls.append(repeat)
+        return 0.1
+
+    pacer = Pacer()
+    try:
+        start = monotonic() - 1.0
+        task = _PacerTask(callback, 'burst', start)
+        assert pacer._call(task)
+        assert calls == [False]
+        assert abs(task.deadline - (start + 0.1)) < 1e-9
+
+        del calls[:]
+        task = _PacerTask(callback, 'skip', start)
+        assert pacer._call(task)
+        assert calls == [False]
+        assert monotonic() - 0.1 <= task.deadline <= monotonic()
+
+        del calls[:]
+        task = _PacerTask(callback, 'duplicate', start)
+        assert pacer._call(task)
+        assert calls[0] is False and len(calls) > 5
+        assert all(calls[1:])
+        assert monotonic() - 0.1 <= task.deadline <= monotonic()
+
+        task = _PacerTask(lambda repeat: None, 'burst', start)
+        assert not pacer._call(task)
+    finally:
+        pacer.stop()
+
+
+def test_pacer_runs_tasks():
+    """
+    Test Pacer calls its tasks periodically from one thread
+    """
+    import threading
+    import time
+    from twitchstream.outputvideo import Pacer
+    threads = set()
+    calls = []
+
+    def callback(repeat):
+        threads.add(threading.current_thread())
+        calls.append(repeat)
+        return 0.01 if len(calls) < 5 else None
+
+    pacer = Pacer()
+    try:
+        pacer.add_task(callback)
+        pacer.add_task(callback, delay=0.005)
+        time.sleep(0.2)
+    finally:
+        pacer.stop()
+    assert 5 <= len(calls) <= 6
+    assert len(threads) == 1
+
+
+def test_frame_buffer_overflow():
+    """
+    Test the overflow policies of FrameBuffer
+    """
+    import pytest
+    import queue
+    from twitchstream import outputvideo
+
+    discarded = []
+    buf = outputvideo.FrameBuffer(maxsize=2, overflow='block')
+    assert buf.put(1, 'b') == outputvideo.BUFFER_QUEUED
+    assert buf.put(0, 'a') == outputvideo.BUFFER_QUEUED
+    with pytest.raises(queue.Full):
+        buf.put(2, 'c', timeout=0.01)
+    assert buf.get_nowait() == (0, 'a')
+    assert buf.put(2, 'c', timeout=0.01) == outputvideo.BUFFER_QUEUED
+    assert buf.qsize() == 2
+
+    buf = outputvideo.FrameBuffer(maxsize=2, overflow='drop_oldest',
+                                  on_discard=discarded.append)
+    buf.put(0, 'a')
+    buf.put(1, 'b')
+    assert buf.put(2, 'c') == outputvideo.BUFFER_DROPPED_OLDEST
+    assert discarded == ['a']
+    assert buf.get_nowait() == (1, 'b')
+
+    del discarded[:]
+    buf = outputvideo.FrameBuffer(maxsize=1, overflow='drop_newest',
+                                  on_discard=discarded.append)
+    buf.put(0, 'a')
+    assert buf.put(1, 'b') == outputvideo.BUFFER_DROPPED_NEWEST
+    assert discarded == ['b']
+    assert buf.get_nowait() == (0, 'a')
+    with pytest.raises(queue.Empty):
+        buf.get_nowait()
+
+    del discarded[:]
+    buf = outputvideo.FrameBuffer(maxsize=2, overflow='merge',
+                                  on_discard=discarded.append)
+    buf.put(0, 'a')
+    buf.put(1, 'b')
+    assert buf.put(2, 'c') == outputvideo.BUFFER_MERGED
+    assert discarded == ['b']
+    assert buf.get_nowait() == (0, 'a')
+    assert buf.get_nowait() == (2, 'c')
+
+    buf = outputvideo.FrameBuffer(maxsize=1, overflow='merge',
+                                  merge=lambda old, new: old + new)
+    buf.put(0, 'a')
+    buf.put(1, 'b')
+    assert buf.get_nowait() == (1, 'ab')
+
+
+def test_encoder_profile():
+    """
+    Test EncoderProfile
+    """
+    import multiprocessing
+    from twitchstream.outputvideo import EncoderProfile
+    profile = EncoderProfile()
+    args = profile.x264_args(30.)
+    assert args[args.index('-preset') + 1] == 'faster'
+    assert args[args.index('-g') + 1] == '60'
+    assert args[args.index('-threads') + 1] == '2'
+    assert args[args.index('-b:v') + 1] == '3000k'
+
+    profile = EncoderProfile(keyframe_interval=2., adaptive=True)
+    args = profile.x264_args(60.)
+    assert args[args.index('-g') + 1] == '120'
+    assert args[args.index('-threads') + 1] == \
+        '%d' % multiprocessing.cpu_count()
+    assert EncoderProfile(threads=3, adaptive=True).get_threads() == 3
+
+    # nothing can be measured without an encoder
+    profile.prepare('/nonexistent/ffmpeg', 64, 48, 30.)
+    assert profile.calibrated and profile.preset == 'faster'
+
+    profile.report_speed(1.2)
+    assert not profile.falling_behind
+    for _ in range(10):
+        profile.report_speed(0.5)
+    assert profile.falling_behind
+    profile.prepare('/nonexistent/ffmpeg', 64, 48, 30.)
+    assert profile.preset == 'veryfast'
+    assert not profile.falling_behind
+
+
+def test_encoder_profile_cache(tmpdir):
+    """
+    Test a calibration is cached for the next run
+    """
+    from twitchstream.outputvideo import EncoderProfile
+    encoder = tmpdir.join('ffmpeg')
+    encoder.write('#!/bin/sh\n')
+    encoder.chmod(0o755)
+    cache_file = tmpdir.join('cache', 'encoder.json')
+
+    profile = EncoderProfile(adaptive=True, cache_file=str(cache_file))
+    profile.prepare(str(encoder), 64, 48, 30.)
+    # the stand-in encodes in no time, so the best preset is fast enough
+    assert profile.preset == 'faster'
+    cache = json.loads(cache_file.read())
+    assert list(cache.values()) == ['faster']
+
+    for key in cache:
+        cache[key] = 'veryfast'
+    cache_file.write(json.dumps(cache))
+    profile = EncoderProfile(adaptive=True, cache_file=str(cache_file))
+    profile.prepare(str(encoder), 64, 48, 30.)
+    assert profile.preset == 'veryfast'
+    # another stream size is calibrated again
+    profile = EncoderProfile(adaptive=True, cache_file=str(cache_file))
+    profile.prepare(str(encoder), 128, 96, 30.)
+    assert profile.preset == 'faster'
+
+
+def test_parse_progress():
+    """
+    Test TwitchOutputStream._parse_progress
+    """
+    from twitchstream.outputvideo import TwitchOutputStream
+    report = dict(line.split('=', 1) for line in [
+        'frame=150', 'fps=29.97', 'stream_0_0_q=23.0',
+        'bitrate=2998.1kbits/s', 'total_size=1873920',
+        'out_time_us=5000000', 'out_time_ms=5000000',
+        'out_time=00:00:05.000000', 'dup_frames=2', 'drop_frames=1',
+        'speed=1.01x', 'progress=continue'])
+    stats = TwitchOutputStream._parse_progress(report)
+    assert stats == {
+        'frames': 150,
+        'fps': 29.97,
+        'speed': 1.01,
+        'bitrate': 2998.1,
+        'dropped_frames': 1,
+        'duplicated_frames': 2,
+        'out_time': 5.0,
+    }
+
+    report = {'frame': '0', 'fps': '0.00', 'bitrate': 'N/A',
+              'out_time_ms': '0', 'speed': 'N/A', 'progress': 'continue'}
+    stats = TwitchOutputStream._parse_progress(report)
+    assert stats['bitrate'] is None and stats['speed'] is None
+    assert stats['out_time'] == 0.
+    assert stats['dropped_frames'] is None
+
+
+def test_output_args():
+    """
+    Test output_args
+    """
+    import pytest
+    from twitchstream.outputvideo import output_args, output_format
+    assert output_format('rtmp://live.twitch.tv/app/key') == 'flv'
+    assert output_format('archive.MKV') == 'matroska'
+    assert output_format('udp://127.0.0.1:1234') == 'mpegts'
+    with pytest.raises(ValueError):
+        output_format('archive')
+
+    assert output_args(['rtmp://live.twitch.tv/app/key']) == \
+        ['-f', 'flv', 'rtmp://live.twitch.tv/app/key']
+    assert output_args(['null']) == ['-f', 'null', '-']
+    assert output_args([('archive', 'nut')]) == ['-f', 'nut', 'archive']
+
+    args = output_args(['rtmp://live.twitch.tv/app/key',
+                        '/tmp/a|b.flv', 'null'])
+    assert args[:4] == ['-flags', '+global_header', '-f', 'tee']
+    assert args[4] == ('[f=flv]rtmp://live.twitch.tv/app/key|'
+                       '[f=flv:onfail=ignore]/tmp/a\\|b.flv|'
+                       '[f=null:onfail=ignore]-')
+
+
+def test_interleave_audio(streams):
+    """
+    Test TwitchOutputStream._interleave_audio
+    """
+    from twitchstream.outputvideo import TwitchOutputStream
+    stream = streams.open(TwitchOutputStream, width=4, height=2)
+    left = np.array([0.0, 0.5, -2.0])
+    right = np.array([1.0, -0.5, 0.25])
+    samples = stream._interleave_audio(left, right)
+    assert samples.dtype == np.int16
+    assert samples.tobytes() == np.array(
+        [0, 32767, 16383, -16383, -32767, 8191], dtype=np.int16).tobytes()
+
+    # the buffer is reused once it has been given back
+    buffer = samples.base
+    stream._recycle_audio(samples)
+    samples = stream._interleave_audio(np.array([1, 2], dtype=np.int16),
+                                       np.array([3, 4], dtype=np.int16))
+    assert samples.tolist() == [[1, 3], [2, 4]]
+    assert samples.base is buffer
+
+
+def test_audio_buffers_are_recycled(streams):
+    """
+    Test the buffers of the audio written in the background are reused
+    once they have been written, and not before
+    """
+    from twitchstream.outputvideo import TwitchOutputStreamRepeater
+    stream = streams.open(TwitchOutputStreamRepeater, ticking=False,
+                          width=4, height=2, fps=30., enable_audio=True)
+    for i in range(20):
+        stream.send_audio(np.full(1470, i, np.int16),
+                          np.full(1470, -i, np.int16))
+        stream._send_last_audio()
+    streams.close(stream)
+    audio = streams.read_audio(stream).reshape((20, 1470, 2))
+    assert (audio[:, :, 0] == np.arange(20)[:, None]).all()
+    assert (audio[:, :, 1] == -np.arange(20)[:, None]).all()
+    assert 0 < len(stream._audio_buffers) < 20
+
+
+def test_av_sync(streams):
+    """
+    Test TwitchBufferedOutputStream corrects A/V drift after the video
+    buffer ran dry
+    """
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    for av_sync in ('audio', 'video'):
+        # one gray pixel per frame, the ticks are called by the test
+        stream = streams.open(TwitchBufferedOutputStream, ticking=False,
+                              width=1, height=1, fps=30., pix_fmt='gray',
+                              enable_audio=True, av_sync=av_sync,
+                              max_av_drift=0.02)
+        for i in range(1, 13):
+            # the video buffer runs dry for two frames, which arrive late
+            if i == 4:
+                stream.send_video_frame(np.full((1, 1), 2, np.uint8), 1)
+                stream.send_video_frame(np.full((1, 1), 3, np.uint8), 2)
+            if i not in (2, 3):
+                stream.send_video_frame(np.full((1, 1), i, np.uint8), i - 1)
+            stream.send_audio(np.full(1470, i, np.int16),
+                              np.ones(1470, np.int16))
+            stream._send_video_frame()
+        assert abs(stream.get_av_drift()) <= 0.02
+        streams.close(stream)
+        video = np.frombuffer(streams.read_video(stream), np.uint8)
+        audio = streams.read_audio(stream)
+        assert len(video) == 12 and len(audio) == 12 * 1470
+        # in sync again, frames play with the audio sent along with them
+        assert video[-1] == audio[-1, 0]
+        assert video[-1] == (12 if av_sync == 'video' else 10)
+
+
+def test_av_sync_audio_only(streams):
+    """
+    Test TwitchBufferedOutputStream keeps on playing the audio when only
+    audio comes in, and catches up once the video comes back
+    """
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    stream = streams.open(TwitchBufferedOutputStream, ticking=False,
+                          width=1, height=1, fps=30., pix_fmt='gray',
+                          enable_audio=True, av_sync='audio',
+                          max_av_correction=0.5)
+    stream.send_video_frame(np.zeros((1, 1), np.uint8))
+    for i in range(1, 61):
+        stream.send_audio(np.full(1470, i, np.int16),
+                          np.full(1470, i, np.int16))
+        stream._send_video_frame()
+        assert stream.get_audio_buffer_state() == 0
+    # the drift stopped growing at max_av_correction
+    assert stream.get_av_drift() < 0.5 + 2. / 30.
+    for i in range(61, 121):
+        stream.send_video_frame(np.zeros((1, 1), np.uint8))
+        stream.send_audio(np.full(1470, i, np.int16),
+                          np.full(1470, i, np.int16))
+        stream._send_video_frame()
+    assert abs(stream.get_av_drift()) <= 0.04
+    streams.close(stream)
+    audio = streams.read_audio(stream)[::1470, 0]
+    assert audio[:60].tolist() == list(range(1, 61))
+
+
+def test_buffered_frames_are_converted(streams):
+    """
+    Test TwitchBufferedOutputStream buffers float frames as uint8
+    """
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    stream = streams.open(TwitchBufferedOutputStream, ticking=False,
+                          width=6, height=4)
+    stream.send_video_frame(np.ones((4, 6, 3)))
+    frame = np.zeros((4, 6, 3), np.uint8)
+    stream.send_video_frame(frame)
+    assert stream.get_video_frame_buffer_nbytes() == 2 * 4 * 6 * 3
+    _, (pool_frame, data, _) = stream.q_video.get_nowait()
+    assert pool_frame is None
+    assert data.dtype == np.uint8 and (data == 255).all()
+    # uint8 frames are not copied
+    _, (_, data, _) = stream.q_video.get_nowait()
+    assert data is frame
+    assert stream.get_video_frame_buffer_nbytes() == 0
+
+
+def test_frame_cache(streams):
+    """
+    Test FrameCache and the conversion of frames with a version
+    """
+    from twitchstream.outputvideo import FrameCache, TwitchOutputStream
+    cache = FrameCache(maxsize=2)
+    red, green = np.zeros((1, 1, 3)), np.ones((1, 1, 3))
+    cache.put(red, 'red', b'red')
+    cache.put(green, 'green', b'green')
+    assert cache.get(red, 'red') == b'red'
+    assert cache.get(red, 'blue') is None
+    assert cache.get(np.zeros((1, 1, 3)), 'red') is None
+    # green is the least recently used frame
+    cache.put(red, 'blue', b'blue')
+    assert cache.get(green, 'green') is None
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (1, 3)
+
+    stream = streams.open(TwitchOutputStream, width=1, height=1)
+    data = stream._frame_bytes(green, 'green')
+    assert data.tolist() == [[[255, 255, 255]]]
+    assert stream._frame_bytes(green, 'green') is data
+    assert stream._frame_bytes(green) is not data
+    # uint8 frames are sent as they are, without caching
+    pixels = np.zeros((1, 1, 3), np.uint8)
+    assert stream._frame_bytes(pixels, 'black') is pixels
+    assert len(stream.frame_cache) == 1
+
+
+def test_time_to_first_frame(streams):
+    """
+    Test time_to_first_frame is set once the first frame is written to
+    ffmpeg, not when it is handed to the writer thread
+    """
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    stream = streams.open(TwitchBufferedOutputStream, ticking=False,
+                          width=4, height=2)
+    stream.video_writer.suspend()
+    stream._send_video_frame()
+    assert stream.time_to_first_frame is None
+    stream.video_writer.resume(stream.ffmpeg_process.stdin.fileno())
+    assert stream.video_writer.flush(timeout=5.)
+    assert stream.time_to_first_frame > 0.
+
+
+def test_repeater_converts_once(streams):
+    """
+    Test TwitchOutputStreamRepeater converts a frame when it is sent, not
+    every time it is repeated
+    """
+    from twitchstream.outputvideo import TwitchOutputStreamRepeater
+    stream = streams.open(TwitchOutputStreamRepeater, ticking=False,
+                          width=4, height=2, timing_window=10)
+    stream.send_video_frame(np.full((2, 4, 3), 0.5))
+    for _ in range(3):
+        stream._send_last_video_frame()
+    assert stream.timings['convert'].total_count == 1
+    assert stream.timings['write'].total_count == 3
+    streams.close(stream)
+    assert streams.read_video(stream) == b'\x7f' * (3 * 24)
+
+
+def test_timing_histogram(streams):
+    """
+    Test TimingHistogram and the timing of a stream
+    """
+    import time
+    from twitchstream.outputvideo import TimingHistogram, Pacer, \
+        TwitchOutputStreamRepeater
+    histogram = TimingHistogram(size=4)
+    assert histogram.summary()['count'] == 0
+    for duration in (5., 1., 2., 3., 4.):
+        histogram.record(duration)
+    assert histogram.total_count == 5
+    summary = histogram.summary()
+    assert summary['count'] == 4 and summary['max'] == 4.
+    assert summary['mean'] == summary['median'] == 2.5
+    counts, edges = histogram.histogram(bins=[0., 2., 5.])
+    assert counts.tolist() == [1, 3]
+
+    # a task which holds the pacer up makes the ticks of the stream late
+    pacer = Pacer()
+    pacer.add_task(lambda repeat: time.sleep(0.1) or 0.2)
+    try:
+        stream = streams.open(TwitchOutputStreamRepeater, width=4, height=2,
+                              fps=30., timing_window=100, pacer=pacer)
+        assert _wait_for(lambda: stream.late_ticks['video_tick'] > 0)
+    finally:
+        pacer.stop()
+    ticks = stream.timings['video_tick'].total_count
+    assert ticks > 0
+    assert stream.timings['video_tick'].get_durations().max() > .5 / 30.
+    assert stream._timed('video_tick', max, 1, 2) == 2
+    assert stream.get_timings()['video_tick']['count'] == min(ticks + 1,
+                                                              100)
+
+
+def test_rgb_to_yuv420p():
+    """
+    Test rgb_to_yuv420p
+    """
+    from twitchstream.outputvideo import rgb_to_yuv420p
+    frame = np.zeros((2, 4, 3), dtype=np.uint8)
+    frame[:, :2] = [255, 0, 0]      # a red and a white 2x2 block
+    frame[:, 2:] = [255, 255, 255]
+    yuv = rgb_to_yuv420p(frame)
+    assert yuv.dtype == np.uint8 and yuv.shape == (12, )
+    assert yuv[:8].tolist() == [81, 81, 235, 235] * 2
+    assert yuv[8:10].tolist() == [90, 128]
+    assert yuv[10:].tolist() == [240, 128]
+
+    # float frames and BGRA frames
+    assert rgb_to_yuv420p(frame / 255.).tolist() == yuv.tolist()
+    bgra = np.concatenate([frame[:, :, ::-1],
+                           np.zeros((2, 4, 1), dtype=np.uint8)], axis=2)
+    assert rgb_to_yuv420p(bgra, bgr=True).tolist() == yuv.tolist()
+
+    yuv = rgb_to_yuv420p(frame, matrix='bt709')
+    assert yuv[:8].tolist() == [63, 63, 235, 235] * 2
+    assert yuv[8:].tolist() == [102, 128, 240, 128]
+
+    # the bands converted by the worker threads make up the same frame
+    frame = np.random.RandomState(0).randint(0, 256, (200, 64, 3))
+    assert rgb_to_yuv420p(frame.astype(np.uint8), workers=3).tolist() == \
+        rgb_to_yuv420p(frame.astype(np.uint8), workers=1).tolist()
+
+
+def test_pipe_writer():
+    """
+    Test PipeWriter writes in order, and waits for a full pipe
+    """
+    import os
+    import threading
+    from twitchstream.outputvideo import PipeWriter
+    read_fd, write_fd = os.pipe()
+    writer = PipeWriter(max_backlog=2 << 20)
+    done = []
+    data = np.arange(1 << 18, dtype=np.int32)  # larger than the pipe
+    writer.write(write_fd, [b'head', data], callback=lambda: done.append(1))
+    writer.call_after_writes(lambda: done.append(2))
+    writer.write(write_fd, [b'tail'])
+    assert done == []
+    assert not writer.flush(timeout=0.2)
+
+    received = []
+
+    def read():
+        while sum(len(chunk) for chunk in received) < data.nbytes + 8:
+            received.append(os.read(read_fd, 1 << 16))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert writer.flush(timeout=5.)
+    reader.join()
+    assert done == [1, 2]
+    assert b''.join(received) == b'head' + data.tobytes() + b'tail'
+    stats = writer.get_stats()
+    assert stats['bytes_written'] == data.nbytes + 8
+    assert stats['backlog'] == 0 and stats['stall_time'] > 0.1
+    writer.close()
+    os.close(read_fd)
+    os.close(write_fd)
+
+
+def test_play_file(tmpdir, streams):
+    """
+    Test frames are played from a file, and written without copies
+    """
+    import os
+    import pytest
+    from twitchstream.outputvideo import TwitchBufferedOutputStream, \
+        FrameFile, FileRegion, PipeWriter
+    frames = np.arange(3 * 2 * 4 * 3, dtype=np.uint8).reshape((3, 2, 4, 3))
+    path = str(tmpdir.join('frames.npy'))
+    np.save(path, frames)
+    with pytest.raises(ValueError):
+        FrameFile(str(tmpdir.join('frames.raw')))
+
+    stream = streams.open(TwitchBufferedOutputStream, ticking=False,
+                          width=4, height=2)
+    with stream.play_file(path, loop=False) as frame_file:
+        assert len(frame_file) == 3
+        assert frame_file.get_frame(1).tolist() == frames[1].ravel().tolist()
+        data = [stream._next_file_frame() for _ in range(4)]
+        assert data[3] is None
+        # the last frame outlives the file
+        assert not np.may_share_memory(stream.last_frame, frame_file.frames)
+
+        read_fd, write_fd = os.pipe()
+        writer = PipeWriter(max_backlog=1 << 20)
+        writer.write(write_fd, data[:3])
+        assert writer.flush(timeout=5.)
+        assert os.read(read_fd, 1 << 16) == frames.tobytes()
+        writer.close()
+        os.close(read_fd)
+        os.close(write_fd)
+    if isinstance(data[0], FileRegion):
+        assert data[1].offset - data[0].offset == frames[0].nbytes
+
+    stream = streams.open(TwitchBufferedOutputStream, ticking=False,
+                          width=6, height=2)
+    with pytest.raises(ValueError):
+        stream.play_file(frame_file)
+
+
+def test_close_played_file(tmpdir, streams):
+    """
+    Test the stream keeps on streaming after the file it played has been
+    stopped and closed
+    """
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    frames = np.arange(3, dtype=np.uint8)[:, None, None, None] + \
+        np.zeros((3, 2, 4, 3), dtype=np.uint8)
+    path = str(tmpdir.join('frames.npy'))
+    np.save(path, frames)
+    stream = streams.open(TwitchBufferedOutputStream, width=4, height=2,
+                          fps=50., enable_audio=False)
+    for loop in (True, False):
+        frame_file = stream.play_file(path, loop=loop)
+        ticks = stream.ticks
+        assert _wait_for(lambda: stream.ticks > ticks + 5)
+        stream.play_file(None)
+        frame_file.close()
+        ticks = stream.ticks
+        assert _wait_for(lambda: stream.ticks > ticks + 5)
+    stream.send_video_frame(np.full((2, 4, 3), 9, dtype=np.uint8))
+    assert _wait_for(lambda: not stream.get_video_frame_buffer_state())
+    ticks = stream.ticks
+    assert _wait_for(lambda: stream.ticks > ticks + 1)
+    streams.close(stream)
+    video = np.frombuffer(streams.read_video(stream),
+                          dtype=np.uint8).reshape((-1, 24))
+    played = video[:, 0].tolist()
+    # the looping file, then the file which does not loop, played once
+    # and shown until the buffered frame comes along
+    assert played[played.index(0):][:6] == [0, 1, 2, 0, 1, 2]
+    assert played[played.index(9) - 5:played.index(9)] == [2] * 5
+    assert played[-1] == 9
+    assert set(played) <= set([0, 1, 2, 9, 255])
+
+
+def test_pipe_writer_high_fd():
+    """
+    Test PipeWriter waits for a full pipe with a file descriptor which
+    select() does not take, and survives a failing write
+    """
+    import resource
+    import threading
+    import pytest
+    from twitchstream.outputvideo import PipeWriter
+    if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 1500:
+        pytest.skip("too few file descriptors")
+    read_fd, write_fd = os.pipe()
+    high_fd = 1500
+    os.dup2(write_fd, high_fd)
+    writer = PipeWriter(max_backlog=2 << 20)
+    data = np.zeros(1 << 20, dtype=np.uint8)   # larger than the pipe
+    writer.write(high_fd, [data])
+    received = []
+
+    def read():
+        while sum(received) < data.nbytes + 4:
+            received.append(len(os.read(read_fd, 1 << 16)))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert writer.flush(timeout=5.)
+    assert writer.get_stats()['bytes_written'] == data.nbytes
+
+    # the error of a failing write is raised, and the writer goes on
+    writer.write(-1, [b'lost'])
+    with pytest.raises(OSError):
+        writer.flush(timeout=5.)
+    writer.write(high_fd, [b'data'])
+    assert writer.flush(timeout=5.)
+    reader.join()
+    writer.close()
+    for fd in (read_fd, write_fd, high_fd):
+        os.close(fd)
+
+
+def test_pipe_writer_resume():
+    """
+    Test PipeWriter keeps the writes which failed, or were in progress
+    when it was suspended, and writes them to the pipe it resumes to
+    """
+    import threading
+    import pytest
+    from twitchstream.outputvideo import PipeWriter
+    read_fd, write_fd = os.pipe()
+    os.close(read_fd)
+    writer = PipeWriter(max_backlog=2 << 20, keep_failed=True)
+    done = []
+    writer.write(write_fd, [b'failed'], callback=lambda: done.append(1))
+    with pytest.raises(OSError):
+        writer.flush(timeout=5.)
+    # kept until the writer is resumed
+    writer.write(write_fd, [b'kept'], callback=lambda: done.append(2))
+    assert writer.flush(timeout=5.)
+    assert done == [] and writer.get_stats()['backlog'] == 10
+    os.close(write_fd)
+    read_fd, write_fd = os.pipe()
+    writer.resume(write_fd)
+    assert writer.flush(timeout=5.)
+    assert done == [1, 2]
+    assert os.read(read_fd, 1 << 16) == b'failedkept'
+
+    # a write which waits for a full pipe starts over on the new pipe
+    data = np.arange(1 << 18, dtype=np.int32)  # larger than the pipe
+    writer.write(write_fd, [data])
+    assert not writer.flush(timeout=0.2)
+    writer.suspend()
+    new_read_fd, new_write_fd = os.pipe()
+    writer.resume(new_write_fd)
+    received = []
+
+    def read():
+        while sum(len(chunk) for chunk in received) < data.nbytes:
+            received.append(os.read(new_read_fd, 1 << 16))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert writer.flush(timeout=5.)
+    reader.join()
+    assert b''.join(received) == data.tobytes()
+    assert writer.get_stats()['backlog'] == 0
+    writer.close()
+    for fd in (read_fd, write_fd, new_read_fd, new_write_fd):
+        os.close(fd)
+
+
+def test_auto_recover(streams):
+    """
+    Test auto_recover restarts ffmpeg when it stops, unless it stops
+    again within recover_interval
+    """
+    import pytest
+    from twitchstream.outputvideo import TwitchOutputStream, \
+        TwitchBufferedOutputStream
+    frame = np.zeros((2, 4, 3), dtype=np.uint8)
+
+    stream = streams.open(TwitchOutputStream, width=4, height=2,
+                          enable_audio=True, auto_recover=True,
+                          recover_interval=60.)
+    stream.send_video_frame(frame)
+    for failures in (1, 2):
+        process = stream.ffmpeg_process
+        process.kill()
+        process.wait()
+        if failures == 1:
+            stream.send_video_frame(frame)
+            stream.send_audio(np.zeros(10), np.zeros(10))
+            assert stream.recoveries == 1
+            assert stream.ffmpeg_process is not process
+            assert stream.ffmpeg_process.poll() is None
+        else:
+            # failing again right away, restarting won't help
+            with pytest.raises(OSError):
+                stream.send_video_frame(frame)
+            assert stream.recoveries == 1
+
+    stream = streams.open(TwitchBufferedOutputStream, width=4, height=2,
+                          fps=50., enable_audio=True, auto_recover=True)
+    assert _wait_for(lambda: stream.ticks > 5)
+    process = stream.ffmpeg_process
+    process.kill()
+    process.wait()
+    assert _wait_for(lambda: stream.ffmpeg_process is not process)
+    assert _wait_for(lambda: stream.recoveries == 1)
+    # the pacer keeps on streaming to the new ffmpeg
+    ticks = stream.ticks
+    assert _wait_for(lambda: stream.ticks > ticks + 5)
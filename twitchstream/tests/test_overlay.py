@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for overlay.py
+"""
+import os
+import zlib
+
+import numpy as np
+
+
+def test_overlay_filter(streams):
+    """
+    Test the overlays are drawn one after the other by the filter graph
+    """
+    from twitchstream.outputvideo import TwitchOutputStream
+    from twitchstream.overlay import TextOverlay, ImageOverlay
+    with TextOverlay('a: 1', x='w-tw-10') as text, \
+            ImageOverlay(np.zeros((2, 3, 4), dtype=np.uint8)) as image:
+        with open(text.path) as f:
+            assert f.read() == 'a: 1'
+        text.update('a: 2')
+        with open(text.path) as f:
+            assert f.read() == 'a: 2'
+        assert image.input_args(30.)[-1] == image.path
+
+        stream = streams.open(TwitchOutputStream, width=4, height=2,
+                              fps=30., overlays=[text, image])
+        graph = stream._overlay_filter()
+        assert graph.startswith('[0:v]drawtext=textfile=%s:reload=1:'
+                                % text.path)
+        assert 'x=w-tw-10' in graph
+        assert graph.endswith('[v0];[v0][2:v]overlay=x=0:y=0:shortest=1'
+                              '[vout]')
+        paths = [text.path, image.path]
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def test_escape_filter_value():
+    """
+    Test special characters survive the filter options and the filter
+    graph
+    """
+    from twitchstream.overlay import escape_filter_value
+    assert escape_filter_value('C:\\text') == 'C\\\\:\\\\\\\\text'
+    assert escape_filter_value("it's") == "it\\\\\\'s"
+    assert escape_filter_value('a,b') == 'a\\,b'
+
+
+def test_encode_png():
+    """
+    Test the image data of an encoded PNG
+    """
+    from twitchstream.overlay import encode_png
+    image = np.arange(2 * 3 * 3, dtype=np.uint8).reshape((2, 3, 3))
+    png = encode_png(image)
+    assert png.startswith(b'\x89PNG\r\n\x1a\n')
+    start = png.index(b'IDAT') + 4
+    length = int.from_bytes(png[start - 8:start - 4], 'big')
+    rows = zlib.decompress(png[start:start + length])
+    assert rows == b'\x00' + image[0].tobytes() + b'\x00' + \
+        image[1].tobytes()
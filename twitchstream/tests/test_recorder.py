@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for recorder.py
+"""
+import numpy as np
+
+
+class _Stream(object):
+    """
+    Collects what is sent to it, like a buffered stream
+    """
+    frame_shape = (2, 3, 3)
+    fps = 30.
+    audio_enabled = True
+    recorder = None
+
+    def __init__(self):
+        self.frames = []
+        self.audio = []
+
+    def send_video_frame(self, frame):
+        self.frames.append(frame)
+
+    def send_audio(self, left_channel, right_channel):
+        self.audio.append((left_channel, right_channel))
+
+
+def test_record_and_replay(tmpdir):
+    """
+    Test a session replays what was recorded, in order and at its pace
+    """
+    from twitchstream.recorder import SessionRecorder, SessionReplayer, \
+        RECORD_VIDEO, RECORD_AUDIO, RECORD_CHAT
+    path = str(tmpdir.join('session.rec'))
+    stream = _Stream()
+    messages = [{'channel': '#a', 'username': 'b', 'message': 'c'}]
+    with SessionRecorder(path, stream=stream) as recorder:
+        assert stream.recorder is recorder
+        recorder.record_video_frame(np.full((2, 3, 3), 7, dtype=np.uint8))
+        recorder.record_audio(np.arange(5, dtype=np.int16),
+                              -np.arange(5, dtype=np.int16), 0)
+        recorder.record_chat_messages(messages)
+        recorder.record_video_frame(np.ones((2, 3, 3)), 1)
+    assert stream.recorder is None
+
+    replayer = SessionReplayer(path)
+    assert replayer.info == {'frame_shape': [2, 3, 3], 'fps': 30.}
+    assert replayer.get_counts() == {'video': 2, 'audio': 1, 'chat': 1}
+    records = list(replayer.records())
+    assert [record[0] for record in records] == \
+        [RECORD_VIDEO, RECORD_AUDIO, RECORD_CHAT, RECORD_VIDEO]
+    assert [record[2] for record in records] == [None, 0, None, 1]
+    assert records[1][3][1].dtype == np.int16
+    assert records[1][3][1].tolist() == [0, -1, -2, -3, -4]
+    assert records[2][3] == messages
+
+    chat = []
+    replayed = _Stream()
+    stats = replayer.replay(replayed, on_chat=chat.append, speed=None)
+    assert stats['video'] == 2 and stats['chat'] == 1
+    assert [frame.tolist() for frame in replayed.frames] == \
+        [np.full((2, 3, 3), 7).tolist(), np.full((2, 3, 3), 255).tolist()]
+    assert replayed.audio[0][0].tolist() == [0, 1, 2, 3, 4]
+    assert chat == [messages]
@@ -0,0 +1,35 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Tests for renderpool.py
+"""
+import numpy as np
+
+
+def _render(frame_counter, frame):
+    frame[...] = frame_counter
+
+
+def test_render_pool(streams):
+    """
+    Test RenderPool commits the frames rendered by the processes in order
+    """
+    from twitchstream.outputvideo import TwitchBufferedOutputStream
+    from twitchstream.renderpool import RenderPool
+    stream = streams.open(TwitchBufferedOutputStream, ticking=False,
+                          width=6, height=4, frame_pool_size=4)
+
+    with RenderPool(stream, _render, processes=2) as pool:
+        assert pool.render_frames(3) == 3
+        assert stream.frame_pool.get_free_count() == 1
+        frame_counter, (frame, _, _) = stream.q_video.get_nowait()
+        assert frame_counter == 0 and (frame == 0).all()
+        stream.release_frame(frame)
+        assert pool.render_frames(2) == 2
+    assert stream.frame_counter == 5
+    frames = []
+    while stream.q_video.qsize():
+        frame_counter, (frame, _, _) = stream.q_video.get_nowait()
+        assert (frame == frame_counter).all()
+        frames.append(frame_counter)
+    assert frames == [1, 2, 3, 4]